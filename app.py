@@ -1,5 +1,6 @@
 import streamlit as st
 from openai import OpenAI
+import openai
 import json
 import base64
 import requests
@@ -8,24 +9,92 @@ from datetime import datetime
 import hashlib
 import numpy as np
 import re
+import io
+import time
+import threading
+import heapq
+import zlib
+import zipfile
+import html as html_lib
+import sys
+import uuid
+import secrets
+import hmac
+import ipaddress
+from urllib.parse import urlsplit
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except Exception:  # Pillow은 streamlit 의존성이지만 없을 때도 동작
+    Image = None
 
 # =========================================================
 # 1) Page config
 # =========================================================
-st.set_page_config(page_title="AI 윤리 교육 (수업유형 3종)", page_icon="🤖", layout="wide")
+def _in_streamlit_runtime() -> bool:
+    try:
+        from streamlit.runtime import exists
+        return exists()
+    except Exception:
+        return False
+
+# `streamlit run` 밖(`python app.py --warmup`, import)에서는 화면 코드 없이 함수/상수만 정의
+if _in_streamlit_runtime():
+    st.set_page_config(page_title="AI 윤리 교육 (수업유형 3종)", page_icon="🤖", layout="wide")
 
 # =========================================================
 # 2) Models
 # =========================================================
 TEXT_MODEL = "gpt-4o"
+TEXT_MODEL_FAST = "gpt-4o-mini"
 IMAGE_MODEL = "dall-e-3"
 EMBED_MODEL = "text-embedding-3-small"
 
+# 호출 종류별 모델 단계(앞에서부터 사용, 예산/지연 초과 시 다음 단계로 강등)
+CALL_CLASS_TIERS = {
+    "lesson": [TEXT_MODEL, TEXT_MODEL_FAST],    # 수업 설계/질문 나무
+    "feedback": [TEXT_MODEL, TEXT_MODEL_FAST],  # 학생 답 피드백 JSON
+    "debate": [TEXT_MODEL_FAST],                # 2줄 꼬리 질문
+    "summary": [TEXT_MODEL, TEXT_MODEL_FAST],   # 반 전체 답 묶음 요약
+}
+CALL_CLASS_DAILY_TOKENS = {"lesson": 400_000, "feedback": 800_000, "debate": 300_000, "summary": 200_000}
+LESSON_DAILY_TOKENS = 250_000  # 수업 코드(반)별 하루 토큰 상한: 한 반이 공용 예산을 다 쓰지 않게
+DAILY_COST_BUDGET_USD = 20.0
+BUDGET_DEGRADE_AT = 0.8  # 일 예산의 80%를 넘으면 가장 싼 단계만 사용
+LATENCY_SLO_S = {"lesson": 45.0, "feedback": 12.0, "debate": 6.0, "summary": 30.0}
+LATENCY_RETRY_S = 120  # SLO 초과로 강등된 단계도 이 시간 뒤 다시 시도
+MODEL_PRICE_PER_1M = {  # (입력, 출력) USD / 1M tokens
+    TEXT_MODEL: (2.50, 10.00),
+    TEXT_MODEL_FAST: (0.15, 0.60),
+}
+
+# 모델별 토큰 버킷(분당 요청 수, 버스트) + 우선순위(작을수록 먼저)
+RATE_LIMITS_PER_MIN = {
+    TEXT_MODEL: (120, 10),
+    TEXT_MODEL_FAST: (300, 20),
+    IMAGE_MODEL: (5, 2),
+    EMBED_MODEL: (300, 20),
+}
+RATE_WAIT_TIMEOUT_S = 90
+PRIORITY_STUDENT = 0  # 학생 피드백/학생이 누른 생성
+PRIORITY_WARM = 1     # 단계 삽화 미리 생성
+PRIORITY_TEACHER = 2  # 교사 수업 (재)생성
+
 # =========================================================
 # 3) Internal RAG (reference.txt only)
 # =========================================================
 REFERENCE_PATH = "reference.txt"
 RAG_TOP_K = 4
+# 색인 저장 형식: 축소 차원 + 단위 정규화 후 양자화("int8" | "float16" | "float32")
+EMBED_DIMENSIONS = 512
+EMBED_STORAGE = "int8"
+EMBED_FULL_DIMS = {"text-embedding-3-small": 1536, "text-embedding-3-large": 3072, "text-embedding-ada-002": 1536}
+# 재현율 측정: 색인 밖 실제 질의(고정 스토리 단계 + 주제) vs 전체 차원 float32, 청크는 최대 이만큼 표본
+RAG_RECALL_SAMPLE = 256
+RAG_RECALL_TOPICS = ["저작권", "개인정보", "딥페이크", "AI 그림 출처", "데이터 편향"]
 
 # =========================================================
 # 4) Image prompt policy: NO TEXT
@@ -37,14 +106,77 @@ NO_TEXT_IMAGE_PREFIX = (
     "No text-like shapes. Only 그림/도형/사물. "
 )
 
+# 학생 프롬프트 사전 점검(유료 생성 전): 글자 요청은 빼고 진행, 나머지는 생성 없이 안내
+IMAGE_PROMPT_MIN_HANGUL = 2  # "공룡", "우주" 처럼 한글은 2음절이면 충분
+IMAGE_PROMPT_MIN_LATIN = 3   # 영어는 글자 수로("sun", "cat")
+_KO_PARTICLES = "은|는|이|가|을|를|의|와|과|도|로|으로|처럼|같은|같이|랑|이랑|만|님"
+
+def _ko_words(*words) -> str:
+    # 한글 단어 통째로만(뒤에 조사 허용): "방탄"은 잡고 "방탄조끼"는 안 잡음
+    return rf"(?<![가-힣])(?:{'|'.join(words)})(?:{_KO_PARTICLES})?(?![가-힣])"
+
+_TEXT_WORDS_KO = "글자|글씨|문구|텍스트|숫자|제목|슬로건"
+_TEXT_WORDS_EN = r"text|words?|letters?|titles?|captions?|slogans?|typography|writing|lettering|numbers?"
+# "글자 없이/없는", "no text", "without letters" 처럼 글자를 빼 달라는 말은 글자 요청이 아님
+IMAGE_PROMPT_TEXT_NEG_RE = re.compile(
+    rf"(?:{_TEXT_WORDS_KO})\s*(?:(?:은|는|이|가|을|를|도)\s*)?(?:없이|없는|없고|없음|없게|빼고|말고|넣지\s*말|쓰지\s*말|금지)|"
+    rf"\b(?:no|without|zero|avoid(?:ing)?|not?\s+any|free\s+of)\s+(?:(?:any|visible|written)\s+)?(?:{_TEXT_WORDS_EN})\b|"
+    r"\btext[\s-]*(?:free|less)\b",
+    re.I,
+)
+# 글자 요청은 분명한 말이 있을 때만: 글씨/문구 같은 낱말, "써 줘", "says". 숫자/제목/이름/word 는 쓰라는 말이 같이 있어야 함
+# ("숫자 모양 구름", "a number of birds" 는 글자 요청이 아님)
+IMAGE_PROMPT_TEXT_RE = re.compile(
+    rf"{_ko_words('글자', '글씨', '문구', '텍스트', '슬로건', '구호')}|"
+    r"(?:숫자|제목|이름|인사말)\s*(?:을|를|이|가)?\s*(?:크게\s*)?(?:써|쓰|넣|적|박)|써\s*줘|적어\s*줘|"
+    r"\b(?:text|captions?|slogans?|typography|lettering|says|saying|spell(?:ed|ing)?|written|write)\b|"
+    r"\b(?:with|put|add)\s+(?:the\s+|a\s+|some\s+|my\s+|our\s+)?(?:words?|letters?|titles?|numbers?|names?)\b",
+    re.I,
+)
+IMAGE_PROMPT_BLOCK_RULES = [
+    ("brand", re.compile(
+        _ko_words("나이키", "아디다스", "디즈니", "마블", "포켓몬", "피카츄", "마리오", r"헬로\s*키티", "짱구", "뽀로로", "스타벅스", "맥도날드")
+        + r"|\b(nike|adidas|disney|marvel|pok[eé]mon|pikachu|mario|hello\s*kitty|starbucks|mcdonald'?s|mickey)\b",
+        re.I,
+    ), "다른 회사나 만화의 캐릭터·로고는 저작권이 있어서 만들 수 없어요. 나만의 새로운 캐릭터로 바꿔 볼까요?"),
+    ("person", re.compile(
+        _ko_words("아이유", "손흥민", "방탄", "방탄소년단", "블랙핑크", "뉴진스", "대통령", r"실제\s*사람", r"실존\s*인물")
+        + r"|\b(bts|blackpink|trump|obama|elon\s*musk|taylor\s*swift|celebrity|real\s+person)\b",
+        re.I,
+    ), "실제 사람(연예인·선수 등)의 모습은 만들 수 없어요. 상상 속 인물이나 동물로 바꿔 보세요."),
+    ("unsafe", re.compile(
+        _ko_words("피투성이", "살인", "죽이는", "죽이기", "죽여", "죽였", r"총(?=을|으로)", "총알", "총싸움", "칼", "폭탄", "시체", "귀신", "좀비", "야한", "벗은", "담배", "마약", "술병")
+        + r"|\b(blood(y)?|gore|kill(ing)?|guns?|weapons?|bombs?|zombies?|horror|nude|naked|sexy|drugs?|cigarettes?)\b",
+        re.I,
+    ), "무섭거나 위험한 장면은 만들 수 없어요. 밝고 안전한 장면으로 바꿔 보세요."),
+]
+# 위험 낱말이 들어 있어도 해가 없는 말(물총 놀이 등)은 규칙 검사 전에 지움(애매한 나머지는 분류기/생성 API 검수 몫)
+IMAGE_PROMPT_SAFE_RE = re.compile(r"\b(?:water|toy|squirt|nerf|glue|bubble)[\s-]*guns?\b|물총|장난감\s*총", re.I)
+IMAGE_PROMPT_CLF_THRESHOLD = 0.85  # 규칙에 안 걸린 프롬프트는 확신할 때만 거절
+
+# 표시용 썸네일: 원본(1024 PNG)은 디스크에만, 세션/전송은 작은 WebP
+IMAGE_SIZE = "1024x1024"
+IMAGE_STORE_DIR = Path(".image_store")
+THUMB_MAX_PX = 420  # 화면 최대 표시 폭(show_step_illustration_medium)
+THUMB_FORMAT = "WEBP"  # 실패 시 JPEG
+THUMB_QUALITY = 80
+
+# 이미지 생성: 1회 호출 원칙(유료 생성 중복 금지)
+IMAGE_TIMEOUT_S = 90
+IMAGE_MAX_ATTEMPTS = 3  # 생성 전에 거절된 오류(429/5xx/연결)만 재시도
+IMAGE_BACKOFF_S = 2.0
+IMAGE_DOWNLOAD_TIMEOUT_S = 25
+
 # =========================================================
 # 5) OpenAI client
 # =========================================================
 try:
-    client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY") or st.secrets["OPENAI_API_KEY"])
 except Exception:
-    st.error("⚠️ API 키 오류: secrets.toml을 확인하세요.")
-    st.stop()
+    client = None
+    if _in_streamlit_runtime():
+        st.error("⚠️ API 키 오류: secrets.toml을 확인하세요.")
+        st.stop()
 
 # =========================================================
 # 6) System prompts
@@ -108,61 +240,696 @@ def _clip(s: str, max_len: int = 1800) -> str:
     s = (s or "").strip()
     return s[:max_len] + ("…" if len(s) > max_len else "")
 
+# ---- JSON fast path + 잘린 출력 복구 ----
+try:
+    import orjson  # 선택 설치: 있으면 빠른 파서 사용
+    _json_loads = orjson.loads
+except Exception:
+    _json_loads = json.loads
+
+_CODE_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+
+@st.cache_resource(show_spinner=False)
+def get_json_quality_stats() -> dict:
+    # partial: 잘린 JSON 복구, reask: 일부 필드 재요청, fallback: 모양별 기본값 대체
+    return {"lock": threading.Lock(), "partial": 0, "reask": 0, "reask_fixed": 0, "fallback": {}}
+
+def _bump_json_stat(name: str, shape: str = ""):
+    stats = get_json_quality_stats()
+    with stats["lock"]:
+        if name == "fallback":
+            stats["fallback"][shape] = stats["fallback"].get(shape, 0) + 1
+        else:
+            stats[name] += 1
+
+def _close_partial_json(s: str):
+    # 최상위 객체가 끝나지 않았으면 마지막으로 완결된 값까지 자르고 괄호를 닫음
+    stack, in_str, esc, last_safe = [], False, False, None
+    for i, ch in enumerate(s):
+        if in_str:
+            if esc:
+                esc = False
+            elif ch == "\\":
+                esc = True
+            elif ch == '"':
+                in_str = False
+            continue
+        if ch == '"':
+            in_str = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                return s[:i + 1]
+            last_safe = (i + 1, list(stack))
+        elif ch == "," and stack:
+            last_safe = (i, list(stack))
+    if last_safe is None:
+        return None
+    pos, open_stack = last_safe
+    return s[:pos] + "".join(reversed(open_stack))
+
 def safe_json_load(s: str):
     if not s:
         return None
-    s = s.strip()
+    s = _CODE_FENCE_RE.sub("", s.strip())
     try:
-        return json.loads(s)
+        return _json_loads(s)
     except Exception:
+        pass
+    a = s.find("{")
+    if a == -1:
+        return None
+    b = s.rfind("}")
+    if b > a:
+        try:
+            return _json_loads(s[a:b + 1])
+        except Exception:
+            pass
+    fixed = _close_partial_json(s[a:])
+    if fixed:
         try:
-            a = s.find("{")
-            b = s.rfind("}")
-            if a != -1 and b != -1 and b > a:
-                return json.loads(s[a:b + 1])
+            data = _json_loads(fixed)
+            _bump_json_stat("partial")
+            return data
         except Exception:
             return None
     return None
 
-def ask_gpt_json_object(prompt: str, system_prompt: str = SYSTEM_PERSONA) -> dict:
+# ---- Compiled schema validators (lesson / debate / feedback) ----
+_MISSING = object()
+
+def _compile_field(f: dict):
+    kind = f.get("type", "str")
+    required = f.get("required", False)
+    default = f.get("default")
+
+    if kind == "str":
+        choices = f.get("choices")
+
+        def check(v):
+            if isinstance(v, (str, int, float)) and not isinstance(v, bool):
+                s = str(v).strip()
+                if choices:
+                    s = s.upper()
+                    if s in choices:
+                        return True, s
+                elif s:
+                    return True, s
+            return (not required), (default if default is not None else "")
+        return check
+
+    if kind == "str_list":
+        max_items, min_items = f.get("max_items"), f.get("min_items", 0)
+
+        def check(v):
+            if isinstance(v, list):
+                items = [str(x).strip() for x in v if str(x).strip()]
+                items = items[:max_items] if max_items else items
+                if len(items) >= min_items and (items or not required):
+                    return True, items
+            return (not required), list(default or [])
+        return check
+
+    if kind == "dict":
+        sub = compile_schema(f.get("schema", {}))
+
+        def check(v):
+            val, errs = sub(v if isinstance(v, dict) else {})
+            return (not errs) if (required or isinstance(v, dict)) else True, val
+        check.sub = sub
+        return check
+
+    if kind == "list":
+        by_index = [compile_schema(x) for x in f.get("items_by_index", [])]
+        items = compile_schema(f["items"]) if f.get("items") else None
+        min_items = f.get("min_items", 0)
+
+        def check(v):
+            if not isinstance(v, list) or len(v) < min_items:
+                return (not required), list(default or [])
+            out, ok = [], True
+            for i, x in enumerate(v):
+                sub = by_index[i] if i < len(by_index) else items
+                if sub is None:
+                    break
+                val, errs = sub(x if isinstance(x, dict) else {})
+                ok = ok and not errs
+                out.append(val)
+            return ok, out
+        return check
+
+    raise ValueError(f"unknown field type: {kind}")
+
+def compile_schema(spec: dict):
+    # spec을 한 번만 검사 함수로 컴파일. validate(data) -> (정리된 dict, 오류 필드 목록)
+    checks = [(name, _compile_field(f)) for name, f in spec.items()]
+
+    def validate(data):
+        data = data if isinstance(data, dict) else {}
+        out, errors = {}, []
+        for name, check in checks:
+            ok, val = check(data.get(name, _MISSING))
+            out[name] = val
+            if not ok:
+                errors.append(name)
+        return out, errors
+
+    validate.spec = spec
+    return validate
+
+ANALYSIS_SPEC = {
+    "ethics_standards": {"type": "str_list"},
+    "curriculum_alignment": {"type": "str_list"},
+    "lesson_content": {"type": "str_list"},
+}
+
+IMAGE_LESSON_SPEC = {
+    "topic": {"type": "str"},
+    "analysis": {"type": "dict", "schema": ANALYSIS_SPEC, "desc": "ethics_standards/curriculum_alignment/lesson_content 리스트"},
+    "teacher_guide": {"type": "str"},
+    "steps": {
+        "type": "list",
+        "required": True,
+        "min_items": 3,
+        "desc": "길이 3 리스트: [image_revision, dilemma, discussion]",
+        "items_by_index": [
+            # 단계 안의 키는 필수 아님(기존처럼 3단계 리스트면 그대로 사용, 빠진 값은 빈 값)
+            {
+                "type": {"type": "str", "default": "image_revision"},
+                "story": {"type": "str"},
+                "prompt_goal": {"type": "str"},
+                "checklist_items": {"type": "str_list", "max_items": 9},
+                "reflection_question": {"type": "str", "default": "어떤 내용의 로고를 제작했나요?"},
+            },
+            {
+                "type": {"type": "str", "default": "dilemma"},
+                "story": {"type": "str"},
+                "choice_a": {"type": "str"},
+                "choice_b": {"type": "str"},
+            },
+            {
+                "type": {"type": "str", "default": "discussion"},
+                "story": {"type": "str"},
+                "question": {"type": "str"},
+            },
+        ],
+    },
+}
+
+DEBATE_LESSON_SPEC = {
+    "topic": {"type": "str"},
+    "analysis": {"type": "dict", "schema": ANALYSIS_SPEC, "desc": "ethics_standards/curriculum_alignment/lesson_content 리스트"},
+    "teacher_guide": {"type": "str"},
+    "debate_step": {
+        "type": "dict",
+        "required": True,
+        "desc": "case_title, case_summary, story, choice_a, choice_b, opening_question, constraints",
+        "schema": {
+            "case_title": {"type": "str"},
+            "case_summary": {"type": "str"},
+            "story": {"type": "str", "required": True},
+            "choice_a": {"type": "str"},
+            "choice_b": {"type": "str"},
+            "opening_question": {"type": "str"},
+            "constraints": {"type": "str_list"},
+        },
+    },
+    "closing_step": {
+        "type": "dict",
+        "required": True,
+        "desc": "story, question",
+        "schema": {
+            "story": {"type": "str"},
+            "question": {"type": "str", "required": True},
+        },
+    },
+}
+
+# 빠진 문장은 재요청 대신 기본 문장으로 채움(학생 대기 시간에 LLM 왕복 추가 금지)
+_FEEDBACK_TEXT_SPEC = {
+    "praise": {"type": "str", "required": True, "desc": "칭찬(구체적 1문장)", "default": "자기 생각을 글로 정리한 점이 좋아요."},
+    "risk": {"type": "str", "required": True, "desc": "위험/주의점(1문장)", "default": "근거가 충분한지 한 번 더 살펴봐요."},
+    "check_question": {"type": "str", "required": True, "desc": "확인 질문(1문장)", "default": "그렇게 생각한 까닭을 한 가지 더 말해 볼래요?"},
+    "next_action": {"type": "str", "required": True, "desc": "다음 행동(1문장)", "default": "선생님이 정한 기준에 맞는지 다시 확인해 봐요."},
+}
+
+FEEDBACK_SPEC = {
+    "tags": {"type": "str_list", "max_items": 3},
+    "summary": {"type": "str"},
+    "template": {"type": "str", "choices": ["A", "B"], "default": "A"},
+    **_FEEDBACK_TEXT_SPEC,
+}
+
+validate_analysis = compile_schema(ANALYSIS_SPEC)
+validate_image_lesson = compile_schema(IMAGE_LESSON_SPEC)
+validate_debate_lesson = compile_schema(DEBATE_LESSON_SPEC)
+validate_feedback = compile_schema(FEEDBACK_SPEC)
+validate_feedback_text = compile_schema(_FEEDBACK_TEXT_SPEC)
+
+# ---- Shared cache backend: 여러 서버 프로세스/레플리카가 같이 쓰는 캐시 ----
+# SHARED_CACHE_URL 예) sqlite:///.shared_cache/cache.db (기본), none
+# 다른 저장소(예: Redis)는 CacheBackend를 구현해 CACHE_BACKENDS에 scheme으로 등록.
+SHARED_CACHE_URL_DEFAULT = "sqlite:///.shared_cache/cache.db"
+# 큰 바이트(이미지 원본/에셋/내보내기 zip)는 기간 + 네임스페이스별 용량 상한. 넘으면 먼저 만료될 것부터 지움
+SHARED_IMAGE_TTL_S = 7 * 24 * 3600
+SHARED_ASSET_TTL_S = 3 * 24 * 3600
+SHARED_CACHE_NS_MAX_BYTES = {"image": 512 * 1024 * 1024, "asset": 256 * 1024 * 1024}
+
+class CacheBackend:
+    """(namespace, key) → bytes. 실패는 예외 대신 None/무시로 처리."""
+
+    def get(self, ns: str, key: str):
+        return None
+
+    def set(self, ns: str, key: str, value: bytes, ttl_s: float = None):
+        pass
+
+    def delete(self, ns: str, key: str):
+        pass
+
+    def prune(self, ns: str, max_bytes: int):
+        pass
+
+class SQLiteCacheBackend(CacheBackend):
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "ns TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, expires_at REAL, "
+            "PRIMARY KEY (ns, key))"
+        )
+
+    def get(self, ns: str, key: str):
+        try:
+            with self.lock:
+                row = self.conn.execute(
+                    "SELECT value, expires_at FROM cache WHERE ns = ? AND key = ?", (ns, key)
+                ).fetchone()
+            if not row:
+                return None
+            if row[1] is not None and row[1] < time.time():
+                self.delete(ns, key)
+                return None
+            return bytes(row[0])
+        except Exception:
+            return None
+
+    def set(self, ns: str, key: str, value: bytes, ttl_s: float = None):
+        try:
+            expires_at = time.time() + ttl_s if ttl_s else None
+            with self.lock:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO cache (ns, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                    (ns, key, sqlite3.Binary(value), expires_at),
+                )
+        except Exception:
+            pass
+        if ns in SHARED_CACHE_NS_MAX_BYTES:
+            self.prune(ns, SHARED_CACHE_NS_MAX_BYTES[ns])
+
+    def delete(self, ns: str, key: str):
+        try:
+            with self.lock:
+                self.conn.execute("DELETE FROM cache WHERE ns = ? AND key = ?", (ns, key))
+        except Exception:
+            pass
+
+    def prune(self, ns: str, max_bytes: int):
+        # 만료된 행 삭제 → 그래도 max_bytes 를 넘으면 만료가 가까운(=오래된) 것부터 삭제
+        try:
+            with self.lock:
+                self.conn.execute("DELETE FROM cache WHERE ns = ? AND expires_at < ?", (ns, time.time()))
+                total = self.conn.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM cache WHERE ns = ?", (ns,)).fetchone()[0]
+                if total <= max_bytes:
+                    return
+                rows = self.conn.execute(
+                    "SELECT key, LENGTH(value) FROM cache WHERE ns = ? ORDER BY COALESCE(expires_at, 0), rowid", (ns,)
+                ).fetchall()
+                drop = []
+                for key, size in rows:
+                    if total <= max_bytes:
+                        break
+                    drop.append((ns, key))
+                    total -= size
+                self.conn.executemany("DELETE FROM cache WHERE ns = ? AND key = ?", drop)
+        except Exception:
+            pass
+
+CACHE_BACKENDS = {
+    "sqlite": lambda url: SQLiteCacheBackend(url[len("sqlite:///"):]),
+    "none": lambda url: CacheBackend(),
+}
+
+def _shared_cache_url() -> str:
+    url = os.environ.get("SHARED_CACHE_URL", "")
+    if not url:
+        try:
+            url = st.secrets.get("SHARED_CACHE_URL", "")
+        except Exception:
+            url = ""
+    return url or SHARED_CACHE_URL_DEFAULT
+
+@st.cache_resource(show_spinner=False)
+def get_shared_cache() -> CacheBackend:
+    url = _shared_cache_url()
+    factory = CACHE_BACKENDS.get(url.split(":", 1)[0])
+    try:
+        return factory(url) if factory else CacheBackend()
+    except Exception:
+        return CacheBackend()
+
+def shared_get_json(ns: str, key: str):
+    raw = get_shared_cache().get(ns, key)
+    return safe_json_load(raw.decode("utf-8")) if raw else None
+
+def shared_set_json(ns: str, key: str, value, ttl_s: float = None):
+    get_shared_cache().set(ns, key, json.dumps(value, ensure_ascii=False).encode("utf-8"), ttl_s)
+
+# ---- Single-flight: 동일 요청이 동시에 들어오면 업스트림 호출 1번만 ----
+@st.cache_resource(show_spinner=False)
+def get_inflight_registry() -> dict:
+    return {"lock": threading.Lock(), "calls": {}, "leader": 0, "shared": 0}
+
+def single_flight_key(*parts) -> str:
+    return hashlib.sha256("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+def single_flight(key: str, fn):
+    reg = get_inflight_registry()
+    with reg["lock"]:
+        call = reg["calls"].get(key)
+        leader = call is None
+        if leader:
+            call = {"event": threading.Event(), "result": None, "error": None}
+            reg["calls"][key] = call
+            reg["leader"] += 1
+        else:
+            reg["shared"] += 1
+
+    if not leader:
+        call["event"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"]
+
+    try:
+        call["result"] = fn()
+        return call["result"]
+    except Exception as e:
+        call["error"] = e
+        raise
+    finally:
+        with reg["lock"]:
+            reg["calls"].pop(key, None)
+        call["event"].set()
+
+# ---- Rate scheduler: 세션 전체가 공유하는 모델별 토큰 버킷 + 우선순위 대기열 ----
+@st.cache_resource(show_spinner=False)
+def get_rate_scheduler() -> dict:
+    return {"cond": threading.Condition(), "buckets": {}, "seq": 0}
+
+def _rate_bucket(sched: dict, model: str) -> dict:
+    b = sched["buckets"].get(model)
+    if b is None:
+        rpm, burst = RATE_LIMITS_PER_MIN.get(model, (60, 5))
+        b = {
+            "rate": rpm / 60.0,
+            "capacity": float(burst),
+            "tokens": float(burst),
+            "updated": time.monotonic(),
+            "queue": [],
+        }
+        sched["buckets"][model] = b
+    return b
+
+def acquire_rate_slot(model: str, priority: int = PRIORITY_STUDENT, timeout: float = RATE_WAIT_TIMEOUT_S) -> bool:
+    sched = get_rate_scheduler()
+    cond = sched["cond"]
+    deadline = time.monotonic() + timeout
+    with cond:
+        b = _rate_bucket(sched, model)
+        sched["seq"] += 1
+        ticket = (int(priority), sched["seq"])
+        heapq.heappush(b["queue"], ticket)
+        try:
+            while True:
+                now = time.monotonic()
+                b["tokens"] = min(b["capacity"], b["tokens"] + (now - b["updated"]) * b["rate"])
+                b["updated"] = now
+                is_head = b["queue"][0] == ticket
+                if is_head and b["tokens"] >= 1.0:
+                    b["tokens"] -= 1.0
+                    return True
+                remaining = deadline - now
+                if remaining <= 0:
+                    return False
+                wait = min(remaining, (1.0 - b["tokens"]) / b["rate"]) if is_head else remaining
+                cond.wait(timeout=max(0.01, wait))
+        finally:
+            b["queue"].remove(ticket)
+            heapq.heapify(b["queue"])
+            cond.notify_all()
+
+def rate_queue_depth(model: str) -> int:
+    sched = get_rate_scheduler()
+    with sched["cond"]:
+        b = sched["buckets"].get(model)
+        return len(b["queue"]) if b else 0
+
+def queue_wait_text(base: str, model: str = None, call_class: str = "feedback") -> str:
+    # model 생략 시 이 호출 종류가 지금 쓸 모델 단계의 대기열
+    n = rate_queue_depth(model or peek_text_model(call_class))
+    return f"{base} (요청이 많아 기다리는 중: 앞에 {n}건)" if n > 0 else base
+
+# ---- Budget governor: 호출 종류별 모델 단계 + 일일 토큰/비용 예산 + 지연 SLO ----
+class BudgetExceededError(RuntimeError):
+    pass
+
+_BUDGET_LOCAL = threading.local()  # 세션 밖(내보낸 수업의 피드백 API)에서 부를 때 수업 코드
+
+@st.cache_resource(show_spinner=False)
+def get_budget_governor() -> dict:
+    return {"lock": threading.Lock(), "day": "", "usage": {}, "lessons": {}, "latency": {}, "events": []}
+
+def _governor_roll_day(gov: dict):
+    today = datetime.now().strftime("%Y-%m-%d")
+    if gov["day"] != today:
+        gov.update({"day": today, "usage": {}, "lessons": {}, "events": []})
+
+def current_budget_lesson() -> str:
+    lesson_id = getattr(_BUDGET_LOCAL, "lesson_id", None)
+    if lesson_id is not None:
+        return lesson_id
+    try:
+        return str(st.session_state.get("lesson_id", "") or "")
+    except Exception:
+        return ""
+
+def _class_usage(gov: dict, call_class: str) -> dict:
+    return gov["usage"].setdefault(call_class, {"tokens": 0, "cost": 0.0, "calls": 0, "degraded": 0, "blocked": 0})
+
+def _governor_event(gov: dict, call_class: str, action: str, reason: str):
+    gov["events"].append({"t": datetime.now().strftime("%H:%M:%S"), "class": call_class, "action": action, "reason": reason})
+    del gov["events"][:-50]
+
+def _pick_text_model(gov: dict, call_class: str, lesson_id: str):
+    # (모델, 강등 이유, 예산 소진 여부). 호출 종류 토큰/전체 비용/수업 코드 토큰 중 가장 많이 쓴 비율 기준
+    tiers = CALL_CLASS_TIERS.get(call_class, [TEXT_MODEL])
+    use = _class_usage(gov, call_class)
+    total_cost = sum(u["cost"] for u in gov["usage"].values())
+    frac = max(use["tokens"] / max(1, CALL_CLASS_DAILY_TOKENS.get(call_class, 10**9)), total_cost / DAILY_COST_BUDGET_USD)
+    lesson_frac = gov["lessons"].get(lesson_id, 0) / LESSON_DAILY_TOKENS if lesson_id else 0.0
+    scope = f"수업 {lesson_id} " if lesson_frac > frac else ""
+    if max(frac, lesson_frac) >= 1.0:
+        return tiers[-1], f"{scope}일 예산 소진", True
+    if max(frac, lesson_frac) >= BUDGET_DEGRADE_AT:
+        return tiers[-1], f"{scope}예산 {max(frac, lesson_frac):.0%}", False
+    slo = LATENCY_SLO_S.get(call_class)
+    model, reason = tiers[-1], ""
+    for m in tiers:
+        lat, seen = gov["latency"].get((call_class, m), (None, 0.0))
+        if lat is not None and time.monotonic() - seen > LATENCY_RETRY_S:
+            lat = None
+        if slo is None or lat is None or lat <= slo:
+            return m, "", False
+        reason = f"{m} 지연 {lat:.1f}s > {slo:.0f}s"
+    return model, reason, False
+
+def choose_text_model(call_class: str) -> str:
+    # 사용할 모델. 예산 소진이면 BudgetExceededError(호출부는 캐시/기본값으로 대체)
+    tiers = CALL_CLASS_TIERS.get(call_class, [TEXT_MODEL])
+    gov = get_budget_governor()
+    with gov["lock"]:
+        _governor_roll_day(gov)
+        use = _class_usage(gov, call_class)
+        model, reason, exhausted = _pick_text_model(gov, call_class, current_budget_lesson())
+        if exhausted:
+            use["blocked"] += 1
+            _governor_event(gov, call_class, "fallback", reason)
+            raise BudgetExceededError(call_class)
+        if model != tiers[0]:
+            use["degraded"] += 1
+            _governor_event(gov, call_class, f"→ {model}", reason)
+        return model
+
+def peek_text_model(call_class: str) -> str:
+    # 기록 없이 지금 고를 모델만(대기열 안내용)
+    gov = get_budget_governor()
+    with gov["lock"]:
+        _governor_roll_day(gov)
+        return _pick_text_model(gov, call_class, current_budget_lesson())[0]
+
+def budget_exhausted(call_class: str) -> bool:
+    gov = get_budget_governor()
+    with gov["lock"]:
+        _governor_roll_day(gov)
+        return _pick_text_model(gov, call_class, current_budget_lesson())[2]
+
+def record_text_usage(call_class: str, model: str, usage, latency_s: float):
+    p_in, p_out = MODEL_PRICE_PER_1M.get(model, MODEL_PRICE_PER_1M[TEXT_MODEL])
+    tin = int(getattr(usage, "prompt_tokens", 0) or 0)
+    tout = int(getattr(usage, "completion_tokens", 0) or 0)
+    gov = get_budget_governor()
+    with gov["lock"]:
+        _governor_roll_day(gov)
+        use = _class_usage(gov, call_class)
+        use["tokens"] += tin + tout
+        use["cost"] += (tin * p_in + tout * p_out) / 1_000_000
+        use["calls"] += 1
+        lesson_id = current_budget_lesson()
+        if lesson_id:
+            gov["lessons"][lesson_id] = gov["lessons"].get(lesson_id, 0) + tin + tout
+        prev, seen = gov["latency"].get((call_class, model), (None, 0.0))
+        if prev is not None and time.monotonic() - seen <= LATENCY_RETRY_S:
+            latency_s = 0.7 * prev + 0.3 * latency_s
+        gov["latency"][(call_class, model)] = (latency_s, time.monotonic())
+
+def budget_report() -> dict:
+    gov = get_budget_governor()
+    with gov["lock"]:
+        _governor_roll_day(gov)
+        rows = {
+            c: {
+                **_class_usage(gov, c),
+                "budget": CALL_CLASS_DAILY_TOKENS.get(c),
+                "latency": {m: round(gov["latency"][(c, m)][0], 1) for m in CALL_CLASS_TIERS[c] if (c, m) in gov["latency"]},
+            }
+            for c in CALL_CLASS_TIERS
+        }
+        lessons = dict(sorted(gov["lessons"].items(), key=lambda kv: -kv[1])[:10])
+        return {"day": gov["day"], "classes": rows, "lessons": lessons, "events": list(gov["events"])}
+
+COMPLETION_CACHE_TTL_S = 7 * 24 * 3600
+
+def _chat_completion_content(messages: list, temperature: float, json_mode: bool = False, priority: int = PRIORITY_STUDENT, cache: bool = False, call_class: str = "lesson") -> str:
+    # cache=True: 같은 입력이면 공유 캐시의 이전 응답 재사용(레플리카 간 공유, 모델 단계와 무관)
+    key = single_flight_key("chat", call_class, temperature, json_mode, json.dumps(messages, ensure_ascii=False))
+
+    def call():
+        if cache:
+            hit = get_shared_cache().get("completion", key)
+            if hit:
+                return hit.decode("utf-8")
+        model = choose_text_model(call_class)
+        kwargs = {"model": model, "messages": messages, "temperature": temperature}
+        if json_mode:
+            kwargs["response_format"] = {"type": "json_object"}
+        if not acquire_rate_slot(model, priority):
+            raise TimeoutError("rate queue timeout")
+        t0 = time.monotonic()
+        resp = client.chat.completions.create(**kwargs)
+        record_text_usage(call_class, model, getattr(resp, "usage", None), time.monotonic() - t0)
+        content = (resp.choices[0].message.content or "").strip()
+        if cache and content:
+            get_shared_cache().set("completion", key, content.encode("utf-8"), COMPLETION_CACHE_TTL_S)
+        return content
+
+    return single_flight(key, call)
+
+def embed_texts(texts, model: str = EMBED_MODEL, priority: int = PRIORITY_STUDENT, dimensions: int = None) -> list:
+    def call():
+        if not acquire_rate_slot(model, priority):
+            raise TimeoutError("rate queue timeout")
+        kwargs = {"model": model, "input": texts}
+        if dimensions:
+            kwargs["dimensions"] = int(dimensions)
+        resp = client.embeddings.create(**kwargs)
+        return [d.embedding for d in resp.data]
+
+    key = single_flight_key("embed", model, dimensions or "", json.dumps(texts, ensure_ascii=False))
+    return single_flight(key, call)
+
+def ask_gpt_json_object(prompt: str, system_prompt: str = SYSTEM_PERSONA, priority: int = PRIORITY_STUDENT, cache: bool = False, call_class: str = "lesson") -> dict:
     try:
-        resp = client.chat.completions.create(
-            model=TEXT_MODEL,
-            messages=[
+        raw = _chat_completion_content(
+            [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt},
             ],
-            response_format={"type": "json_object"},
             temperature=0.5,
+            json_mode=True,
+            priority=priority,
+            cache=cache,
+            call_class=call_class,
         )
-        raw = (resp.choices[0].message.content or "").strip()
         data = safe_json_load(raw)
         return data if isinstance(data, dict) else {}
     except Exception:
         return {}
 
-def ask_gpt_text(prompt: str, system_prompt: str = SYSTEM_PERSONA) -> str:
+def ask_json_validated(prompt: str, validator, shape: str, system_prompt: str = SYSTEM_JSON_DESIGNER, priority: int = PRIORITY_STUDENT, cache: bool = False, call_class: str = "lesson", reask: bool = True):
+    # 검증 실패 시 전체 재생성 대신 실패한 최상위 키만 1회 재요청. (정리된 dict, 남은 오류) 반환
+    # reask=False(학생 경로): 재요청 없이 spec 기본값으로 채운 결과와 오류 목록을 그대로 반환
+    raw = ask_gpt_json_object(prompt, system_prompt=system_prompt, priority=priority, cache=cache, call_class=call_class)
+    if not raw:
+        _bump_json_stat("fallback", shape)
+        data, _ = validator({})
+        return data, ["_empty"]
+
+    data, errors = validator(raw)
+    if errors and reask:
+        _bump_json_stat("reask")
+        spec = validator.spec
+        fields = "\n".join(f"- {k}: {spec[k].get('desc', spec[k].get('type', ''))}" for k in errors)
+        kept = {k: v for k, v in raw.items() if k not in errors}
+        fix_prompt = f"""{prompt}
+
+[이미 받은 JSON(그대로 둠)]
+{_clip(json.dumps(kept, ensure_ascii=False), 3000)}
+
+위 JSON에서 빠졌거나 형식이 틀린 키만 다시 만든다.
+반드시 JSON만 출력하고, 아래 키만 포함:
+{fields}
+"""
+        patch = ask_gpt_json_object(fix_prompt, system_prompt=system_prompt, priority=priority, call_class=call_class)
+        merged = dict(raw)
+        merged.update({k: patch[k] for k in errors if k in patch})
+        data, errors = validator(merged)
+        if not errors:
+            _bump_json_stat("reask_fixed")
+    if errors:
+        _bump_json_stat("fallback", shape)
+    return data, errors
+
+def ask_gpt_text(prompt: str, system_prompt: str = SYSTEM_PERSONA, priority: int = PRIORITY_STUDENT, context_prefix: str = "", cache: bool = False, call_class: str = "lesson") -> str:
+    # context_prefix: 매번 같은 앞부분(상황/발췌/기준)을 별도 메시지로 먼저 보냄
+    messages = [{"role": "system", "content": system_prompt}]
+    if context_prefix:
+        messages.append({"role": "user", "content": context_prefix})
+    messages.append({"role": "user", "content": prompt})
     try:
-        resp = client.chat.completions.create(
-            model=TEXT_MODEL,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt},
-            ],
-            temperature=0.6,
-        )
-        return (resp.choices[0].message.content or "").strip()
+        return _chat_completion_content(messages, temperature=0.6, priority=priority, cache=cache, call_class=call_class)
     except Exception:
         return ""
 
 def normalize_analysis(x):
-    if isinstance(x, dict):
-        return {
-            "ethics_standards": x.get("ethics_standards", []) if isinstance(x.get("ethics_standards", []), list) else [],
-            "curriculum_alignment": x.get("curriculum_alignment", []) if isinstance(x.get("curriculum_alignment", []), list) else [],
-            "lesson_content": x.get("lesson_content", []) if isinstance(x.get("lesson_content", []), list) else [],
-        }
-    return {"ethics_standards": [], "curriculum_alignment": [], "lesson_content": []}
+    return validate_analysis(x)[0]
 
 def render_bullets(items):
     if not items:
@@ -191,17 +958,37 @@ def render_analysis_box(a):
         render_bullets(a.get("lesson_content", []))
 
 # ---- Story line rendering (한줄에 하나씩) ----
+_WS_RE = re.compile(r"\s+")
+# 문장부호(. ! ? …) 뒤, 또는 문장부호+닫는 따옴표/괄호(다.” / 요!’ / 요.)) 뒤의 공백에서 분리
+# 단, 닫는 따옴표 뒤에 "라고/하고/는" 같은 조사가 이어지면 인용문이 문장 안에 있는 것이라 나누지 않음
+_QUOTE_TAIL_PARTICLES = "이라고|라고|이라며|라며|이라는|라는|하고|하며|하면서|하는|고|며|는|은|을|를|와|과|도|처럼"
+_SENTENCE_SPLIT_RE = re.compile(
+    rf"(?<=[.!?…])\s+|(?<=[.!?…][”\"’')])\s+(?!(?:{_QUOTE_TAIL_PARTICLES})(?![가-힣]))"
+)
+STORY_MAX_LINES = 60
+
 def split_to_lines(text: str, max_lines: int = 50) -> list:
     t = (text or "").strip()
     if not t:
         return []
-    t = re.sub(r"\s+", " ", t)
-    parts = re.split(r"(?<=[.!?])\s+|(?<=다\.)\s+|(?<=요\.)\s+|(?<=다\?)\s+|(?<=요\?)\s+", t)
-    lines = [p.strip() for p in parts if p and p.strip()]
+    t = _WS_RE.sub(" ", t)
+    lines = [p.strip() for p in _SENTENCE_SPLIT_RE.split(t) if p and p.strip()]
     return lines[:max_lines]
 
-def render_story_box(text: str):
-    lines = split_to_lines(text, max_lines=60)
+def with_story_lines(item: dict, fields=("story", "debrief")) -> dict:
+    # 수업 생성/불러오기 때 1번만 문장 분리해 *_lines 로 저장(이미 있으면 그대로)
+    if not isinstance(item, dict):
+        return item
+    out = dict(item)
+    for f in fields:
+        if out.get(f) and f"{f}_lines" not in out:
+            out[f"{f}_lines"] = split_to_lines(out[f], max_lines=STORY_MAX_LINES)
+    return out
+
+def render_story_box(text: str, lines: list = None):
+    # lines가 있으면(미리 분리됨) 재실행 때 텍스트 처리 없음
+    if lines is None:
+        lines = split_to_lines(text, max_lines=STORY_MAX_LINES)
     if not lines:
         return
     with st.container(border=True):
@@ -210,33 +997,240 @@ def render_story_box(text: str):
 # =========================================================
 # 8) Image generation (bytes) - cached
 # =========================================================
-@st.cache_data(show_spinner=False)
-def generate_image_bytes_cached(user_prompt: str, model: str):
-    full_prompt = f"{NO_TEXT_IMAGE_PREFIX}{user_prompt}"
-    # 1) b64_json
+def image_key(user_prompt: str, model: str) -> str:
+    return hashlib.sha256(f"{model}\n{NO_TEXT_IMAGE_PREFIX}{user_prompt}".encode("utf-8")).hexdigest()[:32]
+
+def save_original_image(key: str, img_bytes: bytes, share: bool = True) -> str:
+    # 원본은 디스크 저장소가 기준. 공유 캐시는 다른 레플리카용 사본(기간/용량 제한), 새로 만든 원본만 올림
     try:
-        r = client.images.generate(
-            model=model,
-            prompt=full_prompt,
-            size="1024x1024",
-            n=1,
-            response_format="b64_json",
-        )
-        b64 = getattr(r.data[0], "b64_json", None)
-        if b64:
-            return base64.b64decode(b64)
+        IMAGE_STORE_DIR.mkdir(parents=True, exist_ok=True)
+        p = IMAGE_STORE_DIR / f"{key}.png"
+        if not p.exists():
+            tmp = p.with_suffix(".tmp")
+            tmp.write_bytes(img_bytes)
+            tmp.replace(p)
+        if share:
+            get_shared_cache().set("image", key, img_bytes, SHARED_IMAGE_TTL_S)
+        return str(p)
+    except Exception:
+        return ""
+
+# ---- Asset refs: 세션에는 경로만, 바이트는 디스크(ASSET_DIR)에 ----
+ASSET_DIR = IMAGE_STORE_DIR / "assets"
+
+def _asset_suffix(data: bytes) -> str:
+    if data[:4] == b"RIFF":
+        return ".webp"
+    if data[:2] == b"\xff\xd8":
+        return ".jpg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return ".png"
+    return ".bin"
+
+def put_asset(data: bytes, suffix: str = "", share: bool = True) -> str:
+    # share=False: 공유 캐시에서 받아 온 것을 디스크에만 다시 둘 때(공유 캐시에 되쓰지 않음)
+    p = ASSET_DIR / f"{hashlib.sha256(data).hexdigest()[:32]}{suffix or _asset_suffix(data)}"
+    try:
+        if not p.exists():
+            ASSET_DIR.mkdir(parents=True, exist_ok=True)
+            tmp = p.with_suffix(".tmp")
+            tmp.write_bytes(data)
+            tmp.replace(p)
+            if share:
+                get_shared_cache().set("asset", p.name, data, SHARED_ASSET_TTL_S)
+        return str(p)
+    except Exception:
+        return ""
+
+def load_asset(ref):
+    # ref: put_asset 경로. (예전 세션의 bytes도 그대로 허용)
+    if isinstance(ref, (bytes, bytearray)):
+        return bytes(ref)
+    if not ref:
+        return None
+    p = Path(ref)
+    try:
+        if p.exists():
+            return p.read_bytes()
     except Exception:
         pass
+    data = get_shared_cache().get("asset", p.name)
+    if data:
+        put_asset(data, p.suffix, share=False)
+    return data
+
+def image_ref(img_bytes):
+    if not img_bytes:
+        return None
+    return put_asset(img_bytes) or img_bytes
+
+def put_array_asset(arr: np.ndarray) -> str:
+    buf = io.BytesIO()
+    np.save(buf, arr, allow_pickle=False)
+    return put_asset(buf.getvalue(), ".npy")
 
-    # 2) url fallback
+@st.cache_data(show_spinner=False, max_entries=16)
+def load_array_asset(ref: str):
+    data = load_asset(ref)
+    return np.load(io.BytesIO(data), allow_pickle=False) if data else None
+
+def load_original_image(key: str):
+    p = IMAGE_STORE_DIR / f"{key}.png"
+    try:
+        if p.exists():
+            return p.read_bytes()
+    except Exception:
+        pass
+    # 다른 레플리카가 만든 원본
+    data = get_shared_cache().get("image", key)
+    if data:
+        save_original_image(key, data, share=False)
+    return data
+
+def make_thumbnail(img_bytes: bytes, max_px: int = THUMB_MAX_PX, quality: int = THUMB_QUALITY) -> bytes:
+    if not img_bytes or Image is None:
+        return img_bytes
     try:
-        r = client.images.generate(model=model, prompt=full_prompt, size="1024x1024", n=1)
-        url = getattr(r.data[0], "url", None)
-        if not url:
+        im = Image.open(io.BytesIO(img_bytes))
+        im = im.convert("RGB")
+        im.thumbnail((max_px, max_px), Image.LANCZOS)
+        for fmt in [THUMB_FORMAT, "JPEG"]:
+            try:
+                out = io.BytesIO()
+                im.save(out, format=fmt, quality=quality, optimize=True)
+                return out.getvalue()
+            except Exception:
+                continue
+    except Exception:
+        pass
+    return img_bytes
+
+# ---- Image fetch engine (오류 분류 + 재시도 + 경로 기록) ----
+RETRYABLE_ERRORS = {"rate_limit", "server", "connection"}
+
+def classify_api_error(e: Exception) -> str:
+    # timeout은 서버에서 이미 생성(과금)됐을 수 있으므로 재시도하지 않음
+    if isinstance(e, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(e, openai.APIConnectionError):
+        return "connection"
+    if isinstance(e, openai.RateLimitError):
+        return "rate_limit"
+    if isinstance(e, openai.InternalServerError):
+        return "server"
+    if isinstance(e, openai.BadRequestError):
+        return "policy" if "content_policy" in str(getattr(e, "code", "") or e) else "bad_request"
+    if isinstance(e, (openai.AuthenticationError, openai.PermissionDeniedError)):
+        return "auth"
+    if isinstance(e, requests.Timeout):
+        return "timeout"
+    if isinstance(e, requests.RequestException):
+        return "connection"
+    return "unknown"
+
+def _retry_after_s(e: Exception, attempt: int) -> float:
+    try:
+        ra = float(e.response.headers.get("retry-after"))
+        if ra > 0:
+            return min(ra, 30.0)
+    except Exception:
+        pass
+    return IMAGE_BACKOFF_S * (2 ** attempt)
+
+@st.cache_resource(show_spinner=False)
+def get_http_session() -> requests.Session:
+    # URL 다운로드용 커넥션 풀(프로세스 공유)
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    sess = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=retry)
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
+    return sess
+
+@st.cache_resource(show_spinner=False)
+def get_image_fetch_stats() -> dict:
+    # path: b64 / url / disk, error: 분류별 횟수
+    return {"path": {}, "error": {}, "retries": 0}
+
+def _count(bucket: dict, key: str):
+    bucket[key] = bucket.get(key, 0) + 1
+
+def _fetch_image_bytes(user_prompt: str, model: str, priority: int = PRIORITY_STUDENT):
+    full_prompt = f"{NO_TEXT_IMAGE_PREFIX}{user_prompt}"
+    stats = get_image_fetch_stats()
+    # SDK 내부 재시도(타임아웃 포함)를 끄고 여기서만 재시도 판단
+    img_client = client.with_options(max_retries=0, timeout=IMAGE_TIMEOUT_S)
+
+    r = None
+    for attempt in range(IMAGE_MAX_ATTEMPTS):
+        if not acquire_rate_slot(model, priority):
+            _count(stats["error"], "queue_timeout")
             return None
-        resp = requests.get(url, timeout=25)
+        try:
+            r = img_client.images.generate(
+                model=model,
+                prompt=full_prompt,
+                size=IMAGE_SIZE,
+                n=1,
+                response_format="b64_json",
+            )
+            break
+        except Exception as e:
+            kind = classify_api_error(e)
+            _count(stats["error"], kind)
+            if kind not in RETRYABLE_ERRORS or attempt == IMAGE_MAX_ATTEMPTS - 1:
+                return None
+            stats["retries"] += 1
+            time.sleep(_retry_after_s(e, attempt))
+
+    if r is None or not getattr(r, "data", None):
+        return None
+
+    # 1) b64_json
+    b64 = getattr(r.data[0], "b64_json", None)
+    if b64:
+        _count(stats["path"], "b64")
+        return base64.b64decode(b64)
+
+    # 2) 같은 응답의 url만 다운로드(재생성 없음)
+    url = getattr(r.data[0], "url", None)
+    if not url:
+        return None
+    try:
+        resp = get_http_session().get(url, timeout=IMAGE_DOWNLOAD_TIMEOUT_S)
         resp.raise_for_status()
+        _count(stats["path"], "url")
         return resp.content
+    except Exception as e:
+        _count(stats["error"], classify_api_error(e))
+        return None
+
+@st.cache_data(show_spinner=False)
+def generate_image_bytes_cached(user_prompt: str, model: str, _priority: int = PRIORITY_STUDENT):
+    # 반환값은 표시용 썸네일. 원본은 IMAGE_STORE_DIR에만 저장.
+    # _priority는 캐시 키에서 제외(밑줄 인자)
+    key = image_key(user_prompt, model)
+    raw = load_original_image(key)
+    if raw is not None:
+        _count(get_image_fetch_stats()["path"], "disk")
+    else:
+        def fetch_and_store():
+            b = _fetch_image_bytes(user_prompt, model, _priority)
+            if b:
+                save_original_image(key, b)
+            return b
+
+        raw = single_flight("img:" + key, fetch_and_store)
+        if not raw:
+            raise RuntimeError("image generation failed")  # 실패(대기 초과/429 등)는 캐시하지 않음
+    return make_thumbnail(raw)
+
+def image_ref_or_none(user_prompt: str, model: str, priority: int = PRIORITY_STUDENT):
+    # 화면용: 생성 실패면 None(세션에 넣지 않아 다음 실행에서 다시 시도)
+    try:
+        return image_ref(generate_image_bytes_cached(user_prompt, model, _priority=priority))
     except Exception:
         return None
 
@@ -261,53 +1255,65 @@ def clear_story_prompt_assets():
 def sha256_text(s: str) -> str:
     return hashlib.sha256((s or "").encode("utf-8")).hexdigest()
 
+# ---- Streaming chunker: 파일 핸들/줄 단위 입력, 문장 경계 유지, max_chars 엄수 ----
+def chunk_id(text: str) -> str:
+    # 내용 기반 ID: 내용이 같으면 파일이 바뀌어도 같은 ID(증분 비교용)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+def _iter_text_units(lines, max_chars: int):
+    # (앞 구분자, 문장) 단위로 내보냄. 구분자: 같은 줄 " ", 줄바꿈 "\n", 문단 "\n\n", 강제 분할 ""
+    para_break = False
+    for raw in lines:
+        line = raw.rstrip("\r\n").rstrip()
+        if not line.strip():
+            para_break = True
+            continue
+        for i, sent in enumerate(s for s in _SENTENCE_SPLIT_RE.split(line) if s):
+            sep = " " if i > 0 else ("\n\n" if para_break else "\n")
+            para_break = False
+            while len(sent) > max_chars:
+                yield sep, sent[:max_chars]
+                sent, sep = sent[max_chars:], ""
+            yield sep, sent
+
+def _join_units(units: list) -> str:
+    return "".join((sep if i else "") + u for i, (sep, u) in enumerate(units))
+
+def iter_chunks(lines, max_chars: int = 900, overlap: int = 160):
+    # 각 청크는 {"id", "text"}; len(text) <= max_chars 보장.
+    # overlap: 앞 청크 끝의 '완결된 문장'들(합계 overlap 이하)만 다음 청크 앞에 반복
+    buf, size = [], 0
+    for sep, unit in _iter_text_units(lines, max_chars):
+        if buf and size + len(sep) + len(unit) > max_chars:
+            text = _join_units(buf).strip()
+            if text:
+                yield {"id": chunk_id(text), "text": text}
+            tail, tail_size = [], 0
+            for s_, u_ in reversed(buf[1:]):  # 앞 청크 전체가 반복되지 않도록 첫 단위 제외
+                if tail_size + len(s_) + len(u_) > overlap:
+                    break
+                tail.insert(0, (s_, u_))
+                tail_size += len(s_) + len(u_)
+            buf = tail
+            size = len(_join_units(buf))
+            while buf and size + len(sep) + len(unit) > max_chars:
+                buf.pop(0)
+                size = len(_join_units(buf))
+        size += (len(sep) if buf else 0) + len(unit)
+        buf.append((sep, unit))
+    text = _join_units(buf).strip()
+    if text:
+        yield {"id": chunk_id(text), "text": text}
+
+def iter_file_chunks(path_str: str, max_chars: int = 900, overlap: int = 160):
+    with open(path_str, encoding="utf-8", errors="ignore") as f:
+        yield from iter_chunks(f, max_chars=max_chars, overlap=overlap)
+
 def chunk_text(text: str, max_chars: int = 900, overlap: int = 160):
     text = (text or "").replace("\r\n", "\n").strip()
     if not text:
         return []
-
-    # split on blank lines
-    parts, buf = [], []
-    for line in text.split("\n"):
-        if line.strip() == "":
-            if buf:
-                parts.append("\n".join(buf).strip())
-                buf = []
-        else:
-            buf.append(line)
-    if buf:
-        parts.append("\n".join(buf).strip())
-
-    # pack
-    chunks, cur = [], ""
-    for p in parts:
-        if len(cur) + len(p) + 2 <= max_chars:
-            cur = (cur + "\n\n" + p).strip() if cur else p
-        else:
-            if cur:
-                chunks.append(cur)
-            if len(p) > max_chars:
-                start = 0
-                while start < len(p):
-                    end = min(len(p), start + max_chars)
-                    chunks.append(p[start:end])
-                    start = max(0, end - overlap)
-                cur = ""
-            else:
-                cur = p
-    if cur:
-        chunks.append(cur)
-
-    # overlap merge
-    final = []
-    for i, c in enumerate(chunks):
-        if i == 0:
-            final.append(c)
-        else:
-            tail = chunks[i - 1][-overlap:] if overlap > 0 else ""
-            final.append((tail + "\n" + c).strip() if tail else c)
-
-    return [x.strip() for x in final if x.strip()]
+    return [c["text"] for c in iter_chunks(text.split("\n"), max_chars=max_chars, overlap=overlap)]
 
 @st.cache_data(show_spinner=False)
 def load_reference_text_cached(path_str: str, mtime: float) -> str:
@@ -317,42 +1323,333 @@ def load_reference_text_cached(path_str: str, mtime: float) -> str:
     txt = p.read_text(encoding="utf-8", errors="ignore")
     return txt[:1_200_000]  # safety cap
 
-@st.cache_data(show_spinner=False)
-def build_rag_index_cached(path_str: str, embed_model: str, mtime: float):
-    txt = load_reference_text_cached(path_str, mtime)
+def _pack_rag_index(index: dict) -> bytes:
+    buf = io.BytesIO()
+    scale = index.get("scale")
+    np.savez(
+        buf,
+        emb=index["emb"],
+        scale=scale if scale is not None else np.zeros(0, dtype=np.float32),
+        meta=np.array(json.dumps(
+            {
+                "chunks": index["chunks"],
+                "ids": index.get("ids", []),
+                "content_hash": index["content_hash"],
+                "storage": index.get("storage", "float32"),
+                "dims": index.get("dims"),
+                "full_dims": index.get("full_dims"),
+                "recall": index.get("recall"),
+            },
+            ensure_ascii=False,
+        )),
+    )
+    return buf.getvalue()
+
+def _unpack_rag_index(data: bytes):
+    if not data:
+        return None
+    try:
+        z = np.load(io.BytesIO(data), allow_pickle=False)
+        meta = json.loads(str(z["meta"]))
+        if "scale" not in z.files:
+            return None  # 이전(float32+norms) 형식은 다시 빌드
+        return {
+            "chunks": meta["chunks"],
+            "ids": meta.get("ids") or [chunk_id(c) for c in meta["chunks"]],
+            "emb": z["emb"],
+            "scale": z["scale"] if z["scale"].size else None,
+            "storage": meta.get("storage", "float32"),
+            "dims": meta.get("dims"),
+            "full_dims": meta.get("full_dims"),
+            "recall": meta.get("recall"),
+            "content_hash": meta["content_hash"],
+        }
+    except Exception:
+        return None
+
+# ---- Compact embeddings: 단위 정규화 + float16/int8(행별 scale) 양자화 ----
+def _unit_rows(emb):
+    emb = np.asarray(emb, dtype=np.float32)
+    return emb / (np.linalg.norm(emb, axis=-1, keepdims=True) + 1e-8)
+
+def quantize_embeddings(emb, storage: str = EMBED_STORAGE):
+    # (양자화 배열, 행별 scale 또는 None). int8은 행마다 max|x|/127 로 스케일
+    unit = _unit_rows(emb)
+    if storage == "int8":
+        scale = (np.abs(unit).max(axis=-1) / 127.0 + 1e-12).astype(np.float32)
+        q = np.clip(np.rint(unit / scale[..., None]), -127, 127).astype(np.int8)
+        return q, scale
+    if storage == "float16":
+        return unit.astype(np.float16), None
+    return unit, None
+
+def quantized_scores(emb, scale, qv, storage: str = EMBED_STORAGE, block: int = 4096):
+    # 코사인 유사도 근사. int8은 질의도 int8로 양자화해 정수 내적 후 scale 곱
+    if storage == "int8":
+        q8, qs = quantize_embeddings(qv[None, :], "int8")
+        q32 = q8[0].astype(np.int32)
+        out = np.empty(len(emb), dtype=np.float32)
+        for s in range(0, len(emb), block):
+            out[s:s + block] = (emb[s:s + block] @ q32) * scale[s:s + block] * qs[0]
+        return out
+    return (emb @ _unit_rows(qv).astype(emb.dtype)).astype(np.float32)
+
+def embedding_recall(corpus_full, queries_full, emb, scale, storage: str, k: int = RAG_TOP_K) -> float:
+    # 전체 차원 float32 top-k 대비 (축소 차원 + 양자화) top-k 재현율
+    # corpus_full[i] 는 emb[i] 와 같은 청크, 질의는 색인 밖 문장. 축소 질의 = 앞 d차원 잘라 재정규화
+    n = len(corpus_full)
+    if n <= 1 or not len(queries_full):
+        return 1.0
+    k = min(k, n)
+    unit = _unit_rows(corpus_full)
+    d = emb.shape[1]
+    hits = 0
+    for qv in _unit_rows(queries_full):
+        base = set(np.argsort(-(unit @ qv))[:k].tolist())
+        approx = set(np.argsort(-quantized_scores(emb, scale, _unit_rows(qv[:d]), storage))[:k].tolist())
+        hits += len(base & approx)
+    return round(hits / (k * len(queries_full)), 4)
+
+def _recall_queries() -> list:
+    return ([rag_query_for_step("저작권", c["story"]) for c in FIXED_STORY_CHAPTERS]
+            + [rag_query_for_step(t, "") for t in RAG_RECALL_TOPICS])
+
+def measure_index_recall(chunks: list, emb, scale, storage: str, model: str = EMBED_MODEL):
+    # 표본 청크 + 질의를 전체 차원으로 한 번 더 임베딩(빌드당 1~2회 호출). (재현율, 전체 차원) 또는 (None, None)
+    pick = np.unique(np.linspace(0, len(chunks) - 1, min(RAG_RECALL_SAMPLE, len(chunks))).astype(int))
+    texts = [_clip_for_embedding(chunks[i]) for i in pick] + _recall_queries()
+    try:
+        vecs = [None] * len(texts)
+        for batch in split_embedding_batches(list(enumerate(texts))):
+            out = embed_texts([t for _, t in batch], model=model, priority=PRIORITY_WARM)
+            for (i, _), v in zip(batch, out):
+                vecs[i] = v
+        full = np.array(vecs, dtype=np.float32)
+    except Exception:
+        return None, None
+    sub_scale = scale[pick] if scale is not None else None
+    return embedding_recall(full[:len(pick)], full[len(pick):], emb[pick], sub_scale, storage), int(full.shape[1])
+
+def rag_storage_report(index: dict) -> dict:
+    if not index or index.get("emb") is None:
+        return {}
+    emb, scale = index["emb"], index.get("scale")
+    n, d = emb.shape
+    return {
+        "storage": index.get("storage", "float32"),
+        "dims": d,
+        "chunks": n,
+        "bytes": int(emb.nbytes + (scale.nbytes if scale is not None else 0)),
+        "float32_full_bytes": int(n * (index.get("full_dims") or EMBED_FULL_DIMS.get(EMBED_MODEL, d)) * 4),
+        "recall_at_k": index.get("recall"),
+    }
+
+# ---- Embedding pipeline: 배치 분할 + 병렬 + 재시도 + 청크별 체크포인트 ----
+EMBED_BATCH_MAX_ITEMS = 128
+EMBED_BATCH_MAX_TOKENS = 100_000   # 요청당 입력 토큰 상한(추정치 기준, 여유 있게)
+EMBED_INPUT_MAX_TOKENS = 8_000     # 입력 1개 상한
+EMBED_PARALLEL = 4
+EMBED_MAX_ATTEMPTS = 4
+EMBED_RETRYABLE = RETRYABLE_ERRORS | {"timeout"}  # 임베딩은 멱등이라 timeout도 재시도
+
+def estimate_tokens(text: str) -> int:
+    # tiktoken 없이 보수적으로: 한글 ~1토큰/글자(3바이트), 영문은 과대추정
+    return len((text or "").encode("utf-8")) // 3 + 1
+
+def _clip_for_embedding(text: str) -> str:
+    while estimate_tokens(text) > EMBED_INPUT_MAX_TOKENS:
+        text = text[: int(len(text) * 0.9)]
+    return text
+
+def split_embedding_batches(items: list) -> list:
+    # items: [(index, text)] → 항목 수/토큰 상한을 지키는 배치 목록
+    batches, cur, cur_tokens = [], [], 0
+    for i, text in items:
+        t = estimate_tokens(text)
+        if cur and (len(cur) >= EMBED_BATCH_MAX_ITEMS or cur_tokens + t > EMBED_BATCH_MAX_TOKENS):
+            batches.append(cur)
+            cur, cur_tokens = [], 0
+        cur.append((i, text))
+        cur_tokens += t
+    if cur:
+        batches.append(cur)
+    return batches
+
+def _embedding_ckpt_key(model: str, cid: str) -> str:
+    return f"{model}@{EMBED_DIMENSIONS}:{cid}"
+
+def load_embedding_checkpoint(model: str, cid: str):
+    data = get_shared_cache().get("embedding", _embedding_ckpt_key(model, cid))
+    return np.frombuffer(data, dtype=np.float32) if data else None
+
+@st.cache_resource(show_spinner=False)
+def get_embed_progress() -> dict:
+    return {"total": 0, "done": 0, "failed_batches": 0, "running": False}
+
+def _embed_batch_with_retry(batch: list, ids: list, model: str, priority: int) -> dict:
+    texts = [_clip_for_embedding(t) for _, t in batch]
+    for attempt in range(EMBED_MAX_ATTEMPTS):
+        try:
+            vecs = embed_texts(texts, model=model, priority=priority, dimensions=EMBED_DIMENSIONS)
+            out = {}
+            for (i, _), v in zip(batch, vecs):
+                arr = np.asarray(v, dtype=np.float32)
+                get_shared_cache().set("embedding", _embedding_ckpt_key(model, ids[i]), arr.tobytes())
+                out[i] = arr
+            return out
+        except Exception as e:
+            if classify_api_error(e) not in EMBED_RETRYABLE or attempt == EMBED_MAX_ATTEMPTS - 1:
+                return {}
+            time.sleep(_retry_after_s(e, attempt))
+    return {}
+
+def embed_chunks_resumable(ids: list, texts: list, model: str = EMBED_MODEL, priority: int = PRIORITY_WARM) -> list:
+    # 체크포인트에 있는 청크는 건너뛰고 나머지만 병렬 배치로 임베딩. 실패한 청크는 None.
+    vecs = [load_embedding_checkpoint(model, cid) for cid in ids]
+    todo = [(i, texts[i]) for i, v in enumerate(vecs) if v is None]
+    progress = get_embed_progress()
+    progress.update({"total": len(ids), "done": len(ids) - len(todo), "failed_batches": 0, "running": bool(todo)})
+    if not todo:
+        return vecs
+
+    with ThreadPoolExecutor(max_workers=EMBED_PARALLEL, thread_name_prefix="embed") as pool:
+        futures = [pool.submit(_embed_batch_with_retry, b, ids, model, priority) for b in split_embedding_batches(todo)]
+        for fut in futures:
+            got = fut.result()
+            if not got:
+                progress["failed_batches"] += 1
+            for i, v in got.items():
+                vecs[i] = v
+            progress["done"] += len(got)
+    progress["running"] = False
+    return vecs
+
+RAG_PARTIAL_RETRY_S = 300  # 일부 임베딩 실패 시 이 시간 뒤 재시도(완료분은 체크포인트 재사용)
+RAG_WATCH_INTERVAL_S = 5
+
+def build_rag_index(txt: str, embed_model: str = EMBED_MODEL, storage: str = EMBED_STORAGE) -> dict:
     if not txt.strip():
-        return {"chunks": [], "emb": None, "norms": None, "content_hash": ""}
+        return {"chunks": [], "emb": None, "scale": None, "content_hash": ""}
 
-    chunks = chunk_text(txt, max_chars=900, overlap=160)
+    items = list(iter_chunks(txt.replace("\r\n", "\n").split("\n"), max_chars=900, overlap=160))
+    chunks = [c["text"] for c in items]
+    ids = [c["id"] for c in items]
     if not chunks:
-        return {"chunks": [], "emb": None, "norms": None, "content_hash": sha256_text(txt)}
+        return {"chunks": [], "emb": None, "scale": None, "content_hash": sha256_text(txt)}
+
+    shared_key = f"{embed_model}@{EMBED_DIMENSIONS}:{storage}:{sha256_text(txt)}"
+    shared = _unpack_rag_index(get_shared_cache().get("rag_index", shared_key))
+    if shared:
+        return shared
 
     try:
-        resp = client.embeddings.create(model=embed_model, input=chunks)
-        vecs = [d.embedding for d in resp.data]
-        emb = np.array(vecs, dtype=np.float32)
-        norms = np.linalg.norm(emb, axis=1) + 1e-8
-        return {"chunks": chunks, "emb": emb, "norms": norms, "content_hash": sha256_text(txt)}
+        vecs = embed_chunks_resumable(ids, chunks, model=embed_model, priority=PRIORITY_WARM)
+        keep = [i for i, v in enumerate(vecs) if v is not None]
+        if not keep:
+            return {"chunks": chunks, "ids": ids, "emb": None, "scale": None, "content_hash": sha256_text(txt),
+                    "partial": True, "built_at": time.time()}
+        full = np.stack([vecs[i] for i in keep]).astype(np.float32)
+        emb, scale = quantize_embeddings(full, storage)
+        recall, full_dims = measure_index_recall([chunks[i] for i in keep], emb, scale, storage, embed_model)
+        index = {
+            "chunks": [chunks[i] for i in keep],
+            "ids": [ids[i] for i in keep],
+            "emb": emb,
+            "scale": scale,
+            "storage": storage,
+            "dims": int(full.shape[1]),
+            "full_dims": full_dims,
+            "recall": recall,
+            "content_hash": sha256_text(txt),
+        }
+        if len(keep) < len(chunks):
+            # 일부만 성공: 있는 만큼으로 RAG 유지, 공유 캐시에는 저장하지 않음
+            index.update({"partial": True, "built_at": time.time()})
+        else:
+            get_shared_cache().set("rag_index", shared_key, _pack_rag_index(index))
+        return index
     except Exception:
-        return {"chunks": chunks, "emb": None, "norms": None, "content_hash": sha256_text(txt)}
-
-def get_rag_index():
+        return {"chunks": chunks, "ids": ids, "emb": None, "scale": None, "content_hash": sha256_text(txt),
+                "partial": True, "built_at": time.time()}
+
+# ---- Index holder: 백그라운드에서 새 색인을 만든 뒤 참조만 바꿔 끼움(요청 경로는 기다리지 않음) ----
+@st.cache_resource(show_spinner=False)
+def get_rag_holder() -> dict:
+    return {"lock": threading.Lock(), "index": None, "mtime": -1.0, "building": False,
+            "retry_at": 0.0, "swaps": 0, "swapped_at": None, "last_build_s": None}
+
+def _rag_needs_build(holder: dict, mtime) -> bool:
+    cur = holder["index"]
+    if time.time() < holder["retry_at"]:
+        return False
+    if mtime != holder["mtime"]:
+        return True
+    return bool(cur and cur.get("partial") and time.time() - cur.get("built_at", 0) > RAG_PARTIAL_RETRY_S)
+
+def refresh_rag_index(wait: bool = False):
+    # 파일이 바뀌었거나 부분 색인이면 호출 스레드에서 다시 빌드 후 교체. 다른 빌드가 진행 중이면 기존 색인 반환
+    holder = get_rag_holder()
     p = Path(REFERENCE_PATH)
-    if not p.exists():
-        return None
-    mtime = p.stat().st_mtime
-    return build_rag_index_cached(REFERENCE_PATH, EMBED_MODEL, mtime)
+    mtime = p.stat().st_mtime if p.exists() else None
+    with holder["lock"]:
+        busy = holder["building"]
+        if not busy and not _rag_needs_build(holder, mtime):
+            return holder["index"]
+        if not busy:
+            holder["building"] = True
+    if busy:
+        while wait and holder["building"]:
+            time.sleep(0.2)
+        return holder["index"]
+
+    try:
+        cur = holder["index"]
+        new = None
+        if mtime is not None:
+            txt = load_reference_text_cached(REFERENCE_PATH, mtime)
+            if cur and cur.get("content_hash") == sha256_text(txt) and not cur.get("partial"):
+                new = cur  # 내용은 그대로(mtime만 바뀜)
+            else:
+                t0 = time.monotonic()
+                new = build_rag_index(txt, EMBED_MODEL)
+                holder["last_build_s"] = round(time.monotonic() - t0, 2)
+        with holder["lock"]:
+            if new and new.get("chunks") and new.get("emb") is None and cur and cur.get("emb") is not None:
+                holder["retry_at"] = time.time() + RAG_PARTIAL_RETRY_S  # 빌드 실패: 이전 색인 유지
+            else:
+                if new is not cur:
+                    holder.update({"index": new, "swaps": holder["swaps"] + 1, "swapped_at": time.time()})
+                holder["mtime"] = mtime
+            return holder["index"]
+    finally:
+        holder["building"] = False
 
-def rag_retrieve(query: str, index: dict, top_k: int = RAG_TOP_K) -> str:
+def get_rag_index():
+    # 요청 경로: 현재 색인을 즉시 반환(첫 빌드 전이면 None → RAG 없이 진행)
+    return get_rag_holder()["index"]
+
+@st.cache_resource(show_spinner=False)
+def start_rag_watcher() -> threading.Thread:
+    def loop():
+        while True:
+            try:
+                refresh_rag_index()
+            except Exception:
+                pass
+            time.sleep(RAG_WATCH_INTERVAL_S)
+
+    t = threading.Thread(target=loop, name="rag-watcher", daemon=True)
+    t.start()
+    return t
+
+def rag_retrieve(query: str, index: dict, top_k: int = RAG_TOP_K, priority: int = PRIORITY_STUDENT) -> str:
     query = (query or "").strip()
     if not query or not index or not index.get("chunks") or index.get("emb") is None:
         return ""
     try:
-        q = client.embeddings.create(model=EMBED_MODEL, input=query).data[0].embedding
+        q = embed_texts([query], priority=priority, dimensions=index.get("dims") or EMBED_DIMENSIONS)[0]
         qv = np.array(q, dtype=np.float32)
-        qn = np.linalg.norm(qv) + 1e-8
-        emb, norms = index["emb"], index["norms"]
-        sims = (emb @ qv) / (norms * qn)
+        sims = quantized_scores(index["emb"], index.get("scale"), qv, index.get("storage", "float32"))
         k = max(1, min(int(top_k), len(index["chunks"])))
         top_idx = np.argsort(-sims)[:k].tolist()
         ctx = "\n\n---\n\n".join(index["chunks"][i].strip() for i in top_idx)
@@ -360,6 +1657,24 @@ def rag_retrieve(query: str, index: dict, top_k: int = RAG_TOP_K) -> str:
     except Exception:
         return ""
 
+@st.cache_data(show_spinner=False, max_entries=512)
+def _rag_retrieve_cached(query: str, content_hash: str, top_k: int, _index: dict, _priority: int = PRIORITY_STUDENT) -> str:
+    ctx = rag_retrieve(query, _index, top_k=top_k, priority=_priority)
+    if not ctx:
+        raise ValueError("empty rag context")  # 실패는 캐시하지 않음
+    return ctx
+
+def rag_retrieve_cached(query: str, index: dict, top_k: int = RAG_TOP_K, priority: int = PRIORITY_STUDENT) -> str:
+    if not index or not index.get("chunks"):
+        return ""
+    try:
+        return _rag_retrieve_cached(query, index.get("content_hash", ""), top_k, index, priority)
+    except Exception:
+        return ""
+
+def rag_query_for_step(topic: str, text: str) -> str:
+    return f"{topic} {text} 저작권 출처 허락 사례01 사례02 사례03 사례04 사례05 국가 인공지능 윤리기준 프라이버시 보호 연대성 데이터 관리 침해 금지 안전성"
+
 # =========================================================
 # 10) Lesson types / standards
 # =========================================================
@@ -369,6 +1684,13 @@ LESSON_DEEP_DEBATE = "심화 대화 토론형"
 
 NATIONAL_ETHICS_KEYS = ["프라이버시 보호", "연대성", "데이터 관리", "침해 금지", "안전성"]
 
+# 심화 토론: 후속 질문 수 / 미리 만든 질문 트리
+DEBATE_TURNS_DEFAULT = 3
+DEBATE_TURNS_MAX = 6
+DEBATE_ARG_TYPES = ["왜", "근거", "반대", "대안", "조건"]
+DEBATE_TREE_MAX_DEPTH = 2
+DEBATE_TREE_MIN_SIM = 0.55  # 이보다 가까운 가지가 없으면 LLM 호출
+
 def ensure_analysis_defaults(topic: str, analysis_obj) -> dict:
     a = normalize_analysis(analysis_obj if isinstance(analysis_obj, dict) else {})
     fixed = [x for x in a.get("ethics_standards", []) if x in NATIONAL_ETHICS_KEYS]
@@ -486,10 +1808,10 @@ steps[2] discussion: story, question
 - 법 단정 금지(약관/규정/상황 확인 필요)
 - 폭력/공포 배제
 """
-    data = ask_gpt_json_object(prompt, system_prompt=SYSTEM_JSON_DESIGNER)
+    data, errors = ask_json_validated(prompt, validate_image_lesson, "image_lesson", priority=PRIORITY_TEACHER)
 
-    steps = data.get("steps", [])
-    if not isinstance(steps, list) or len(steps) < 3:
+    steps = data["steps"]
+    if "steps" in errors or len(steps) < 3:
         steps = [
             {
                 "type": "image_revision",
@@ -518,15 +1840,20 @@ steps[2] discussion: story, question
             },
         ]
 
-    analysis = ensure_analysis_defaults(topic, data.get("analysis", {}))
+    analysis = ensure_analysis_defaults(topic, data["analysis"])
     return {
-        "topic": str(data.get("topic", topic)).strip() or topic,
+        "topic": data["topic"] or topic,
         "lesson_type": LESSON_IMAGE_PROMPT,
         "analysis": analysis,
-        "teacher_guide": str(data.get("teacher_guide", "")).strip(),
+        "teacher_guide": data["teacher_guide"],
         "steps": steps[:3],
     }
 
+@st.cache_resource(show_spinner=False)
+def fixed_story_chapters() -> list:
+    # 고정 스토리 문장 분리는 프로세스당 1번(웜업이 미리 채움)
+    return [with_story_lines(c) for c in FIXED_STORY_CHAPTERS]
+
 def generate_lesson_story_mode_fixed(topic: str) -> dict:
     # 고정 스토리(브러시)로 진행
     analysis = ensure_analysis_defaults("저작권", {})
@@ -552,11 +1879,12 @@ def generate_lesson_story_mode_fixed(topic: str) -> dict:
         "teacher_guide": teacher_guide,
         "story_title": FIXED_STORY_TITLE,
         "outline": outline,
-        "chapters": FIXED_STORY_CHAPTERS,
-        "first_chapter": FIXED_STORY_CHAPTERS[0],
+        "chapters": fixed_story_chapters(),
+        "first_chapter": fixed_story_chapters()[0],
     }
 
-def generate_lesson_deep_debate(topic: str, rag_ctx: str) -> dict:
+def generate_lesson_deep_debate(topic: str, rag_ctx: str, turns: int = DEBATE_TURNS_DEFAULT, tree_depth: int = 0) -> dict:
+    turns = clamp_debate_turns(turns)
     prompt = f"""
 교사용 설계 요청. (교사 관점)
 
@@ -574,7 +1902,7 @@ def generate_lesson_deep_debate(topic: str, rag_ctx: str) -> dict:
 - debate_step.case_title / case_summary에 반영.
 - A/B 선택지: debate_step.choice_a / choice_b.
 - opening_question은 "A/B 중 무엇을 선택하고, 왜 그렇게 생각하나요?" 포함.
-- turns는 3 고정.
+- turns는 {turns} 고정.
 
 반드시 JSON만 출력.
 키:
@@ -582,19 +1910,19 @@ def generate_lesson_deep_debate(topic: str, rag_ctx: str) -> dict:
 - lesson_type: "{LESSON_DEEP_DEBATE}"
 - analysis(ethics_standards/curriculum_alignment/lesson_content)
 - teacher_guide
-- debate_step: case_title, case_summary, story, choice_a, choice_b, opening_question, constraints, turns=3
+- debate_step: case_title, case_summary, story, choice_a, choice_b, opening_question, constraints, turns={turns}
 - closing_step: story, question
 
 규칙:
 - 폭력/공포 배제
 - 법 단정 금지(약관/규정/상황 확인 필요)
 """
-    data = ask_gpt_json_object(prompt, system_prompt=SYSTEM_JSON_DESIGNER)
+    data, errors = ask_json_validated(prompt, validate_debate_lesson, "debate_lesson", priority=PRIORITY_TEACHER)
 
-    debate = data.get("debate_step", {})
-    closing = data.get("closing_step", {})
+    debate = data["debate_step"]
+    closing = data["closing_step"]
 
-    if not isinstance(debate, dict) or not debate.get("story"):
+    if "debate_step" in errors or not debate.get("story"):
         debate = {
             "case_title": f"{topic} 관련 사례",
             "case_summary": f"'{topic}' 활동에서 공유/사용 과정에서 확인할 점이 생겼다.",
@@ -604,54 +1932,64 @@ def generate_lesson_deep_debate(topic: str, rag_ctx: str) -> dict:
             "choice_b": "보류(확인 전까지 멈추고 대안을 찾기)",
             "opening_question": "좋아, 네 생각이 궁금해.\nA/B 중 무엇을 선택하고, 왜 그렇게 생각하나요?",
             "constraints": ["근거 1개 이상", "반대 의견 1개", "대안 1개", "단정 금지", "약관/학교 규칙 확인 언급"],
-            "turns": 3,
+            "turns": turns,
         }
 
-    oq = str(debate.get("opening_question", "")).strip()
+    oq = debate.get("opening_question", "")
     if "A/B" not in oq or "왜" not in oq:
         oq = "좋아, 네 생각이 궁금해.\nA/B 중 무엇을 선택하고, 왜 그렇게 생각하나요?"
     if "\n" not in oq:
         oq = "좋아, 네 생각이 궁금해.\n" + oq
 
-    ca = str(debate.get("choice_a", "")).strip() or "A 선택(조건부 진행: 허락/출처/목적 확인)"
-    cb = str(debate.get("choice_b", "")).strip() or "B 선택(보류/대안 찾기)"
+    ca = debate.get("choice_a", "") or "A 선택(조건부 진행: 허락/출처/목적 확인)"
+    cb = debate.get("choice_b", "") or "B 선택(보류/대안 찾기)"
 
-    if not isinstance(closing, dict) or not closing.get("question"):
+    if "closing_step" in errors or not closing.get("question"):
         closing = {
             "story": "정리: 토론을 바탕으로 실행 가능한 규칙을 만든다.",
             "question": "우리 반 규칙 3줄(허락/출처/목적/공개범위 기준)",
         }
 
-    analysis = ensure_analysis_defaults(topic, data.get("analysis", {}))
+    analysis = ensure_analysis_defaults(topic, data["analysis"])
+    debate_step_story = debate.get("story", "")
 
     return {
-        "topic": str(data.get("topic", topic)).strip() or topic,
+        "topic": data["topic"] or topic,
         "lesson_type": LESSON_DEEP_DEBATE,
         "analysis": analysis,
-        "teacher_guide": str(data.get("teacher_guide", "")).strip(),
+        "teacher_guide": data["teacher_guide"],
         "debate_step": {
-            "case_title": str(debate.get("case_title", "")).strip(),
-            "case_summary": str(debate.get("case_summary", "")).strip(),
-            "story": str(debate.get("story", "")).strip(),
+            "case_title": debate.get("case_title", ""),
+            "case_summary": debate.get("case_summary", ""),
+            "story": debate_step_story,
             "choice_a": ca,
             "choice_b": cb,
             "opening_question": oq,
-            "constraints": debate.get("constraints", []) if isinstance(debate.get("constraints", []), list) else [],
-            "turns": 3,
+            "constraints": debate.get("constraints", []),
+            "turns": turns,
+            "question_tree": build_debate_question_tree(topic, debate_step_story, ca, cb, rag_ctx, tree_depth),
         },
         "closing_step": {
-            "story": str(closing.get("story", "")).strip(),
-            "question": str(closing.get("question", "")).strip(),
+            "story": closing.get("story", ""),
+            "question": closing.get("question", ""),
         },
     }
 
 # =========================================================
 # 13) Teacher feedback (칭찬 + 교사기준 반영 강제)
 # =========================================================
+_FEEDBACK_LOCAL = threading.local()  # 세션 밖(내보낸 수업의 피드백 API)에서 부를 때 교사 기준/임계값
+
 def get_teacher_feedback_context() -> str:
-    ctx = (st.session_state.get("teacher_feedback_context") or "").strip()
+    ctx = getattr(_FEEDBACK_LOCAL, "teacher_ctx", None)
+    if ctx is None:
+        ctx = st.session_state.get("teacher_feedback_context") or ""
+    ctx = ctx.strip()
     return _clip(ctx, 900) if ctx else ""
 
+FEEDBACK_BUSY_MSG = "지금 친구들의 요청이 많아서 피드백이 늦어지고 있어요.\n잠시 후 다시 제출해 주세요."
+FEEDBACK_BUDGET_MSG = "오늘 사용량을 모두 썼어요.\n피드백은 선생님과 함께 이야기해 보거나 내일 다시 받아 보세요."
+
 def _format_feedback(template: str, praise: str, risk: str, q: str, next_action: str) -> str:
     praise = praise.strip() or "-"
     risk = risk.strip() or "-"
@@ -662,8 +2000,334 @@ def _format_feedback(template: str, praise: str, risk: str, q: str, next_action:
         return f"핵심 판단: {praise}\n근거: {risk}\n확인 질문: {q}\n다음 행동: {next_action}"
     return f"잘한 점: {praise}\n위험 요소: {risk}\n확인 질문: {q}\n다음 행동: {next_action}"
 
+# ---- Local tag/template classifier (누적 피드백 로그로 학습) ----
+FEEDBACK_SAMPLES_PATH = Path(".feedback_log/feedback_samples.jsonl")
+FEEDBACK_CLF_MIN_SAMPLES = 40
+FEEDBACK_CLF_RETRAIN_EVERY = 20
+FEEDBACK_CLF_MAX_SAMPLES = 3000
+FEEDBACK_CLF_MIN_TAG_COUNT = 5
+FEEDBACK_CLF_MAX_LABELS = 30
+FEEDBACK_CLF_DIM = 2048
+FEEDBACK_CLF_TAG_THRESHOLD = 0.5
+FEEDBACK_CLF_TEMPLATE_MARGIN = 0.2  # |p(B) - 0.5| 이 이보다 작으면 LLM에 맡김
+
+@st.cache_resource(show_spinner=False)
+def get_feedback_samples_lock() -> threading.Lock:
+    return threading.Lock()
+
+def record_feedback_sample(answer_text: str, tags: list, template: str):
+    # LLM이 직접 고른 태그/템플릿만 학습 데이터로 저장(자기 예측 재학습 방지)
+    row = {"ts": now_str(), "answer": _clip(answer_text, 1200), "tags": tags, "template": template}
+    try:
+        with get_feedback_samples_lock():
+            FEEDBACK_SAMPLES_PATH.parent.mkdir(parents=True, exist_ok=True)
+            with FEEDBACK_SAMPLES_PATH.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    except Exception:
+        pass
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def count_feedback_samples_cached(path_str: str, mtime: float) -> int:
+    try:
+        with open(path_str, "rb") as f:
+            return sum(1 for _ in f)
+    except Exception:
+        return 0
+
+def char_ngram_features(texts: list, dim: int = FEEDBACK_CLF_DIM) -> np.ndarray:
+    # 한국어는 띄어쓰기가 불안정해서 문자 2~3-gram 해시 특징 사용
+    X = np.zeros((len(texts), dim), dtype=np.float32)
+    for r, t in enumerate(texts):
+        t = re.sub(r"\s+", " ", (t or "").strip().lower())
+        for n in (2, 3):
+            for i in range(len(t) - n + 1):
+                X[r, zlib.crc32(t[i:i + n].encode("utf-8")) % dim] += 1.0
+    X /= (np.linalg.norm(X, axis=1, keepdims=True) + 1e-8)
+    return X
+
+def _train_logreg(X: np.ndarray, Y: np.ndarray, iters: int = 300, lr: float = 2.0, l2: float = 1e-3):
+    # one-vs-rest 로지스틱 회귀(전체 배치 경사하강)
+    n, d = X.shape
+    W = np.zeros((d, Y.shape[1]), dtype=np.float32)
+    b = np.zeros(Y.shape[1], dtype=np.float32)
+    for _ in range(iters):
+        P = 1.0 / (1.0 + np.exp(-(X @ W + b)))
+        G = P - Y
+        W -= lr * ((X.T @ G) / n + l2 * W)
+        b -= lr * G.mean(axis=0)
+    return W, b
+
+def train_feedback_classifier(path_str: str):
+    rows = []
+    try:
+        with open(path_str, encoding="utf-8") as f:
+            for line in f:
+                row = safe_json_load(line)
+                if isinstance(row, dict) and row.get("answer"):
+                    rows.append(row)
+    except Exception:
+        return None
+    rows = rows[-FEEDBACK_CLF_MAX_SAMPLES:]
+    if len(rows) < FEEDBACK_CLF_MIN_SAMPLES:
+        return None
+
+    counts = {}
+    for row in rows:
+        for t in row.get("tags", []) or []:
+            counts[t] = counts.get(t, 0) + 1
+    labels = [t for t, c in sorted(counts.items(), key=lambda kv: -kv[1]) if c >= FEEDBACK_CLF_MIN_TAG_COUNT]
+    labels = labels[:FEEDBACK_CLF_MAX_LABELS]
+    if not labels:
+        return None
+
+    X = char_ngram_features([row["answer"] for row in rows])
+    Y = np.zeros((len(rows), len(labels) + 1), dtype=np.float32)
+    for r, row in enumerate(rows):
+        row_tags = set(row.get("tags", []) or [])
+        for j, t in enumerate(labels):
+            Y[r, j] = 1.0 if t in row_tags else 0.0
+        Y[r, -1] = 1.0 if row.get("template") == "B" else 0.0
+    W, b = _train_logreg(X, Y)
+    return {"labels": labels, "W": W, "b": b, "n": len(rows)}
+
+@st.cache_resource(show_spinner=False)
+def get_feedback_clf_holder() -> dict:
+    return {"lock": threading.Lock(), "model": None, "bucket": -1, "training": False, "trained_at": None}
+
+def _retrain_feedback_classifier(holder: dict, path_str: str, bucket: int):
+    # 백그라운드 학습 후 교체. 학습 중/실패 시 이전 모델(없으면 LLM 경로) 그대로 사용
+    try:
+        model = train_feedback_classifier(path_str)
+    except Exception:
+        model = None
+    with holder["lock"]:
+        if model:
+            holder.update({"model": model, "trained_at": time.time()})
+        holder.update({"bucket": bucket, "training": False})
+
+def get_feedback_classifier(wait: bool = False):
+    p = FEEDBACK_SAMPLES_PATH
+    if not p.exists():
+        return None
+    n = count_feedback_samples_cached(str(p), p.stat().st_mtime)
+    if n < FEEDBACK_CLF_MIN_SAMPLES:
+        return None
+    holder = get_feedback_clf_holder()
+    bucket = n // FEEDBACK_CLF_RETRAIN_EVERY
+    with holder["lock"]:
+        start = holder["bucket"] != bucket and not holder["training"]
+        if start:
+            holder["training"] = True
+    if start:
+        if wait:
+            _retrain_feedback_classifier(holder, str(p), bucket)
+        else:
+            threading.Thread(target=_retrain_feedback_classifier, args=(holder, str(p), bucket), name="feedback-clf", daemon=True).start()
+    return holder["model"]
+
+def classify_feedback_locally(answer_text: str):
+    # 확신할 때만 {"tags", "template"} 반환, 아니면 None(LLM이 모두 생성)
+    clf = get_feedback_classifier()
+    if not clf:
+        return None
+    x = char_ngram_features([answer_text])
+    p = (1.0 / (1.0 + np.exp(-(x @ clf["W"] + clf["b"]))))[0]
+    tag_p, p_b = p[:-1], float(p[-1])
+    order = [int(i) for i in np.argsort(-tag_p) if tag_p[i] >= FEEDBACK_CLF_TAG_THRESHOLD][:3]
+    if not order or abs(p_b - 0.5) < FEEDBACK_CLF_TEMPLATE_MARGIN:
+        return None
+    return {"tags": [clf["labels"][i] for i in order], "template": "B" if p_b > 0.5 else "A"}
+
+def _local_summary(answer_text: str) -> str:
+    lines = split_to_lines(answer_text, max_lines=1)
+    return _clip(lines[0], 60) if lines else ""
+
+# ---- Semantic answer cache: 거의 같은 답은 이전 피드백 재사용 ----
+SEMANTIC_CACHE_MIN_SIM = 0.93
+SEMANTIC_CACHE_MAX_PER_STEP = 200
+
+@st.cache_resource(show_spinner=False)
+def get_semantic_answer_cache() -> dict:
+    # buckets: (단계, 교사 기준) 해시 → {"label", "emb"(n×d), "results", "hit", "miss"}
+    return {"lock": threading.Lock(), "buckets": {}}
+
+def semantic_cache_bucket_key(step_story: str, extra_context: str) -> str:
+    return sha256_text("\x1f".join([step_story or "", extra_context or "", sha256_text(get_teacher_feedback_context())]))
+
+def embed_answer_unit(answer_text: str):
+    try:
+        v = np.array(embed_texts([answer_text.strip()])[0], dtype=np.float32)
+        return v / (np.linalg.norm(v) + 1e-8)
+    except Exception:
+        return None
+
+def semantic_cache_lookup(bucket_key: str, step_label: str, qv, min_sim: float):
+    cache = get_semantic_answer_cache()
+    with cache["lock"]:
+        b = cache["buckets"].setdefault(bucket_key, {"label": step_label, "emb": None, "results": [], "hit": 0, "miss": 0})
+        if qv is not None and b["emb"] is not None and len(b["results"]):
+            sims = b["emb"] @ qv
+            j = int(np.argmax(sims))
+            if float(sims[j]) >= min_sim:
+                b["hit"] += 1
+                return b["results"][j]
+        b["miss"] += 1
+        return None
+
+def semantic_cache_store(bucket_key: str, qv, result: dict):
+    if qv is None:
+        return
+    cache = get_semantic_answer_cache()
+    with cache["lock"]:
+        b = cache["buckets"].get(bucket_key)
+        if b is None:
+            return
+        emb = qv[None, :] if b["emb"] is None else np.vstack([b["emb"], qv[None, :]])
+        results = b["results"] + [result]
+        b["emb"], b["results"] = emb[-SEMANTIC_CACHE_MAX_PER_STEP:], results[-SEMANTIC_CACHE_MAX_PER_STEP:]
+
+def semantic_cache_stats() -> list:
+    cache = get_semantic_answer_cache()
+    with cache["lock"]:
+        rows = []
+        for b in cache["buckets"].values():
+            total = b["hit"] + b["miss"]
+            rows.append({
+                "단계": b["label"],
+                "요청": total,
+                "재사용": b["hit"],
+                "적중률": f"{(b['hit'] / total * 100):.0f}%" if total else "-",
+                "저장된 답": len(b["results"]),
+            })
+        return rows
+
+def _personalize_cached_feedback(cached: dict, answer_text: str) -> dict:
+    # 학생 자기 말을 첫 줄에 짧게 인용해 '내 답에 대한 피드백'임을 보이게
+    fb = dict(cached)
+    snippet = _local_summary(answer_text)
+    lines = str(cached.get("feedback", "")).split("\n")
+    if snippet and lines and ": " in lines[0]:
+        label, rest = lines[0].split(": ", 1)
+        lines[0] = f"{label}: ‘{_clip(snippet, 30)}’ — {rest}"
+    fb["feedback"] = "\n".join(lines)
+    fb["summary"] = snippet or cached.get("summary", "")
+    fb["cached"] = True
+    return fb
+
+# ---- Answer triage: 뻔한 경우(너무 짧음/베끼기/개인정보)만 LLM 없이 바로 안내. 애매하면 모두 LLM ----
+TRIAGE_MIN_CHARS = 8
+TRIAGE_COPY_OVERLAP = 0.8      # 답의 문자 3-gram 중 이야기에 있는 비율
+TRIAGE_ANSWER_LABELS = ("[최종 정리]", "[로고 설명]", "[답]", "이유:")  # 구역 머리말 먼저(토론 요약 안의 "이유:" 무시)
+_PII_RULES = [
+    ("전화번호", re.compile(r"01[016789][-\s.]?\d{3,4}[-\s.]?\d{4}")),
+    ("주민번호", re.compile(r"\d{6}[-\s]?[1-4]\d{6}")),
+    ("이메일", re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+")),
+    ("주소", re.compile(r"\d+\s*동\s*\d+\s*호|(아파트|빌라)\s*\d+\s*동")),
+    # 이름은 "이름은/이름이" 같은 분명한 말이 있을 때만(성+2글자 추측은 "정직한 친구"도 잡아서 제외, 나머지는 LLM 경로)
+    ("이름", re.compile(r"(내|제|우리\s*반\s*친구|친구|짝꿍|짝|동생|언니|오빠|형|누나)\s*이름(은|이|:)\s*[가-힣]{2,4}")),
+]
+TRIAGE_MESSAGES = {
+    "pii": ("개인정보 보호", "답을 써 준 것은 좋아요.", "답에 {kinds} 같은 개인정보가 들어 있어요. 인터넷에 올리거나 AI에 보내면 위험할 수 있어요.",
+            "개인정보를 빼도 내 생각이 잘 전달될까요?", "개인정보를 지우고 다시 제출해 보세요."),
+    "short": ("답 보완 필요", "생각을 적기 시작한 것이 좋아요.", "답이 너무 짧아서 어떤 이유인지 알기 어려워요.",
+              "왜 그렇게 생각했나요?", "‘왜냐하면 ~ 때문이에요’를 넣어 2문장 이상으로 써 보세요."),
+    "copy": ("내 말로 쓰기", "이야기를 꼼꼼히 읽은 것이 보여요.", "이야기 문장을 거의 그대로 옮겨서 내 생각이 잘 보이지 않아요.",
+             "이 장면에서 나라면 어떻게 했을까요?", "이야기 문장 대신 내 말로 생각과 이유를 써 보세요."),
+}
+
+@st.cache_resource(show_spinner=False)
+def get_triage_stats() -> dict:
+    return {"lock": threading.Lock(), "escalated": 0, "local": {}}
+
+def _student_part(answer_text: str) -> str:
+    # 호출부가 붙인 [질문]/선택: 등 머리말을 빼고 학생이 쓴 부분만
+    t = answer_text or ""
+    for label in TRIAGE_ANSWER_LABELS:
+        if label in t:
+            t = t.rsplit(label, 1)[1]
+            break
+    return t.strip()
+
+def _char_ngrams(text: str, n: int = 3) -> set:
+    t = re.sub(r"\s+", "", text or "")
+    return {t[i:i + n] for i in range(len(t) - n + 1)}
+
+def triage_answer(step_story: str, answer_text: str):
+    # 로컬에서 끝낼 수 있으면 (사유, 부가정보), 아니면 None(LLM으로)
+    pii = [kind for kind, rx in _PII_RULES if rx.search(answer_text or "")]
+    if pii:
+        return "pii", {"kinds": "·".join(pii)}
+
+    mine = _student_part(answer_text)
+    if len(re.sub(r"\s+", "", mine)) < TRIAGE_MIN_CHARS or len(set(mine)) <= 3:
+        return "short", {}
+
+    grams = _char_ngrams(mine)
+    if len(mine) > 15 and grams and len(grams & _char_ngrams(step_story)) / len(grams) >= TRIAGE_COPY_OVERLAP:
+        return "copy", {}
+    # 주제 밖 판단은 어절 비교로는 "돈을 내고 쓰면 괜찮다" 같은 정상 답도 잡아서 하지 않음(LLM 몫)
+    return None
+
+def _triage_feedback(reason: str, info: dict, answer_text: str) -> dict:
+    tag, praise, risk, q, nxt = TRIAGE_MESSAGES[reason]
+    return {
+        "tags": [tag],
+        "summary": "" if reason == "pii" else _local_summary(_student_part(answer_text)),
+        "feedback": _format_feedback("A", praise, risk.format(**info), q, nxt),
+        "triage": reason,
+    }
+
 def feedback_with_tags(step_story: str, answer_text: str, rag_ctx: str, extra_context: str = "") -> dict:
+    stats = get_triage_stats()
+    triaged = triage_answer(step_story, answer_text)
+    with stats["lock"]:
+        if triaged:
+            stats["local"][triaged[0]] = stats["local"].get(triaged[0], 0) + 1
+        else:
+            stats["escalated"] += 1
+    if triaged:
+        return _triage_feedback(triaged[0], triaged[1], answer_text)
+
+    min_sim = getattr(_FEEDBACK_LOCAL, "min_sim", None)
+    if min_sim is None:
+        min_sim = float(st.session_state.get("semantic_cache_threshold", SEMANTIC_CACHE_MIN_SIM))
+    bucket_key = semantic_cache_bucket_key(step_story, extra_context)
+    qv = embed_answer_unit(answer_text) if min_sim < 1.0 else None
+    hit = semantic_cache_lookup(bucket_key, _clip(step_story, 30), qv, min_sim)
+    if hit:
+        return _personalize_cached_feedback(hit, answer_text)
+
+    result = _feedback_with_tags_llm(step_story, answer_text, rag_ctx, extra_context)
+    if not result.get("pending"):
+        semantic_cache_store(bucket_key, qv, result)
+    return result
+
+def _feedback_with_tags_llm(step_story: str, answer_text: str, rag_ctx: str, extra_context: str = "") -> dict:
     teacher_ctx = get_teacher_feedback_context()
+    local = classify_feedback_locally(answer_text)
+    if local:
+        # 태그/템플릿은 로컬 분류기가 결정 → LLM은 문장 4개만
+        output_spec = f"""
+반드시 JSON만 출력.
+템플릿: {local["template"]} ({"핵심 판단/근거" if local["template"] == "B" else "잘한 점/위험 요소"} 형식)
+키:
+- praise: {"핵심 판단(칭찬 포함 1문장)" if local["template"] == "B" else "칭찬(구체적 1문장)"}
+- risk: {"근거(1문장)" if local["template"] == "B" else "위험/주의점(1문장)"}
+- check_question: 확인 질문(1문장)
+- next_action: 다음 행동(1문장, 교사 기준/관점이 있으면 반드시 반영)
+"""
+    else:
+        output_spec = """
+반드시 JSON만 출력.
+키:
+- tags: 문자열 리스트(최대 3개)
+- summary: 1줄 요약
+- template: "A" 또는 "B"
+- praise: 칭찬(구체적 1문장)
+- risk: 위험/주의점(1문장)
+- check_question: 확인 질문(1문장)
+- next_action: 다음 행동(1문장, 교사 기준/관점이 있으면 반드시 반영)
+"""
     prompt = f"""
 [학생 피드백 생성: 교사 기준 강반영 + 칭찬 포함]
 
@@ -681,48 +2345,190 @@ def feedback_with_tags(step_story: str, answer_text: str, rag_ctx: str, extra_co
 
 [학생 답]
 {answer_text}
+{output_spec}"""
+    validator = validate_feedback_text if local else validate_feedback
+    data, errors = ask_json_validated(prompt, validator, "feedback", system_prompt=SYSTEM_FEEDBACK_JSON, cache=True, call_class="feedback", reask=False)
+    if "_empty" in errors or set(_FEEDBACK_TEXT_SPEC) <= set(errors):
+        # API 혼잡/실패: 빈 '-' 피드백 대신 대기 안내(로컬 태그는 유지). 일 예산 소진이면 오늘은 다시 시도해도 안 됨
+        return {
+            "tags": local["tags"] if local else [],
+            "summary": _local_summary(answer_text) if local else "",
+            "feedback": FEEDBACK_BUDGET_MSG if budget_exhausted("feedback") else FEEDBACK_BUSY_MSG,
+            "pending": True,
+        }
 
-반드시 JSON만 출력.
-키:
-- tags: 문자열 리스트(최대 3개)
-- summary: 1줄 요약
-- template: "A" 또는 "B"
-- praise: 칭찬(구체적 1문장)
-- risk: 위험/주의점(1문장)
-- check_question: 확인 질문(1문장)
-- next_action: 다음 행동(1문장, 교사 기준/관점이 있으면 반드시 반영)
-"""
-    data = ask_gpt_json_object(prompt, system_prompt=SYSTEM_FEEDBACK_JSON)
-
-    tags = data.get("tags", [])
-    if not isinstance(tags, list):
-        tags = []
-    tags = [str(t).strip() for t in tags if str(t).strip()][:3]
-
-    template = str(data.get("template", "A")).strip().upper()
-    if template not in ["A", "B"]:
-        template = "A"
+    if local:
+        tags = local["tags"]
+        template = local["template"]
+        summary = _local_summary(answer_text)
+    else:
+        tags = data["tags"]
+        template = data["template"]
+        summary = data["summary"]
+        if tags:
+            record_feedback_sample(answer_text, tags, template)
 
     fb = _format_feedback(
         template,
-        str(data.get("praise", "")).strip(),
-        str(data.get("risk", "")).strip(),
-        str(data.get("check_question", "")).strip(),
-        str(data.get("next_action", "")).strip(),
+        data["praise"],
+        data["risk"],
+        data["check_question"],
+        data["next_action"],
     )
 
     return {
         "tags": tags,
-        "summary": str(data.get("summary", "")).strip(),
+        "summary": summary,
         "feedback": fb,
+        "tag_source": "local" if local else "llm",
     }
 
 # =========================================================
 # 14) Debate adaptive question generator (2 lines)
 # =========================================================
-def debate_next_question(topic: str, story: str, student_history: list, turn_index: int, rag_ctx: str) -> str:
-    teacher_ctx = get_teacher_feedback_context()
+def clamp_debate_turns(turns) -> int:
+    try:
+        t = int(turns)
+    except Exception:
+        t = DEBATE_TURNS_DEFAULT
+    return max(1, min(DEBATE_TURNS_MAX, t))
+
+def _two_line_question(q: str) -> str:
+    q = (q or "").strip()
+    if not q:
+        q = "좋아, 네 생각이 또렷해.\n그 생각의 근거를 한 가지로 말해볼래?"
+    lines = [ln.strip() for ln in q.split("\n") if ln.strip()]
+    if len(lines) == 1:
+        return f"좋아, 잘 설명했어.\n{lines[0]}"
+    return "\n".join(lines[:2])
+
+# ---- 후속 질문 트리(수업 생성 시 미리 계산) ----
+def _flatten_tree_nodes(raw_nodes, choice: str, parent_id: str, depth: int, max_depth: int, out: list):
+    if not isinstance(raw_nodes, list) or depth > max_depth:
+        return
+    for i, n in enumerate(raw_nodes):
+        if not isinstance(n, dict):
+            continue
+        anchor = str(n.get("anchor", "")).strip()
+        question = str(n.get("question", "")).strip()
+        if not anchor or not question:
+            continue
+        node_choice = choice or str(n.get("choice", "")).strip().upper()
+        if node_choice not in ["A", "B"]:
+            continue
+        arg_type = str(n.get("arg_type", "")).strip()
+        if arg_type not in DEBATE_ARG_TYPES:
+            arg_type = DEBATE_ARG_TYPES[i % len(DEBATE_ARG_TYPES)]
+        node_id = f"{parent_id or node_choice}/{arg_type}{i}"
+        out.append({
+            "id": node_id,
+            "parent": parent_id,
+            "choice": node_choice,
+            "arg_type": arg_type,
+            "depth": depth,
+            "anchor": anchor,
+            "question": _two_line_question(question),
+        })
+        _flatten_tree_nodes(n.get("children", []), node_choice, node_id, depth + 1, max_depth, out)
+
+def build_debate_question_tree(topic: str, story: str, choice_a: str, choice_b: str, rag_ctx: str, depth: int) -> dict:
+    depth = max(0, min(int(depth or 0), DEBATE_TREE_MAX_DEPTH))
+    if depth == 0:
+        return {}
+    child_rule = (
+        "각 노드의 children: 그 답 다음에 학생이 할 법한 답 5개(논거 유형별), 같은 키 형식, children는 빈 리스트"
+        if depth >= 2 else "children는 빈 리스트"
+    )
     prompt = f"""
+교사용 설계 요청. (교사 관점)
+심화 토론 후속 질문 트리 미리 만들기.
+
+주제: "{topic}"
+
+[토론 상황]
+{story}
+
+A: {choice_a}
+B: {choice_b}
+
+[reference.txt 발췌]
+{rag_ctx if rag_ctx else "- 없음"}
+
+반드시 JSON만 출력.
+키:
+- nodes: 리스트. 선택(A/B)마다 논거 유형({"/".join(DEBATE_ARG_TYPES)}) 1개씩, 총 10개
+- 각 원소 키: choice("A" 또는 "B"), arg_type, anchor, question, children
+- anchor: 그 선택/유형으로 초등 5~6학년이 할 법한 답 1문장
+- question: 정확히 2줄(1줄: 공감/칭찬 1문장, 2줄: 질문 1문장)
+- {child_rule}
+
+규칙:
+- 단정 금지(약관/규칙/상황 확인 관점)
+- 폭력/공포 배제
+"""
+    data = ask_gpt_json_object(prompt, system_prompt=SYSTEM_JSON_DESIGNER, priority=PRIORITY_TEACHER)
+    nodes = []
+    _flatten_tree_nodes(data.get("nodes", []), "", "", 1, depth, nodes)
+    if not nodes:
+        return {}
+    try:
+        vecs = np.array(embed_texts([n["anchor"] for n in nodes], priority=PRIORITY_TEACHER), dtype=np.float32)
+        vecs /= (np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-8)
+    except Exception:
+        return {}
+    # 임베딩은 세션(수업 dict)에 넣지 않고 디스크 참조만 보관
+    emb_ref = put_array_asset(vecs)
+    return {"depth": depth, "nodes": nodes, "emb": emb_ref} if emb_ref else {}
+
+def pick_tree_question(tree: dict, choice: str, parent_id, answer: str):
+    # parent_id None: 이미 트리를 벗어남(이후는 LLM)
+    if not tree or tree.get("emb") is None or parent_id is None or not (answer or "").strip():
+        return None
+    cand = [i for i, n in enumerate(tree["nodes"]) if n["choice"] == choice and n["parent"] == parent_id]
+    if not cand:
+        return None
+    try:
+        qv = np.array(embed_texts([answer.strip()])[0], dtype=np.float32)
+        qv /= (np.linalg.norm(qv) + 1e-8)
+    except Exception:
+        return None
+    emb = load_array_asset(tree["emb"])
+    if emb is None:
+        return None
+    sims = emb[cand] @ qv
+    j = int(np.argmax(sims))
+    if float(sims[j]) < DEBATE_TREE_MIN_SIM:
+        return None
+    return tree["nodes"][cand[j]]
+
+DEBATE_SUMMARY_MAX_POINTS = 6
+DEBATE_POINT_MAX_CHARS = 120
+DEBATE_QUESTION_MAX_CHARS = 80
+
+def debate_summary_point(student_msg: str, question: str = "") -> str:
+    # "질문 → 답" 한 줄: 최종 피드백이 각 답이 무엇에 대한 답인지 알 수 있게
+    answer = _clip(" ".join(split_to_lines(student_msg, max_lines=3)), DEBATE_POINT_MAX_CHARS)
+    q = [ln.strip() for ln in (question or "").split("\n") if ln.strip()]
+    return f"질문: {_clip(q[-1], DEBATE_QUESTION_MAX_CHARS)} → 답: {answer}" if q else answer
+
+def last_debate_question(msgs: list) -> str:
+    return next((m.get("content", "") for m in reversed(msgs or []) if m.get("role") == "assistant"), "")
+
+def update_debate_summary(summary_points: list, student_msg: str, question: str = "") -> list:
+    # 턴마다 (질문, 학생 답) 1줄 요약 추가. 첫 발언(선택/이유)은 항상 유지.
+    pts = list(summary_points or []) + [debate_summary_point(student_msg, question)]
+    if len(pts) > DEBATE_SUMMARY_MAX_POINTS:
+        pts = pts[:1] + pts[-(DEBATE_SUMMARY_MAX_POINTS - 1):]
+    return pts
+
+def format_debate_summary(summary_points: list) -> str:
+    return "\n".join(f"- {p}" for p in (summary_points or [])) or "- 없음"
+
+def debate_context_prefix(topic: str, story: str, rag_ctx: str) -> str:
+    # 턴마다 바뀌지 않는 앞부분: 주제/상황/RAG/교사 기준
+    # (provider 프롬프트 캐시는 1024토큰 이상부터라 보통 적중하지 않음. 메시지 구성 고정이 목적)
+    teacher_ctx = get_teacher_feedback_context()
+    return f"""
 주제: "{topic}"
 
 [토론 상황]
@@ -733,9 +2539,15 @@ def debate_next_question(topic: str, story: str, student_history: list, turn_ind
 
 [교사 기준(가능하면 반영)]
 {teacher_ctx if teacher_ctx else "- 없음"}
+""".strip()
+
+def debate_next_question(topic: str, story: str, summary_points: list, last_answer: str, turn_index: int, rag_ctx: str) -> str:
+    prompt = f"""
+[지금까지 질문과 학생 답 요약]
+{format_debate_summary(summary_points)}
 
-[학생 발언 기록]
-{json.dumps(student_history, ensure_ascii=False)}
+[학생 최근 답]
+{_clip(last_answer, 600)}
 
 이제 {turn_index}번째 후속 질문을 만든다.
 
@@ -745,15 +2557,205 @@ def debate_next_question(topic: str, story: str, student_history: list, turn_ind
 - 2줄: 질문 1문장(왜/근거/반대/대안/조건 중 1개 포함)
 - 단정 금지(약관/규칙/상황 확인 관점)
 """
-    q = ask_gpt_text(prompt, system_prompt=DEBATE_Q_SYSTEM).strip()
-    if not q:
-        q = "좋아, 네 생각이 또렷해.\n그 생각의 근거를 한 가지로 말해볼래?"
-    lines = [ln.strip() for ln in q.split("\n") if ln.strip()]
-    if len(lines) == 1:
-        q = f"좋아, 잘 설명했어.\n{lines[0]}"
-    else:
-        q = "\n".join(lines[:2])
-    return q
+    q = ask_gpt_text(
+        prompt,
+        system_prompt=DEBATE_Q_SYSTEM,
+        priority=PRIORITY_STUDENT,
+        context_prefix=debate_context_prefix(topic, story, rag_ctx),
+        cache=True,
+        call_class="debate",
+    )
+    return _two_line_question(q)
+
+def debate_follow_up(topic: str, debate: dict, summary_points: list, last_answer: str, turn_index: int, rag_ctx: str):
+    # 가까운 미리 만든 가지가 있으면 즉시 사용, 없으면 LLM. (질문, 출처) 반환
+    node = pick_tree_question(
+        debate.get("question_tree", {}),
+        st.session_state.get("debate_choice", ""),
+        st.session_state.get("debate_tree_node", ""),
+        last_answer,
+    )
+    if node:
+        st.session_state.debate_tree_node = node["id"]
+        return node["question"], "tree"
+    st.session_state.debate_tree_node = None
+    return debate_next_question(topic, debate.get("story", ""), summary_points, last_answer, turn_index, rag_ctx), "llm"
+
+# ---- Warm-up + health: 색인/캐시를 미리 준비하고 준비 상태를 로컬 HTTP로 노출 ----
+HEALTH_HOST = os.environ.get("HEALTH_HOST", "127.0.0.1")
+HEALTH_PORT = int(os.environ.get("HEALTH_PORT", "8599"))  # 0이면 끔
+WARMUP_TOPIC = "저작권"
+
+@st.cache_resource(show_spinner=False)
+def get_warmup_state() -> dict:
+    return {"lock": threading.Lock(), "status": "idle", "started": None, "seconds": None, "steps": {}, "health": ""}
+
+def _warm_step(state: dict, name: str, fn) -> bool:
+    t0 = time.monotonic()
+    try:
+        detail, ok = fn(), True
+    except Exception as e:
+        detail, ok = f"{type(e).__name__}: {e}", False
+    with state["lock"]:
+        state["steps"][name] = {"ok": ok, "seconds": round(time.monotonic() - t0, 3), "detail": detail}
+    return ok
+
+def _warm_shared_cache() -> str:
+    cache = get_shared_cache()
+    if type(cache) is CacheBackend:
+        return "disabled"
+    probe = uuid.uuid4().hex.encode("ascii")
+    cache.set("health", "probe", probe, 60)
+    if cache.get("health", "probe") != probe:
+        raise RuntimeError("read-back mismatch")
+    return type(cache).__name__
+
+def _warm_local_dirs() -> str:
+    dirs = [IMAGE_STORE_DIR, ASSET_DIR, FEEDBACK_SAMPLES_PATH.parent]
+    for d in dirs:
+        d.mkdir(parents=True, exist_ok=True)
+        probe = d / f".probe-{uuid.uuid4().hex[:8]}"
+        probe.write_bytes(b"ok")
+        probe.unlink()
+    return ", ".join(str(d) for d in dirs)
+
+def _warm_rag_index() -> str:
+    index = refresh_rag_index(wait=True)
+    if not index:
+        return "reference.txt 없음"
+    if index.get("emb") is None:
+        raise RuntimeError("embedding build failed")
+    return f"{len(index['chunks'])} chunks" + (" (partial)" if index.get("partial") else "")
+
+def _warm_lesson_assets() -> str:
+    # 고정 스토리: 문장 분리(fixed_story_chapters) + 단계별 RAG 문맥(_rag_retrieve_cached), 교사 피드백 분류기
+    chapters = generate_lesson_story_mode_fixed(WARMUP_TOPIC)["chapters"]
+    index = get_rag_index()
+    warmed = 0
+    if index and index.get("emb") is not None:
+        for c in chapters:
+            warmed += bool(rag_retrieve_cached(rag_query_for_step(WARMUP_TOPIC, c.get("story", "")), index, RAG_TOP_K, PRIORITY_WARM))
+    clf = get_feedback_classifier(wait=True)
+    return f"chapters {len(chapters)}, rag ctx {warmed}, classifier {'on' if clf else 'off'}"
+
+def run_warmup() -> dict:
+    state = get_warmup_state()
+    with state["lock"]:
+        state.update({"status": "warming", "started": datetime.now().isoformat(timespec="seconds"), "steps": {}})
+    t0 = time.monotonic()
+    ok = all([
+        _warm_step(state, "local_dirs", _warm_local_dirs),
+        _warm_step(state, "shared_cache", _warm_shared_cache),
+        _warm_step(state, "rag_index", _warm_rag_index),
+        _warm_step(state, "lesson_assets", _warm_lesson_assets),
+    ])
+    with state["lock"]:
+        state.update({"status": "ready" if ok else "degraded", "seconds": round(time.monotonic() - t0, 3)})
+    return health_report()
+
+def health_report() -> dict:
+    state = get_warmup_state()
+    with state["lock"]:
+        out = {k: state[k] for k in ("status", "started", "seconds", "health")}
+        out["steps"] = {k: dict(v) for k, v in state["steps"].items()}
+    out["ready"] = out["status"] in ("ready", "degraded")
+    out["embedding"] = dict(get_embed_progress())
+    holder = get_rag_holder()
+    out["rag_index"] = {
+        "content_hash": ((holder["index"] or {}).get("content_hash") or "")[:12],
+        "building": holder["building"],
+        "swaps": holder["swaps"],
+        "last_build_s": holder["last_build_s"],
+    }
+    out["queues"] = {m: rate_queue_depth(m) for m in RATE_LIMITS_PER_MIN}
+    return out
+
+def _start_health_server(state: dict):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, code: int, obj: dict):
+            body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self._send_cors()
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_cors(self):
+            # 내보낸 수업(허용한 주소 또는 file:// 의 "null")에서만 응답을 읽을 수 있게
+            origin = self.headers.get("Origin")
+            if origin and export_origin_allowed(origin):
+                self.send_header("Access-Control-Allow-Origin", origin)
+                self.send_header("Vary", "Origin")
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path not in ("/healthz", "/readyz"):
+                self.send_error(404)
+                return
+            report = health_report()
+            self._send_json(503 if path == "/readyz" and not report["ready"] else 200, report)
+
+        def do_OPTIONS(self):
+            self.send_response(204)
+            self._send_cors()
+            self.send_header("Access-Control-Allow-Methods", "POST, OPTIONS")
+            self.send_header("Access-Control-Allow-Headers", "Content-Type")
+            self.end_headers()
+
+        def do_POST(self):
+            if self.path.split("?", 1)[0] != "/api/feedback":
+                self.send_error(404)
+                return
+            origin = self.headers.get("Origin")
+            if origin and not export_origin_allowed(origin):
+                self._send_json(403, {"error": "허용되지 않은 주소예요."})
+                return
+            try:
+                n = int(self.headers.get("Content-Length") or 0)
+            except ValueError:
+                n = 0
+            if n <= 0:
+                self._send_json(400, {"error": "답을 입력해 주세요."})
+                return
+            if n > EXPORT_BODY_MAX_BYTES:
+                self._send_json(413, {"error": "답이 너무 길어요."})
+                return
+            payload = safe_json_load(self.rfile.read(n).decode("utf-8", errors="ignore"))
+            try:
+                code, out = handle_exported_feedback(payload if isinstance(payload, dict) else {}, client=self.client_address[0])
+            except Exception:
+                code, out = 503, {"error": FEEDBACK_BUSY_MSG}
+            self._send_json(code, out)
+
+        def log_message(self, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((HEALTH_HOST, HEALTH_PORT), Handler)
+    except OSError as e:  # 같은 호스트의 다른 레플리카가 포트 사용 중
+        state["health"] = f"off ({e.strerror})"
+        return
+    threading.Thread(target=server.serve_forever, name="health", daemon=True).start()
+    state["health"] = f"http://{HEALTH_HOST}:{HEALTH_PORT}/readyz"
+
+@st.cache_resource(show_spinner=False)
+def start_background_warmup() -> dict:
+    # 프로세스당 1번: 웜업 스레드 + 상태 엔드포인트
+    state = get_warmup_state()
+    if HEALTH_PORT:
+        _start_health_server(state)
+    threading.Thread(target=run_warmup, name="warmup", daemon=True).start()
+    start_rag_watcher()
+    return state
+
+if "--warmup" in sys.argv and not _in_streamlit_runtime():
+    # 배포 시 `python app.py --warmup` 을 서버 시작 전에 실행: 공유 캐시/임베딩 체크포인트를 채워 둠
+    report = run_warmup()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    sys.exit(0 if report["status"] == "ready" else 1)
 
 # =========================================================
 # 15) Session state init
@@ -781,40 +2783,712 @@ default_state = {
     "closing": {},
     "debate_turn": 0,
     "debate_msgs": [],
+    "debate_summary": [],
+    "debate_choice": "",
+    "debate_tree_node": "",
+    "debate_turns_setting": DEBATE_TURNS_DEFAULT,
+    "debate_tree_depth_setting": 0,
+    "semantic_cache_threshold": SEMANTIC_CACHE_MIN_SIM,
+    "lesson_id": "",
+    "resume_code": "",
 }
-for k, v in default_state.items():
-    if k not in st.session_state:
-        st.session_state[k] = v
+def init_session_state():
+    for k, v in default_state.items():
+        if k not in st.session_state:
+            st.session_state[k] = v
+
+# ---- Session footprint: 참조 저장 + 세션당 메모리 상한 + 디스크 방출 ----
+SESSION_STORE_DIR = Path(".session_store")
+SESSION_BUDGET_BYTES = 1_500_000
+SESSION_LOG_KEEP = 30        # 메모리에 남길 최근 로그 수(나머지는 디스크)
+SESSION_INLINE_MAX = 16_384  # 이보다 큰 bytes 값은 asset 참조로 교체
+SESSION_REGISTRY_TTL_S = 3 * 3600
+
+@st.cache_resource(show_spinner=False)
+def get_session_registry() -> dict:
+    return {"lock": threading.Lock(), "sessions": {}}
+
+def session_id() -> str:
+    if "_sid" not in st.session_state:
+        st.session_state["_sid"] = uuid.uuid4().hex
+    return st.session_state["_sid"]
+
+def _session_log_path() -> Path:
+    return SESSION_STORE_DIR / session_id() / "logs.jsonl"
+
+def _approx_size(x, depth: int = 0) -> int:
+    if isinstance(x, (bytes, bytearray)):
+        return len(x)
+    if isinstance(x, np.ndarray):
+        return int(x.nbytes)
+    if isinstance(x, str):
+        return len(x.encode("utf-8", errors="ignore"))
+    if depth > 8:
+        return sys.getsizeof(x)
+    if isinstance(x, dict):
+        return sum(_approx_size(k, depth + 1) + _approx_size(v, depth + 1) for k, v in x.items())
+    if isinstance(x, (list, tuple, set)):
+        return sum(_approx_size(v, depth + 1) for v in x)
+    return sys.getsizeof(x)
+
+def _spill_logs(keep: int):
+    logs = st.session_state.get("logs", [])
+    if len(logs) <= keep:
+        return
+    old, st.session_state.logs = logs[:len(logs) - keep], logs[len(logs) - keep:]
+    try:
+        p = _session_log_path()
+        p.parent.mkdir(parents=True, exist_ok=True)
+        with p.open("a", encoding="utf-8") as f:
+            for row in old:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    except Exception:
+        pass
 
-# =========================================================
-# 16) Sidebar
-# =========================================================
-st.sidebar.title("🤖 AI 윤리 교육")
+def append_log(row: dict):
+    st.session_state.logs.append(row)
+    _spill_logs(SESSION_LOG_KEEP)
+    record_class_answer(st.session_state.get("lesson_id", ""), _class_item_id(row), _class_answer_text(row))
+
+def all_session_logs() -> list:
+    rows = []
+    p = _session_log_path()
+    if p.exists():
+        try:
+            with p.open(encoding="utf-8") as f:
+                rows = [r for r in (safe_json_load(line) for line in f) if isinstance(r, dict)]
+        except Exception:
+            rows = []
+    return rows + list(st.session_state.get("logs", []))
+
+def clear_session_logs():
+    st.session_state.logs = []
+    try:
+        _session_log_path().unlink(missing_ok=True)
+    except Exception:
+        pass
+
+def enforce_session_budget() -> int:
+    # 1) 큰 bytes 값 → asset 참조  2) 그래도 넘으면 로그를 디스크로
+    for k in list(st.session_state.keys()):
+        v = st.session_state[k]
+        if isinstance(v, (bytes, bytearray)) and len(v) > SESSION_INLINE_MAX:
+            st.session_state[k] = image_ref(bytes(v))
+    total = sum(_approx_size(st.session_state[k]) for k in list(st.session_state.keys()))
+    if total > SESSION_BUDGET_BYTES:
+        _spill_logs(0)
+        total = sum(_approx_size(st.session_state[k]) for k in list(st.session_state.keys()))
+
+    reg = get_session_registry()
+    now = time.time()
+    with reg["lock"]:
+        reg["sessions"][session_id()] = {"bytes": total, "ts": now}
+        for sid in [s for s, r in reg["sessions"].items() if now - r["ts"] > SESSION_REGISTRY_TTL_S]:
+            del reg["sessions"][sid]
+    return total
+
+def session_memory_report() -> dict:
+    reg = get_session_registry()
+    with reg["lock"]:
+        rows = dict(reg["sessions"])
+    mine = rows.get(st.session_state.get("_sid", ""), {}).get("bytes", 0)
+    return {"session": mine, "total": sum(r["bytes"] for r in rows.values()), "sessions": len(rows)}
+
+# ---- Lesson store: 생성된 수업을 공유 캐시에 저장(수업 코드로 불러오기) ----
+LESSON_TTL_S = 30 * 24 * 3600
+
+def save_lesson(lesson: dict) -> str:
+    payload = json.dumps(lesson, ensure_ascii=False, sort_keys=True, default=str)
+    lesson_id = sha256_text(payload)[:8].upper()
+    get_shared_cache().set("lesson", lesson_id, payload.encode("utf-8"), LESSON_TTL_S)
+    return lesson_id
+
+def load_lesson(lesson_id: str):
+    data = shared_get_json("lesson", (lesson_id or "").strip().upper())
+    return data if isinstance(data, dict) and data.get("lesson_type") else None
+
+def apply_lesson_to_session(lesson: dict):
+    lt = lesson.get("lesson_type", "")
+    st.session_state.lesson_type = lt
+    st.session_state.analysis = lesson.get("analysis", {})
+    st.session_state.teacher_guide = lesson.get("teacher_guide", "")
+
+    st.session_state.steps = [with_story_lines(s) for s in lesson.get("steps", [])] if lt == LESSON_IMAGE_PROMPT else []
+    st.session_state.current_step = 0
+
+    is_story = lt == LESSON_STORY_MODE
+    st.session_state.story_title = lesson.get("story_title", "") if is_story else ""
+    st.session_state.story_outline = lesson.get("outline", []) if is_story else []
+    st.session_state.story_chapters = [with_story_lines(c) for c in lesson.get("chapters", [])] if is_story else []
+    st.session_state.story_chapter_index = 1
+
+    is_debate = lt == LESSON_DEEP_DEBATE
+    st.session_state.debate = with_story_lines(lesson.get("debate_step", {})) if is_debate else {}
+    st.session_state.closing = lesson.get("closing_step", {}) if is_debate else {}
+    st.session_state.debate_turn = 0
+    st.session_state.debate_msgs = []
+    st.session_state.debate_summary = []
+
+    clear_session_logs()
+    clear_step_images_from_session()
+    clear_student_generated_images_from_session()
+    clear_story_prompt_assets()
+
+# ---- Progress checkpoints: 학생 진행 상황을 이어하기 코드로 저장/복원(새 API 호출 없음) ----
+PROGRESS_TTL_S = 7 * 24 * 3600
+PROGRESS_LOG_MAX = 200
+PROGRESS_KEYS = (
+    "topic", "lesson_type", "lesson_id", "current_step", "story_chapter_index",
+    "debate_turn", "debate_msgs", "debate_summary", "debate_choice", "debate_tree_node",
+    "story_act1_prompt", "story_act1_prompt_final", "story_act1_img",
+)
+PROGRESS_KEY_PREFIXES = ("step_img_", "stu_img_", "p1_", "p2_")  # 이미지 참조 + 프롬프트 입력
+# 수업 코드가 없을 때(공유 캐시 저장 실패 등)만 수업 내용을 같이 저장: 세션 키 → 수업 dict 키
+PROGRESS_LESSON_FIELDS = {
+    "analysis": "analysis", "teacher_guide": "teacher_guide", "steps": "steps",
+    "story_title": "story_title", "story_outline": "outline", "story_chapters": "chapters",
+    "debate": "debate_step", "closing": "closing_step",
+}
+
+# 이어하기 코드: 헷갈리는 글자(0/O/1/I/L) 뺀 31자 × 12자리(약 59비트), 실패는 클라이언트별로 제한
+RESUME_CODE_LEN = 12
+RESUME_ALPHABET = "23456789ABCDEFGHJKMNPQRSTUVWXYZ"
+RESUME_MAX_FAILS = 5
+RESUME_FAIL_WINDOW_S = 600
+
+@st.cache_resource(show_spinner=False)
+def get_rate_windows() -> dict:
+    return {"lock": threading.Lock(), "hits": {}}
+
+def window_hits(scope: str, key: str, window_s: float, add: bool = False) -> int:
+    # 최근 window_s 초 동안 (scope, key) 기록 수. add=True면 이번 것도 기록한 뒤 센다
+    reg = get_rate_windows()
+    now = time.time()
+    with reg["lock"]:
+        hits = [t for t in reg["hits"].get((scope, key), []) if now - t < window_s]
+        if add:
+            hits.append(now)
+        if hits:
+            reg["hits"][(scope, key)] = hits
+        else:
+            reg["hits"].pop((scope, key), None)
+        return len(hits)
+
+def client_key() -> str:
+    try:
+        ip = st.context.ip_address
+    except Exception:
+        ip = None
+    return ip or session_id()
+
+def normalize_resume_code(code: str) -> str:
+    return re.sub(r"[^0-9A-Z]", "", (code or "").upper())
+
+def format_resume_code(code: str) -> str:
+    return "-".join(code[i:i + 4] for i in range(0, len(code), 4))
+
+def resume_code() -> str:
+    if not st.session_state.get("resume_code"):
+        st.session_state.resume_code = "".join(secrets.choice(RESUME_ALPHABET) for _ in range(RESUME_CODE_LEN))
+    return st.session_state.resume_code
+
+def _progress_snapshot() -> dict:
+    ss = st.session_state
+    snap = {k: ss[k] for k in PROGRESS_KEYS if k in ss}
+    snap.update({k: ss[k] for k in list(ss.keys()) if str(k).startswith(PROGRESS_KEY_PREFIXES) and isinstance(ss[k], str)})
+    if not ss.get("lesson_id"):
+        snap["lesson"] = {dst: ss.get(src) for src, dst in PROGRESS_LESSON_FIELDS.items()}
+    return snap
+
+def checkpoint_progress():
+    # 바뀐 경우에만 저장. 재실행/패널 재실행마다 불러도 해시 비교만 함
+    if not st.session_state.get("lesson_type"):
+        return
+    snap = _progress_snapshot()
+    digest = sha256_text(json.dumps([snap, st.session_state.get("logs", [])], ensure_ascii=False, sort_keys=True, default=str))
+    if digest == st.session_state.get("_progress_digest"):
+        return
+    snap["logs"] = all_session_logs()[-PROGRESS_LOG_MAX:]
+    snap["saved_at"] = now_str()
+    shared_set_json("progress", resume_code(), snap, PROGRESS_TTL_S)
+    st.session_state["_progress_digest"] = digest
+
+def restore_progress(code: str) -> str:
+    # "ok" | "missing" | "limited"(최근 실패가 많아 잠시 거절)
+    who = client_key()
+    if window_hits("resume_fail", who, RESUME_FAIL_WINDOW_S) >= RESUME_MAX_FAILS:
+        return "limited"
+    code = normalize_resume_code(code)
+    snap = shared_get_json("progress", code) if len(code) == RESUME_CODE_LEN else None
+    lesson = None
+    if isinstance(snap, dict) and snap.get("lesson_type"):
+        lesson = load_lesson(snap.get("lesson_id", ""))
+        if lesson is None and isinstance(snap.get("lesson"), dict):
+            lesson = {**snap["lesson"], "lesson_type": snap["lesson_type"]}
+    if lesson is None:
+        window_hits("resume_fail", who, RESUME_FAIL_WINDOW_S, add=True)
+        return "missing"
+    apply_lesson_to_session(lesson)
+    for k, v in snap.items():
+        if k not in ("lesson", "logs", "saved_at"):
+            st.session_state[k] = v
+    st.session_state.logs = list(snap.get("logs") or [])
+    _spill_logs(SESSION_LOG_KEEP)
+    st.session_state.resume_code = code
+    st.session_state["_progress_digest"] = ""
+    return "ok"
+
+# ---- Static export: 준비된 수업을 정적 HTML/PWA로(답 제출만 서버의 피드백 API 호출) ----
+EXPORT_TTL_S = 30 * 24 * 3600
+EXPORT_ANSWER_MAX_CHARS = 2000
+EXPORT_BODY_MAX_BYTES = 16_384
+# 학생 기기에서 닿는 피드백 API 주소(예: https://ethics.school.kr:8599). 비우면 HEALTH_HOST:HEALTH_PORT
+EXPORT_API_BASE = os.environ.get("EXPORT_API_BASE", "").strip()
+# 응답을 읽을 수 있는 출처(쉼표 구분). "null" = 파일로 연 index.html
+EXPORT_ALLOWED_ORIGINS = {o.strip().rstrip("/") for o in os.environ.get("EXPORT_ALLOWED_ORIGINS", "null").split(",") if o.strip()}
+EXPORT_TOKENS_KEEP = 3  # 다시 내보내도 최근 몇 개 파일은 계속 동작
+EXPORT_RATE_WINDOW_S = 60
+EXPORT_RATE_PER_CLIENT = 60  # 학교 NAT 뒤 한 반이 같은 IP일 수 있음
+EXPORT_RATE_PER_LESSON = 120
+
+EXPORT_HTML = """<!doctype html>
+<html lang="ko">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>%%TITLE%%</title>
+<link rel="manifest" href="manifest.webmanifest">
+<style>
+body{font-family:system-ui,-apple-system,"Noto Sans KR",sans-serif;max-width:760px;margin:0 auto;padding:16px;line-height:1.6;color:#222}
+section.item{display:none;border:1px solid #ddd;border-radius:12px;padding:16px;margin:12px 0}
+section.item.on{display:block}
+img{display:block;margin:8px auto;max-width:100%;width:320px;border-radius:8px}
+.choice{display:block;margin:6px 0;padding:8px;border-radius:8px;background:#f3f6ff}
+textarea{width:100%;min-height:96px;box-sizing:border-box;font:inherit}
+button{font:inherit;padding:8px 14px;border-radius:8px;border:1px solid #888;background:#fff}
+.fb{white-space:pre-wrap;background:#f7f7f7;border-radius:8px;padding:8px;margin-top:8px}
+.fb:empty{display:none}
+nav{display:flex;justify-content:space-between;align-items:center}
+</style>
+</head>
+<body>
+<h1>%%TITLE%%</h1>
+<p>%%SUBTITLE%%</p>
+%%ITEMS%%
+<nav><button id="prev">&lt; 이전</button><span id="pos"></span><button id="next">다음 &gt;</button></nav>
+<script>
+var LESSON_ID = %%LESSON_ID%%, API = %%API%%, TOKEN = %%TOKEN%%, KEY = "lesson:" + LESSON_ID;
+var items = document.querySelectorAll("section.item"), cur = +(localStorage.getItem(KEY + ":pos") || 0);
+function show(i) {
+  cur = Math.max(0, Math.min(items.length - 1, i));
+  items.forEach(function (s, k) { s.classList.toggle("on", k === cur); });
+  document.getElementById("pos").textContent = (cur + 1) + " / " + items.length;
+  localStorage.setItem(KEY + ":pos", cur);
+  window.scrollTo(0, 0);
+}
+document.getElementById("prev").onclick = function () { show(cur - 1); };
+document.getElementById("next").onclick = function () { show(cur + 1); };
+function queue() { return JSON.parse(localStorage.getItem(KEY + ":queue") || "[]"); }
+function send(data, out) {
+  out.textContent = "피드백 받는 중...";
+  return fetch(API + "/api/feedback", {method: "POST", headers: {"Content-Type": "text/plain"}, body: JSON.stringify(data)})
+    .then(function (r) { return r.json(); })
+    .then(function (j) { out.textContent = j.feedback || j.error || ""; localStorage.setItem(KEY + ":fb:" + data.item, out.textContent); })
+    .catch(function () {
+      var q = queue().filter(function (x) { return x.item !== data.item; }); q.push(data);
+      localStorage.setItem(KEY + ":queue", JSON.stringify(q));
+      out.textContent = "인터넷이 연결되면 자동으로 보낼게요.";
+    });
+}
+function flush() {
+  var q = queue(); localStorage.setItem(KEY + ":queue", "[]");
+  q.forEach(function (d) { var f = document.querySelector("form[data-item='" + d.item + "'] .fb"); if (f) send(d, f); });
+}
+document.querySelectorAll("form.answer").forEach(function (f) {
+  var id = f.dataset.item, out = f.querySelector(".fb");
+  f.answer.value = localStorage.getItem(KEY + ":ans:" + id) || "";
+  out.textContent = localStorage.getItem(KEY + ":fb:" + id) || "";
+  f.answer.oninput = function () { localStorage.setItem(KEY + ":ans:" + id, f.answer.value); };
+  f.onsubmit = function (e) {
+    e.preventDefault();
+    if (!f.answer.value.trim()) { out.textContent = "답을 입력해 주세요."; return; }
+    var c = f.querySelector("input[name=choice]:checked");
+    send({lesson_id: LESSON_ID, token: TOKEN, item: id, choice: c ? c.value : "", answer: f.answer.value}, out);
+  };
+});
+window.addEventListener("online", flush);
+flush();
+show(cur);
+if ("serviceWorker" in navigator) navigator.serviceWorker.register("sw.js");
+</script>
+</body>
+</html>
+"""
+
+EXPORT_SW = """var CACHE = %%CACHE%%, FILES = %%FILES%%;
+self.addEventListener("install", function (e) { e.waitUntil(caches.open(CACHE).then(function (c) { return c.addAll(FILES); })); });
+self.addEventListener("activate", function (e) {
+  e.waitUntil(caches.keys().then(function (ks) { return Promise.all(ks.filter(function (k) { return k !== CACHE; }).map(function (k) { return caches.delete(k); })); }));
+});
+self.addEventListener("fetch", function (e) {
+  if (e.request.method !== "GET") return;
+  e.respondWith(caches.match(e.request).then(function (r) { return r || fetch(e.request); }));
+});
+"""
+
+def export_origin_allowed(origin: str) -> bool:
+    return (origin or "").strip().rstrip("/") in EXPORT_ALLOWED_ORIGINS
 
-rag_index = get_rag_index()
-if rag_index and rag_index.get("chunks"):
-    st.sidebar.caption(f"📚 RAG 적용: reference.txt (Top-K={RAG_TOP_K})")
-else:
-    st.sidebar.caption("📚 RAG 적용: reference.txt")
-    if not Path(REFERENCE_PATH).exists():
-        st.sidebar.warning("reference.txt 없음(레포에 포함 필요)")
+def export_api_problem(api_base: str) -> str:
+    # 학생 기기에서 닿지 않는 주소면 이유를, 괜찮으면 "" 반환
+    try:
+        u = urlsplit((api_base or "").strip())
+        host = u.hostname or ""
+    except ValueError:
+        return "주소 형식이 올바르지 않아요."
+    if u.scheme not in ("http", "https") or not host:
+        return "http(s)://주소:포트 형식으로 적어 주세요."
+    if host == "localhost":
+        return "localhost 는 학생 기기에서 닿지 않아요. 서버의 IP나 도메인을 적어 주세요."
+    try:
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        return ""
+    if ip.is_loopback or ip.is_unspecified:
+        return f"{host} 는 학생 기기에서 닿지 않아요. 서버의 IP나 도메인을 적어 주세요."
+    return ""
+
+def default_export_api_base() -> str:
+    return EXPORT_API_BASE or f"http://{HEALTH_HOST}:{HEALTH_PORT}"
+
+def lesson_items(lesson: dict) -> list:
+    # 수업 유형별 화면 단위: {"id", "title", "story", "question", "choices", "note", "extra", "illustrated"}
+    # illustrated: 학생 화면에서도 삽화를 그리는 항목(내보내기도 이 항목만 삽화 포함)
+    lt = lesson.get("lesson_type", "")
+    items = []
+    if lt == LESSON_IMAGE_PROMPT:
+        for i, s in enumerate(lesson.get("steps", [])):
+            kind = s.get("type", "")
+            items.append({
+                "id": f"s{i}",
+                "title": f"단계 {i + 1}",
+                "story": s.get("story", ""),
+                "question": {"dilemma": "왜 그렇게 생각하나요?", "discussion": s.get("question", "")}.get(kind, ""),
+                "choices": [s.get("choice_a", ""), s.get("choice_b", "")] if kind == "dilemma" else [],
+                "note": "이 단계(이미지 만들기)는 선생님과 함께 수업 화면에서 해요." if kind == "image_revision" else "",
+                "extra": "",
+                "illustrated": True,
+            })
+    elif lt == LESSON_STORY_MODE:
+        for c in lesson.get("chapters", []):
+            items.append({
+                "id": f"c{c.get('chapter_index', len(items) + 1)}",
+                "title": c.get("chapter_title", ""),
+                "story": c.get("story", ""),
+                "question": c.get("question", ""),
+                "choices": [],
+                "note": c.get("debrief", "") if c.get("ending") else "",
+                "extra": "스토리 모드(고정 5막)",
+                "illustrated": True,
+            })
+    elif lt == LESSON_DEEP_DEBATE:
+        d, cl = lesson.get("debate_step", {}), lesson.get("closing_step", {})
+        items.append({
+            "id": "d0",
+            "title": d.get("case_title", "") or "딜레마 토론",
+            "story": d.get("story", ""),
+            "question": "왜 그렇게 생각하나요?",
+            "choices": [d.get("choice_a", ""), d.get("choice_b", "")],
+            "note": "\n".join(f"- {x}" for x in d.get("constraints", []) if x),
+            "extra": "딜레마 토론(오프라인) 첫 선택",
+            "illustrated": True,
+        })
+        items.append({
+            "id": "d1",
+            "title": "정리",
+            "story": cl.get("story", ""),
+            "question": cl.get("question", ""),
+            "choices": [],
+            "note": "",
+            "extra": "딜레마 토론(오프라인) 최종 정리",
+            "illustrated": False,
+        })
+    return items
+
+def _compose_exported_answer(item: dict, choice: str, answer: str) -> str:
+    if item["choices"] and choice in ("A", "B"):
+        return f"선택: {choice} / {item['choices'][0 if choice == 'A' else 1]}\n이유: {answer}"
+    return f"[질문] {item['question']}\n[답] {answer}"
+
+def _render_export_item(item: dict, img_name: str) -> str:
+    esc = html_lib.escape
+    parts = [f'<section class="item"><h2>{esc(item["title"])}</h2>']
+    if img_name:
+        parts.append(f'<img src="assets/{img_name}" alt="" loading="lazy">')
+    parts.append("".join(f"<p>{esc(line)}</p>" for line in split_to_lines(item["story"], max_lines=STORY_MAX_LINES)))
+    if item["note"]:
+        parts.append(f'<p><small>{esc(item["note"]).replace(chr(10), "<br>")}</small></p>')
+    if item["question"]:
+        choices = "".join(
+            f'<label class="choice"><input type="radio" name="choice" value="{k}"{" checked" if k == "A" else ""}> {k}: {esc(c)}</label>'
+            for k, c in zip("AB", item["choices"])
+        )
+        parts.append(
+            f'<form class="answer" data-item="{item["id"]}"><p><b>{esc(item["question"])}</b></p>{choices}'
+            f'<textarea name="answer" placeholder="2~6줄"></textarea><button type="submit">제출(피드백)</button>'
+            f'<div class="fb"></div></form>'
+        )
+    parts.append("</section>")
+    return "".join(parts)
+
+def export_lesson_static(lesson: dict, lesson_id: str, api_base: str, include_images: bool = True, generate_missing: bool = False) -> bytes:
+    # index.html + sw.js + manifest + assets/*.webp 를 zip 으로. 삽화는 학생 화면과 같은 캐시 키 사용
+    # 삽화는 학생 화면이 그리는 항목만, 기본은 이미 만든 원본만(generate_missing=True 일 때만 새로 생성)
+    # 파일마다 새 토큰을 넣고 서버에도 저장: 토큰 없는 제출은 거절
+    items = lesson_items(lesson)
+    token = secrets.token_urlsafe(18)
+    files, assets = {}, {}
+    for it in items:
+        img = None
+        if include_images and it["illustrated"] and it["story"]:
+            if generate_missing:
+                try:
+                    img = generate_image_bytes_cached(it["story"], IMAGE_MODEL, _priority=PRIORITY_TEACHER)
+                except Exception:
+                    img = None
+            else:
+                raw = load_original_image(image_key(it["story"], IMAGE_MODEL))
+                img = make_thumbnail(raw) if raw else None
+        name = ""
+        if img:
+            ext = "webp" if img[8:12] == b"WEBP" else ("png" if img[:4] == b"\x89PNG" else "jpg")
+            name = f"{hashlib.sha256(img).hexdigest()[:16]}.{ext}"
+            assets[f"assets/{name}"] = img
+        it["html"] = _render_export_item(it, name)
+
+    title = lesson.get("story_title") or lesson.get("topic") or "AI 윤리 수업"
+    page = (
+        EXPORT_HTML.replace("%%TITLE%%", html_lib.escape(title))
+        .replace("%%SUBTITLE%%", html_lib.escape(f"{lesson.get('lesson_type', '')} · 수업 코드 {lesson_id}"))
+        .replace("%%ITEMS%%", "\n".join(it["html"] for it in items))
+        .replace("%%LESSON_ID%%", json.dumps(lesson_id).replace("</", "<\\/"))
+        .replace("%%API%%", json.dumps(api_base.rstrip("/")).replace("</", "<\\/"))
+        .replace("%%TOKEN%%", json.dumps(token))
+    )
+    files["index.html"] = page.encode("utf-8")
+    files["manifest.webmanifest"] = json.dumps(
+        {"name": title, "short_name": "AI 윤리", "start_url": "index.html", "display": "standalone", "lang": "ko"},
+        ensure_ascii=False,
+    ).encode("utf-8")
+    cached = ["index.html", "manifest.webmanifest"] + sorted(assets)
+    files["sw.js"] = (
+        EXPORT_SW.replace("%%CACHE%%", json.dumps(f"lesson-{lesson_id}-{sha256_text(page)[:8]}"))
+        .replace("%%FILES%%", json.dumps(cached))
+    ).encode("utf-8")
+    files.update(assets)
+
+    old = shared_get_json("export", lesson_id)
+    prev = (old.get("tokens") or []) if isinstance(old, dict) else []
+    tokens = ([token] + list(prev))[:EXPORT_TOKENS_KEEP]
+    shared_set_json("export", lesson_id, {"teacher_ctx": get_teacher_feedback_context(), "tokens": tokens, "created": now_str()}, EXPORT_TTL_S)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in files.items():
+            # 이미지는 이미 압축(WebP) → 저장만
+            zf.writestr(name, data, compress_type=zipfile.ZIP_STORED if name.startswith("assets/") else zipfile.ZIP_DEFLATED)
+    return buf.getvalue()
+
+def _export_token_ok(meta: dict, token) -> bool:
+    token = str(token or "")
+    return bool(token) and any(hmac.compare_digest(token, str(t)) for t in meta.get("tokens") or [])
+
+def handle_exported_feedback(payload: dict, client: str = ""):
+    # 내보낸 수업의 답 제출 처리 → (HTTP 코드, 응답 dict). 이야기/질문은 서버에 저장된 수업에서 가져옴
+    if window_hits("export_client", client, EXPORT_RATE_WINDOW_S, add=True) > EXPORT_RATE_PER_CLIENT:
+        return 429, {"error": "제출이 너무 많아요. 잠시 뒤에 다시 보내 주세요."}
+    lesson_id = str(payload.get("lesson_id", "")).strip().upper()
+    meta = shared_get_json("export", lesson_id) if lesson_id else None
+    if not isinstance(meta, dict) or not _export_token_ok(meta, payload.get("token")):
+        return 403, {"error": "수업 파일이 올바르지 않아요. 선생님께 새 파일을 받아 주세요."}
+    lesson = load_lesson(lesson_id)
+    if not lesson:
+        return 404, {"error": "수업을 찾을 수 없어요. 선생님께 알려 주세요."}
+    if window_hits("export_lesson", lesson_id, EXPORT_RATE_WINDOW_S, add=True) > EXPORT_RATE_PER_LESSON:
+        return 429, {"error": "제출이 너무 많아요. 잠시 뒤에 다시 보내 주세요."}
+    item = next((it for it in lesson_items(lesson) if it["id"] == payload.get("item") and it["question"]), None)
+    answer = str(payload.get("answer", "")).strip()[:EXPORT_ANSWER_MAX_CHARS]
+    if not item:
+        return 404, {"error": "질문을 찾을 수 없어요."}
+    if not answer:
+        return 400, {"error": "답을 입력해 주세요."}
+    # 선택은 이 항목의 A/B(choice_a/choice_b)만. 선택이 없는 항목은 무시
+    choice = str(payload.get("choice", "")) if item["choices"] else ""
+    if item["choices"] and choice not in ("A", "B"):
+        return 400, {"error": "A/B 중 하나를 골라 주세요."}
+
+    text = _compose_exported_answer(item, choice, answer)
+    _FEEDBACK_LOCAL.teacher_ctx = meta.get("teacher_ctx", "")
+    _FEEDBACK_LOCAL.min_sim = SEMANTIC_CACHE_MIN_SIM
+    _BUDGET_LOCAL.lesson_id = lesson_id
+    try:
+        index = get_rag_index()
+        rag_ctx = rag_retrieve_cached(rag_query_for_step(lesson.get("topic", ""), item["story"]), index) if index else ""
+        fb = feedback_with_tags(item["story"], text, rag_ctx, extra_context=item["extra"])
+    finally:
+        del _FEEDBACK_LOCAL.teacher_ctx, _FEEDBACK_LOCAL.min_sim, _BUDGET_LOCAL.lesson_id
+
+    record_class_answer(lesson_id, item["id"], f"{choice}: {answer}" if choice else answer, source="export")
+    return 200, {k: fb.get(k) for k in ("tags", "summary", "feedback")}
+
+# ---- Class summary: 단계별 반 전체 답을 한 번에 임베딩 → 로컬 k-means → 묶음마다 LLM 1번 ----
+CLASS_STORE_DIR = SESSION_STORE_DIR / "class"
+CLASS_SUMMARY_MIN_ANSWERS = 3
+CLASS_SUMMARY_MAX_K = 6
+CLASS_SUMMARY_EXAMPLES = 5
+CLASS_SUMMARY_TTL_S = 24 * 3600
+_class_store_lock = threading.Lock()
+
+def _class_item_id(row: dict) -> str:
+    # 로그 행 → lesson_items 의 id(s/c/d)
+    if "chapter" in row:
+        return f"c{row['chapter']}"
+    if "step" in row:
+        return f"s{int(row['step']) - 1}"
+    if "closing" in row:
+        return "d1"
+    return ""
+
+def _class_answer_text(row: dict) -> str:
+    if row.get("type") == "dilemma":
+        return f"{row.get('choice', '')}: {row.get('reason', '')}"
+    return str(row.get("answer") or row.get("reflection") or row.get("closing") or "")
+
+def record_class_answer(lesson_id: str, item_id: str, answer: str, source: str = "app"):
+    # 개인정보가 보이는 답은 반 전체 저장소(교사 요약·대표 답)에 남기지 않음
+    if not (lesson_id and item_id and answer.strip()) or any(rx.search(answer) for _, rx in _PII_RULES):
+        return
+    row = {"timestamp": now_str(), "item": item_id, "answer": answer.strip(), "source": source}
+    try:
+        CLASS_STORE_DIR.mkdir(parents=True, exist_ok=True)
+        with _class_store_lock, (CLASS_STORE_DIR / f"{lesson_id}.jsonl").open("a", encoding="utf-8") as f:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    except Exception:
+        pass
 
-if st.sidebar.button("⚠️ 전체 초기화"):
-    st.session_state.clear()
-    st.rerun()
+def load_class_answers(lesson_id: str, item_id: str) -> list:
+    p = CLASS_STORE_DIR / f"{lesson_id}.jsonl"
+    if not p.exists():
+        return []
+    # 제출 1건 = 1행(같은 답을 쓴 학생도 각각 셈). 중복 제거는 임베딩할 때만
+    out = []
+    with p.open(encoding="utf-8") as f:
+        for line in f:
+            row = safe_json_load(line)
+            if isinstance(row, dict) and row.get("item") == item_id:
+                a = _WS_RE.sub(" ", str(row.get("answer", ""))).strip()
+                if a:
+                    out.append(a)
+    return out
+
+def kmeans_numpy(X: np.ndarray, k: int, iters: int = 30, batch: int = 256, seed: int = 0):
+    # 단위 벡터 코사인 k-means(k-means++ 초기화). n > batch 면 미니배치 갱신
+    rng = np.random.default_rng(seed)
+    n = len(X)
+    k = max(1, min(k, n))
+    first = int(rng.integers(n))
+    C = [X[first]]
+    d2 = ((X - X[first]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        i = int(rng.choice(n, p=d2 / d2.sum())) if d2.sum() > 0 else int(rng.integers(n))
+        C.append(X[i])
+        d2 = np.minimum(d2, ((X - X[i]) ** 2).sum(axis=1))
+    C = np.stack(C).astype(np.float32)
+    counts = np.zeros(k, dtype=np.float32)
+    for _ in range(iters):
+        idx = rng.choice(n, size=batch, replace=False) if n > batch else np.arange(n)
+        lab = np.argmax(X[idx] @ C.T, axis=1)
+        for j in range(k):
+            members = X[idx][lab == j]
+            if not len(members):
+                continue
+            if n > batch:
+                counts[j] += len(members)
+                eta = len(members) / counts[j]
+                C[j] = (1 - eta) * C[j] + eta * members.mean(axis=0)
+            else:
+                C[j] = members.mean(axis=0)
+        C /= np.linalg.norm(C, axis=1, keepdims=True) + 1e-8
+    return np.argmax(X @ C.T, axis=1), C
+
+def _class_k(n: int) -> int:
+    return int(max(1, min(CLASS_SUMMARY_MAX_K, round((n / 2) ** 0.5))))
+
+def _embed_class_answers(answers: list):
+    # 같은 글은 1번만 임베딩하고 벡터를 행마다 재사용
+    uniq = list(dict.fromkeys(answers))
+    vecs = [None] * len(uniq)
+    for batch in split_embedding_batches(list(enumerate(uniq))):
+        out = embed_texts([_clip_for_embedding(t) for _, t in batch], priority=PRIORITY_TEACHER)
+        for (i, _), v in zip(batch, out):
+            vecs[i] = v
+    pos = {t: i for i, t in enumerate(uniq)}
+    return _unit_rows(np.array([vecs[pos[t]] for t in answers], dtype=np.float32))
+
+def _summarize_cluster(item: dict, examples: list, size: int, total: int) -> dict:
+    joined = "\n".join(f"- {_clip(a, 200)}" for a in examples)
+    prompt = f"""
+[반 전체 답 묶음 요약]
+상황: {_clip(item.get("story", ""), 600)}
+질문: {item.get("question", "")}
+이 묶음: 전체 {total}명 중 {size}명. 대표 답:
+{joined}
+
+반드시 JSON만 출력. 키:
+- label: 묶음 이름(10자 이내)
+- summary: 이 학생들의 공통 생각(1~2문장)
+- misconception: 오개념/주의점(1문장, 없으면 "없음")
+- teacher_move: 교사가 던질 후속 발문(1문장)
+"""
+    data = ask_gpt_json_object(prompt, system_prompt=SYSTEM_JSON_DESIGNER, priority=PRIORITY_TEACHER, call_class="summary")
+    return {k: str(data.get(k, "")).strip() for k in ("label", "summary", "misconception", "teacher_move")}
+
+def summarize_class_answers(lesson_id: str, item: dict) -> dict:
+    answers = load_class_answers(lesson_id, item["id"])
+    if len(answers) < CLASS_SUMMARY_MIN_ANSWERS:
+        return {"n": len(answers), "clusters": [], "calls": 0}
+    cache_key = sha256_text("\x1f".join([lesson_id, item["id"], *answers]))
+    cached = shared_get_json("class_summary", cache_key)
+    if isinstance(cached, dict):
+        return cached
 
-mode = st.sidebar.radio("모드 선택", ["👨‍🏫 교사용", "🙋‍♂️ 학생용"], key="mode_radio")
-st.session_state.mode = mode
+    try:
+        X = _embed_class_answers(answers)
+        labels, C = kmeans_numpy(X, _class_k(len(answers)))
+    except Exception:
+        X, labels, C = None, np.zeros(len(answers), dtype=int), None  # 임베딩 실패: 한 묶음으로
+    clusters = []
+    for j in sorted(set(labels.tolist()), key=lambda j: -int((labels == j).sum())):
+        members = np.flatnonzero(labels == j)
+        if X is not None:
+            members = members[np.argsort(-(X[members] @ C[j]))]  # 중심에 가까운 답부터
+        examples = list(dict.fromkeys(answers[i] for i in members))[:CLASS_SUMMARY_EXAMPLES]
+        clusters.append({"size": len(members), "examples": examples, **_summarize_cluster(item, examples, len(members), len(answers))})
+    result = {"n": len(answers), "clusters": clusters, "calls": len(clusters), "created": now_str()}
+    if all(c.get("summary") for c in clusters):  # 요약 실패(빈 묶음)가 있으면 다음에 다시 시도
+        shared_set_json("class_summary", cache_key, result, CLASS_SUMMARY_TTL_S)
+    return result
 
 # =========================================================
-# 17) Small image renderer (스토리 모드 이미지 대폭 축소)
+# 16) Small image renderer (스토리 모드 이미지 대폭 축소)
 # =========================================================
 def show_step_illustration_small(key: str, prompt_text: str, width_px: int = 300):
     if key not in st.session_state:
-        with st.spinner("이미지 생성..."):
-            st.session_state[key] = generate_image_bytes_cached(prompt_text, IMAGE_MODEL)
+        with st.spinner(queue_wait_text("이미지 생성...", IMAGE_MODEL)):
+            ref = image_ref_or_none(prompt_text, IMAGE_MODEL, PRIORITY_WARM)
+        if ref:
+            st.session_state[key] = ref
 
-    img = st.session_state.get(key)
+    img = load_asset(st.session_state.get(key))
     if img:
         cL, cM, cR = st.columns([6, 2, 6])
         with cM:
@@ -822,698 +3496,1067 @@ def show_step_illustration_small(key: str, prompt_text: str, width_px: int = 300
 
 def show_step_illustration_medium(key: str, prompt_text: str, width_px: int = 420):
     if key not in st.session_state:
-        with st.spinner("이미지 생성..."):
-            st.session_state[key] = generate_image_bytes_cached(prompt_text, IMAGE_MODEL)
+        with st.spinner(queue_wait_text("이미지 생성...", IMAGE_MODEL)):
+            ref = image_ref_or_none(prompt_text, IMAGE_MODEL, PRIORITY_WARM)
+        if ref:
+            st.session_state[key] = ref
 
-    img = st.session_state.get(key)
+    img = load_asset(st.session_state.get(key))
     if img:
         cL, cM, cR = st.columns([4, 4, 4])
         with cM:
             st.image(img, width=width_px)
 
-# =========================================================
-# 18) Teacher UI
-# =========================================================
-if mode == "👨‍🏫 교사용":
-    st.header("🛠️ 교사용 수업 생성")
-
-    with st.expander("📘 교사용 가이드라인(사용법)", expanded=True):
-        st.markdown(
-            """
-- 주제 1개 입력 → 아래 3개 버튼 중 1개로 수업 생성  
-- 생성 시 reference.txt를 자동 참고(RAG)  
-- 학생 피드백은 교사 기준/관점을 반영  
-- 스토리 모드는 ‘브러시’ 이야기로 5막 고정 진행
-"""
-        )
-
-    topic = st.text_input(
-        "수업 주제 입력",
-        value=st.session_state.topic,
-        placeholder="예: 저작권, 개인정보, 추천 알고리즘, 편향, 딥페이크..."
-    )
-    st.session_state.topic = topic
-
-    st.session_state.teacher_feedback_context = st.text_area(
-        "🧑‍🏫 교사 피드백 기준/관점(학생 피드백에 반영)",
-        value=st.session_state.teacher_feedback_context,
-        height=120,
-        placeholder="예) 1) 출처/허락/목적 구분 강조  2) 약관/학교 규칙 확인 언급  3) 대안 제시 가점",
-    )
+# ---- Student image prompt pre-check: 규칙 + 작은 분류기로 유료 생성 전에 거르기 ----
+# 규칙이 놓치는 표현용 시드(1 = 생성해도 쓸 수 없는 요청)
+IMAGE_PROMPT_SEEDS = [
+    ("우리 반 이름이 크게 보이는 포스터", 1), ("반 이름 넣은 간판", 1), ("말풍선에 인사말", 1),
+    ("유명한 캐릭터랑 똑같이", 1), ("만화 주인공 그대로 따라 그려줘", 1), ("인기 가수 얼굴", 1),
+    ("축구 선수 사진처럼", 1), ("싸우다가 다친 장면", 1), ("무서운 괴물이 사람을 공격", 1),
+    ("a banner that says hello", 1), ("famous cartoon mouse exactly", 1), ("a scary monster attacking", 1),
+    ("asdfasdf", 1), ("ㅋㅋㅋㅋㅋ", 1), ("아무거나", 1),
+    ("웃고 있는 고양이 마스코트, 파란 하늘", 0), ("별과 무지개가 있는 둥근 방패 모양", 0), ("숲속 마을과 작은 집들", 0),
+    ("친구들이 손을 잡은 원 모양", 0), ("노란 병아리와 초록 나무, 단순한 도형", 0), ("바다와 돌고래, 파스텔 색", 0),
+    ("simple class mascot, smiling owl, flat", 0), ("round badge with a tree and sun", 0), ("cozy village, river and bridge", 0),
+    ("하트와 별을 든 곰돌이", 0), ("우리 반을 상징하는 큰 나무와 새", 0), ("밝은 색 로켓과 행성", 0),
+    # 추가: 거절 쪽(글자/유명인/무서운 장면을 돌려 말함, 의미 없는 입력)
+    ("우리 반 구호가 적힌 현수막", 1), ("칠판에 환영합니다 라고", 1), ("반 번호가 크게 박힌 티셔츠", 1),
+    ("간판에 가게 이름", 1), ("신문 기사 화면", 1), ("책 표지에 우리 이름", 1),
+    ("게임 캐릭터 그대로", 1), ("애니메이션 주인공 똑같이 그려줘", 1), ("영화 포스터 그대로 따라해", 1),
+    ("유명한 배우 얼굴", 1), ("아이돌 멤버 사진", 1), ("우리 담임 선생님 얼굴 그대로", 1),
+    ("피 흘리는 사람", 1), ("괴물이 친구를 잡아먹는 장면", 1), ("싸움 나서 때리는 장면", 1),
+    ("sign that reads welcome", 1), ("poster with our class motto", 1), ("copy the famous superhero logo", 1),
+    ("photo of a real singer", 1), ("monster eating people, dark", 1), ("qwerty", 1),
+    ("ㅎㅎ", 1), ("몰라", 1), ("그냥", 1), ("ㅁㄴㅇㄹ", 1),
+    # 추가: 통과 쪽(앱 예시 프롬프트, "글자 없이"/"no text" 가 든 평범한 프롬프트)
+    ("글자 없는 숲속 마을", 0), ("글자 없이 숲속 마을을 그려줘", 0), ("글자 없이 단순한 도형으로 만든 우리 반 로고", 0),
+    ("simple class logo concept, flat illustration, mascot style, no text", 0),
+    ("make it more original, avoid famous characters, simple shapes, no logos, no text", 0),
+    ("colorful forest village, cozy houses, winding paths, soft sunlight, flat illustration, no text", 0),
+    ("warm forest village, small cozy cottages, river and bridge, friendly animals, soft pastel colors, flat illustration, simple shapes, no text", 0),
+    ("초록 언덕 위 풍차와 양", 0), ("비 오는 날 우산 쓴 개구리", 0), ("해바라기 밭과 나비", 0),
+    ("책을 읽는 부엉이 선생님", 0), ("눈사람과 눈송이, 파란 배경", 0), ("무지개 다리 위를 걷는 아이들", 0),
+    ("우주복 입은 강아지", 0), ("서로 돕는 개미들", 0), ("사과나무 아래 쉬는 토끼", 0),
+    ("a friendly robot watering plants", 0), ("hot air balloons over mountains", 0), ("a turtle and a rabbit holding hands", 0),
+    ("pastel rainbow shield with a star", 0), ("children planting trees, flat style", 0), ("a lighthouse by the calm sea", 0),
+]
 
-    def get_rag_ctx_for_topic(tp: str) -> str:
-        if not rag_index:
-            return ""
-        q = f"{tp} 사례01 사례02 사례03 사례04 사례05 딜레마 토론 국가 인공지능 윤리기준 프라이버시 보호 연대성 데이터 관리 침해 금지 안전성"
-        return rag_retrieve(q, rag_index, top_k=RAG_TOP_K)
+@st.cache_resource(show_spinner=False)
+def get_image_prompt_classifier():
+    texts = [t for t, _ in IMAGE_PROMPT_SEEDS]
+    Y = np.array([[y] for _, y in IMAGE_PROMPT_SEEDS], dtype=np.float32)
+    W, b = _train_logreg(char_ngram_features(texts), Y)
+    return {"W": W, "b": b}
+
+@st.cache_resource(show_spinner=False)
+def get_image_precheck_stats() -> dict:
+    return {"lock": threading.Lock(), "checked": 0, "passed": 0, "rewritten": 0, "rejected": {}}
+
+def _precheck_result(action: str, prompt: str, reason: str = "", message: str = "") -> dict:
+    stats = get_image_precheck_stats()
+    with stats["lock"]:
+        stats["checked"] += 1
+        if action == "reject":
+            stats["rejected"][reason] = stats["rejected"].get(reason, 0) + 1
+        else:
+            stats["passed" if action == "ok" else "rewritten"] += 1
+    return {"action": action, "prompt": prompt, "reason": reason, "message": message}
+
+def _asks_for_text(s: str) -> bool:
+    return bool(IMAGE_PROMPT_TEXT_RE.search(IMAGE_PROMPT_TEXT_NEG_RE.sub(" ", s)))
+
+def precheck_image_prompt(prompt: str) -> dict:
+    # {"action": ok|rewrite|reject, "prompt", "reason", "message"}
+    p = _WS_RE.sub(" ", (prompt or "").strip())
+    screened = IMAGE_PROMPT_SAFE_RE.sub(" ", p)
+    for reason, rx, msg in IMAGE_PROMPT_BLOCK_RULES:
+        if rx.search(screened):
+            return _precheck_result("reject", p, reason, msg)
+
+    action = "ok"
+    if _asks_for_text(p):
+        # 글자 요청이 든 구절(쉼표/마침표 단위)만 빼고 나머지로 생성
+        parts = [s.strip() for s in re.split(r"[,.\n]", p) if s.strip()]
+        kept = [s for s in parts if not _asks_for_text(s)]
+        if not kept:
+            return _precheck_result("reject", p, "text", "그림에는 글자를 넣을 수 없어요. 글자 대신 모양·색·동물로 표현해 보세요.")
+        p, action = ", ".join(kept), "rewrite"
+
+    if len(re.findall(r"[가-힣]", p)) < IMAGE_PROMPT_MIN_HANGUL and len(re.findall(r"[A-Za-z]", p)) < IMAGE_PROMPT_MIN_LATIN:
+        return _precheck_result("reject", p, "short", "조금 더 자세히 써 주세요. 무엇을(대상), 어떤 모습으로(색·모양) 그릴지 적어 보세요.")
+
+    clf = get_image_prompt_classifier()
+    score = float((1.0 / (1.0 + np.exp(-(char_ngram_features([p]) @ clf["W"] + clf["b"]))))[0, 0])
+    if score >= IMAGE_PROMPT_CLF_THRESHOLD:
+        return _precheck_result("reject", p, "classifier", "이 프롬프트는 그림으로 만들기 어려워요. 글자·유명 캐릭터 없이 무엇을 어떻게 그릴지 써 보세요.")
+
+    if action == "rewrite":
+        return _precheck_result("rewrite", p, "text", "그림에는 글자를 넣을 수 없어서 글자 부분은 빼고 만들게요!")
+    return _precheck_result("ok", p)
+
+def generate_student_image(prompt: str, spinner_text: str = "생성..."):
+    # 사전 점검을 통과한 프롬프트만 유료 생성. 세션에 넣을 이미지 참조(또는 None) 반환
+    check = precheck_image_prompt(prompt)
+    if check["action"] == "reject":
+        st.warning("🙅 " + check["message"])
+        return None
+    if check["action"] == "rewrite":
+        st.info(f"✏️ {check['message']}\n\n바뀐 프롬프트: {check['prompt']}")
+    with st.spinner(queue_wait_text(spinner_text, IMAGE_MODEL)):
+        ref = image_ref_or_none(check["prompt"], IMAGE_MODEL)
+    if not ref:
+        st.warning("지금은 그림을 만들지 못했어요. 잠시 후 다시 눌러 보세요.")
+    return ref
+
+# ---- Speculative prefetch: 학생이 현재 단계를 푸는 동안 다음 단계 자료 준비 ----
+PREFETCH_WORKERS = 4
+
+@st.cache_resource(show_spinner=False)
+def get_prefetcher() -> dict:
+    return {
+        "pool": ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch"),
+        "lock": threading.Lock(),
+        "pending": set(),
+        "submitted": 0,
+    }
 
-    c1, c2, c3 = st.columns(3)
+def _prefetch(key: str, fn, *args):
+    # 세션마다 같은 키는 1번만 제출. 실제 중복 호출은 캐시/single-flight가 막음.
+    seen = st.session_state.setdefault("_prefetched", set())
+    if key in seen:
+        return
+    seen.add(key)
+    pf = get_prefetcher()
+    with pf["lock"]:
+        if key in pf["pending"]:
+            return
+        pf["pending"].add(key)
+        pf["submitted"] += 1
+
+    def run():
+        try:
+            fn(*args)
+        except Exception:
+            pass
+        finally:
+            with pf["lock"]:
+                pf["pending"].discard(key)
+
+    pf["pool"].submit(run)
+
+def prefetch_step_assets(image_prompt: str = "", rag_query: str = "", index: dict = None):
+    if image_prompt:
+        _prefetch(
+            "img:" + image_key(image_prompt, IMAGE_MODEL),
+            generate_image_bytes_cached, image_prompt, IMAGE_MODEL, PRIORITY_WARM,
+        )
+    if rag_query and index and index.get("chunks"):
+        _prefetch(
+            "rag:" + sha256_text(rag_query + index.get("content_hash", "")),
+            rag_retrieve_cached, rag_query, index, RAG_TOP_K, PRIORITY_WARM,
+        )
 
-    with c1:
-        if st.button(f"1) {LESSON_IMAGE_PROMPT}"):
-            if not topic.strip():
-                st.warning("주제 필요.")
-            else:
-                with st.spinner("수업 생성 중..."):
-                    rag_ctx = get_rag_ctx_for_topic(topic.strip())
-                    lesson = generate_lesson_image_prompt(topic.strip(), rag_ctx)
+# ---- Fragments: 학생 답/토론/이미지 수정 패널은 자기 패널만 다시 실행 ----
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda f: f)
 
-                    st.session_state.lesson_type = lesson["lesson_type"]
-                    st.session_state.analysis = lesson["analysis"]
-                    st.session_state.teacher_guide = lesson["teacher_guide"]
+def _rerun_panel():
+    # 패널 안 상태만 바뀐 경우: 지원 버전이면 패널만, 아니면 전체 재실행. 재실행 전에 진행 상황 저장
+    checkpoint_progress()
+    try:
+        st.rerun(scope="fragment")
+    except Exception:
+        st.rerun()
 
-                    st.session_state.steps = lesson["steps"]
-                    st.session_state.current_step = 0
+def render_log_download():
+    # 답을 기록하는 패널(조각) 안에서도 그려서 조각만 다시 실행돼도 버튼이 바로 나타나고 최신 로그를 담음. 한 번 실행에 1개만
+    st.session_state["_log_download_shown"] = True
+    all_logs = all_session_logs()
+    if all_logs:
+        st.divider()
+        st.download_button(
+            "학습 로그 다운로드(JSON)",
+            data=json.dumps(all_logs, ensure_ascii=False, indent=2),
+            file_name="ethics_learning_log.json",
+            mime="application/json",
+            key="log_download",
+        )
 
-                    # clear others
-                    st.session_state.story_title = ""
-                    st.session_state.story_outline = []
-                    st.session_state.story_chapters = []
-                    st.session_state.story_chapter_index = 1
+def rag_ctx_for_step(text: str) -> str:
+    rag_index = get_rag_index()
+    if not rag_index:
+        return ""
+    return rag_retrieve_cached(rag_query_for_step(st.session_state.topic, text), rag_index, top_k=RAG_TOP_K)
+
+@_fragment
+def render_image_revision_panel(step: dict, idx: int):
+    st.divider()
+    st.subheader("🎨 프롬프트 → 이미지 → 수정")
+    st.caption("글자 없는 그림만 생성(자동 적용)")
+    st.write("목표:", "학급 로고 제작 대회에 낼 우리 반 로고(글자 없음) 만들기")
+
+    # 체크 선택 기능 제거(보기만)
+    items = step.get("checklist_items", [])
+    if isinstance(items, list) and items:
+        with st.expander("점검 포인트(보기)", expanded=False):
+            for it in items:
+                it = str(it).strip()
+                if it:
+                    st.write(f"- {it}")
 
-                    st.session_state.debate = {}
-                    st.session_state.closing = {}
-                    st.session_state.debate_turn = 0
-                    st.session_state.debate_msgs = []
+    p1_key = f"p1_{idx}"
+    p2_key = f"p2_{idx}"
+    img1_key = f"stu_img_{idx}_1"
+    img2_key = f"stu_img_{idx}_2"
 
-                    st.session_state.logs = []
-                    clear_step_images_from_session()
-                    clear_student_generated_images_from_session()
-                    clear_story_prompt_assets()
-                    st.success("생성 완료.")
+    p1 = st.text_input(
+        "1차 프롬프트",
+        value=st.session_state.get(p1_key, ""),
+        key=p1_key,
+        placeholder="예: simple class logo concept, flat illustration, mascot style, no text"
+    )
 
-    with c2:
-        if st.button(f"2) {LESSON_STORY_MODE}"):
-            if not topic.strip():
-                st.warning("주제 필요.")
+    cA, cB = st.columns([1, 1])
+    with cA:
+        if st.button("1차 이미지 생성", key=f"gen1_{idx}"):
+            if p1.strip():
+                ref = generate_student_image(p1.strip())
+                if ref:
+                    st.session_state[img1_key] = ref
             else:
-                with st.spinner("스토리 모드 수업 생성 중..."):
-                    lesson = generate_lesson_story_mode_fixed(topic.strip())
-
-                    st.session_state.lesson_type = lesson["lesson_type"]
-                    st.session_state.analysis = lesson["analysis"]
-                    st.session_state.teacher_guide = lesson["teacher_guide"]
-
-                    st.session_state.story_title = lesson["story_title"]
-                    st.session_state.story_outline = lesson["outline"]
-                    st.session_state.story_chapters = lesson["chapters"]
-                    st.session_state.story_chapter_index = 1
-
-                    # clear others
-                    st.session_state.steps = []
-                    st.session_state.current_step = 0
-
-                    st.session_state.debate = {}
-                    st.session_state.closing = {}
-                    st.session_state.debate_turn = 0
-                    st.session_state.debate_msgs = []
-
-                    st.session_state.logs = []
-                    clear_step_images_from_session()
-                    clear_student_generated_images_from_session()
-                    clear_story_prompt_assets()
-                    st.success("생성 완료.")
+                st.warning("프롬프트 입력 필요.")
+    with cB:
+        if st.button("1차 이미지 지우기", key=f"clr1_{idx}"):
+            if img1_key in st.session_state:
+                del st.session_state[img1_key]
+            _rerun_panel()
+
+    if st.session_state.get(img1_key):
+        cL, cM, cR = st.columns([6, 2, 6])
+        with cM:
+            st.image(load_asset(st.session_state[img1_key]), width=360, caption="1차 이미지")
+
+    default_p2 = st.session_state.get(p2_key, "")
+    if not default_p2 and p1:
+        default_p2 = p1
+    p2 = st.text_input(
+        "2차 프롬프트(수정)",
+        value=default_p2,
+        key=p2_key,
+        placeholder="예: make it more original, avoid famous characters, simple shapes, no logos, no text"
+    )
 
-    with c3:
-        if st.button(f"3) {LESSON_DEEP_DEBATE}"):
-            if not topic.strip():
-                st.warning("주제 필요.")
+    cC, cD = st.columns([1, 1])
+    with cC:
+        if st.button("2차 이미지 생성", key=f"gen2_{idx}"):
+            if p2.strip():
+                ref = generate_student_image(p2.strip())
+                if ref:
+                    st.session_state[img2_key] = ref
             else:
-                with st.spinner("심화 토론 수업 생성 중..."):
-                    rag_ctx = get_rag_ctx_for_topic(topic.strip())
-                    lesson = generate_lesson_deep_debate(topic.strip(), rag_ctx)
+                st.warning("프롬프트 입력 필요.")
+    with cD:
+        if st.button("2차 이미지 지우기", key=f"clr2_{idx}"):
+            if img2_key in st.session_state:
+                del st.session_state[img2_key]
+            _rerun_panel()
+
+    if st.session_state.get(img2_key):
+        cL, cM, cR = st.columns([6, 2, 6])
+        with cM:
+            st.image(load_asset(st.session_state[img2_key]), width=360, caption="2차 이미지(수정본)")
 
-                    st.session_state.lesson_type = lesson["lesson_type"]
-                    st.session_state.analysis = lesson["analysis"]
-                    st.session_state.teacher_guide = lesson["teacher_guide"]
+    reflection = st.text_area(
+        "🗣️ 어떤 내용의 로고를 제작했나요?",
+        key=f"ref_{idx}",
+        placeholder="예: 우리 반을 상징하는 ○○(동물/색/모양)을 넣고, 글자 없이 단순한 도형으로 만들었어요."
+    )
 
-                    # clear others
-                    st.session_state.steps = []
-                    st.session_state.current_step = 0
+    if st.button("제출(피드백 받기)", key=f"submit_rev_{idx}"):
+        if not st.session_state.get(img1_key):
+            st.warning("1차 이미지를 먼저 생성해야 함.")
+        elif not st.session_state.get(img2_key):
+            st.warning("2차 이미지를 생성(수정)해야 함.")
+        elif not reflection.strip():
+            st.warning("답변 입력 필요.")
+        else:
+            rag_ctx = rag_ctx_for_step(step.get("story", ""))
+            answer = f"""
+[1차 프롬프트] {p1.strip()}
+[2차 프롬프트] {p2.strip()}
+[로고 설명] {reflection.strip()}
+""".strip()
+            with st.spinner(queue_wait_text("피드백...")):
+                fb = feedback_with_tags(step.get("story", ""), answer, rag_ctx, extra_context="학급 로고 제작 대회: 로고 만들기/수정 활동")
+            with st.container(border=True):
+                if fb.get("tags"):
+                    st.write("태그:", ", ".join(fb["tags"]))
+                if fb.get("summary"):
+                    st.write("요약:", fb["summary"])
+                st.text(fb["feedback"])
+
+            append_log({
+                "timestamp": now_str(),
+                "topic": st.session_state.topic,
+                "lesson_type": st.session_state.lesson_type,
+                "step": idx + 1,
+                "type": "image_revision",
+                "p1": p1.strip(),
+                "p2": p2.strip(),
+                "reflection": reflection.strip(),
+                "feedback": fb,
+            })
+
+    render_log_download()
+    checkpoint_progress()
+
+@_fragment
+def render_story_answer_panel(chap: dict, chap_idx: int):
+    st.divider()
+    st.write(chap.get("question", ""))
+
+    answer_key = f"story_answer_{chap_idx}"
+    ans = st.text_area("내 생각", key=answer_key, placeholder="2~6줄")
+
+    if st.button("제출(피드백)", key=f"story_submit_{chap_idx}"):
+        if not ans.strip():
+            st.warning("답을 입력해 주세요.")
+        else:
+            rag_ctx = rag_ctx_for_step(chap.get("story", ""))
+            extra = "스토리 모드(고정 5막)"
+            if chap_idx == 1 and st.session_state.get("story_act1_prompt_final"):
+                extra += f" / 1막 프롬프트: {st.session_state.get('story_act1_prompt_final')}"
+            with st.spinner(queue_wait_text("피드백...")):
+                fb = feedback_with_tags(
+                    chap.get("story", ""),
+                    f"[질문] {chap.get('question','')}\n[답] {ans.strip()}",
+                    rag_ctx=rag_ctx,
+                    extra_context=extra
+                )
+            with st.container(border=True):
+                if fb.get("tags"):
+                    st.write("태그:", ", ".join(fb["tags"]))
+                if fb.get("summary"):
+                    st.write("요약:", fb["summary"])
+                st.text(fb["feedback"])
+
+            append_log({
+                "timestamp": now_str(),
+                "topic": st.session_state.topic,
+                "lesson_type": st.session_state.lesson_type,
+                "chapter": chap_idx,
+                "question": chap.get("question", ""),
+                "answer": ans.strip(),
+                "act1_prompt": st.session_state.get("story_act1_prompt_final", "") if chap_idx == 1 else "",
+                "feedback": fb,
+            })
+
+    render_log_download()
+    checkpoint_progress()
+
+@_fragment
+def render_debate_chat(debate: dict, closing: dict, rag_ctx: str, turns: int):
+    if st.session_state.debate_msgs:
+        st.divider()
+        for m in st.session_state.debate_msgs:
+            role = m.get("role", "student")
+            content = m.get("content", "")
+            st.chat_message("assistant" if role == "assistant" else "user").write(content)
+
+    st.divider()
+
+    if st.session_state.debate_turn == 0:
+        st.subheader("선택")
+        c1, c2 = st.columns(2)
+        with c1:
+            st.success("A: " + debate.get("choice_a", ""))
+        with c2:
+            st.warning("B: " + debate.get("choice_b", ""))
+
+        pick = st.radio("A/B 선택", ["A", "B"], horizontal=True, key="deb_pick")
+        opening_reason = st.text_area("왜 그렇게 생각하나요?", key="deb_opening_reason", placeholder="2~6줄")
+
+        if st.button("제출(후속 질문 시작)", key="deb_start"):
+            if not opening_reason.strip():
+                st.warning("이유 입력 필요.")
+            else:
+                choice_text = debate.get("choice_a") if pick == "A" else debate.get("choice_b")
+                msg = f"선택: {pick} / {choice_text}\n이유: {opening_reason.strip()}"
+                st.session_state.debate_msgs.append({"role": "student", "content": msg})
+                st.session_state.debate_summary = update_debate_summary(st.session_state.debate_summary, msg, "왜 그렇게 생각하나요?")
+                st.session_state.debate_choice = pick
+                st.session_state.debate_tree_node = ""
+                record_class_answer(st.session_state.get("lesson_id", ""), "d0", f"{pick}: {opening_reason.strip()}")
+
+                with st.spinner(queue_wait_text("후속 질문...", call_class="debate")):
+                    q1, src = debate_follow_up(
+                        st.session_state.topic,
+                        debate,
+                        st.session_state.debate_summary,
+                        opening_reason.strip(),
+                        1,
+                        rag_ctx
+                    )
+                st.session_state.debate_msgs.append({"role": "assistant", "content": q1, "source": src})
+                st.session_state.debate_turn = 1
+                _rerun_panel()
 
-                    st.session_state.story_title = ""
-                    st.session_state.story_outline = []
-                    st.session_state.story_chapters = []
-                    st.session_state.story_chapter_index = 1
+    elif 1 <= st.session_state.debate_turn <= turns:
+        t = st.session_state.debate_turn
+        st.subheader(f"후속 질문 {t}/{turns}")
+        ans = st.text_area("답변", key=f"deb_ans_{t}", placeholder="2~6줄")
 
-                    st.session_state.debate = lesson["debate_step"]
-                    st.session_state.closing = lesson["closing_step"]
-                    st.session_state.debate_turn = 0
-                    st.session_state.debate_msgs = []
+        if st.button("제출", key=f"deb_submit_{t}"):
+            if not ans.strip():
+                st.warning("입력 필요.")
+            else:
+                asked = last_debate_question(st.session_state.debate_msgs)
+                st.session_state.debate_msgs.append({"role": "student", "content": ans.strip()})
+                st.session_state.debate_summary = update_debate_summary(st.session_state.debate_summary, ans.strip(), asked)
+                if t < turns:
+                    with st.spinner(queue_wait_text("후속 질문...", call_class="debate")):
+                        qn, src = debate_follow_up(
+                            st.session_state.topic,
+                            debate,
+                            st.session_state.debate_summary,
+                            ans.strip(),
+                            t + 1,
+                            rag_ctx
+                        )
+                    st.session_state.debate_msgs.append({"role": "assistant", "content": qn, "source": src})
+                    st.session_state.debate_turn = t + 1
+                else:
+                    st.session_state.debate_turn = turns + 1
+                _rerun_panel()
 
-                    st.session_state.logs = []
-                    clear_step_images_from_session()
-                    clear_student_generated_images_from_session()
-                    clear_story_prompt_assets()
-                    st.success("생성 완료.")
+    else:
+        st.subheader("정리")
+        st.write(closing.get("story", ""))
+        st.write("질문:", closing.get("question", ""))
+
+        closing_ans = st.text_area("최종 정리 답", key="deb_close_ans", placeholder="2~6줄(규칙/원칙 형태)")
+        if st.button("제출(최종 피드백)", key="deb_finish"):
+            if not closing_ans.strip():
+                st.warning("입력 필요.")
+            else:
+                # 전체 대화 대신 (질문 → 답) 누적 요약만 전달(턴 수와 무관하게 입력 길이 일정)
+                answer = f"[토론 요약]\n{format_debate_summary(st.session_state.debate_summary)}\n\n[최종 정리]\n{closing_ans.strip()}"
 
-    if st.session_state.lesson_type:
-        st.divider()
-        st.subheader("✅ 현재 선택된 수업")
-        st.write(f"- 주제: {st.session_state.topic}")
-        st.write(f"- 유형: {st.session_state.lesson_type}")
+                with st.spinner(queue_wait_text("최종 피드백...")):
+                    fb = feedback_with_tags(
+                        debate.get("story", ""),
+                        answer,
+                        rag_ctx,
+                        extra_context=f"딜레마 토론({turns}턴) 최종 정리"
+                    )
+                with st.container(border=True):
+                    if fb.get("tags"):
+                        st.write("태그:", ", ".join(fb["tags"]))
+                    if fb.get("summary"):
+                        st.write("요약:", fb["summary"])
+                    st.text(fb["feedback"])
 
-    if st.session_state.teacher_guide:
-        with st.expander("📌 교사용 안내(자동 생성)", expanded=True):
-            st.text(st.session_state.teacher_guide)
+                append_log({
+                    "timestamp": now_str(),
+                    "topic": st.session_state.topic,
+                    "lesson_type": st.session_state.lesson_type,
+                    "debate_msgs": st.session_state.debate_msgs,
+                    "closing": closing_ans.strip(),
+                    "feedback": fb,
+                })
 
-    if st.session_state.analysis:
-        st.divider()
-        render_analysis_box(st.session_state.analysis)
+        if st.button("처음으로(학생)", key="deb_restart"):
+            st.session_state.debate_turn = 0
+            st.session_state.debate_msgs = []
+            st.session_state.debate_summary = []
+            st.session_state.debate_tree_node = ""
+            clear_step_images_from_session()
+            st.rerun()
 
-    # teacher preview for story
-    if st.session_state.lesson_type == LESSON_STORY_MODE and st.session_state.story_chapters:
-        st.divider()
-        st.subheader("📖 스토리 모드 미리보기(고정)")
-        st.write(f"🎨 제목: {st.session_state.story_title}")
-        with st.container(border=True):
-            st.markdown("### 5막 개요")
-            for i, o in enumerate(st.session_state.story_outline[:5], start=1):
-                st.write(f"- {i}막: {o.get('chapter_title','')} / {o.get('learning_focus','')}")
-        with st.container(border=True):
-            st.markdown("### 1막")
-            ch1 = st.session_state.story_chapters[0]
-            st.write(ch1.get("chapter_title", ""))
-            render_story_box(ch1.get("story", ""))
-            st.write(ch1.get("question", ""))
+    render_log_download()
+    checkpoint_progress()
 
 # =========================================================
-# 19) Student UI
+# 17) Sidebar
 # =========================================================
-else:
-    st.header("🙋‍♂️ 학생용 학습")
-
-    if not st.session_state.lesson_type:
-        st.warning("교사용에서 주제 입력 후 수업 유형 버튼을 눌러 생성 필요.")
-        st.stop()
+def main():
+    start_background_warmup()
+    init_session_state()
+    enforce_session_budget()
+    st.session_state["_log_download_shown"] = False
+
+    st.sidebar.title("🤖 AI 윤리 교육")
+
+    warm = health_report()
+    rag_index = get_rag_index()
+    if rag_index and warm["rag_index"]["building"]:
+        st.sidebar.caption("🔄 reference.txt 변경 감지: 새 색인 준비 중(기존 색인으로 계속)")
+    if not warm["ready"]:
+        done = [k for k, v in warm["steps"].items() if v["ok"]]
+        st.sidebar.caption("🔥 서버 준비 중..." + (f" (완료: {', '.join(done)})" if done else ""))
+    if rag_index and rag_index.get("chunks"):
+        st.sidebar.caption(f"📚 RAG 적용: reference.txt (Top-K={RAG_TOP_K})")
+        rag_rep = rag_storage_report(rag_index)
+        if rag_rep:
+            st.sidebar.caption(
+                f"🗜️ 색인 {rag_rep['storage']}×{rag_rep['dims']}d · {rag_rep['bytes'] / 1024:.0f}KB "
+                f"(float32 기본 대비 {rag_rep['bytes'] / max(1, rag_rep['float32_full_bytes']):.0%}) · recall@{RAG_TOP_K} {rag_rep['recall_at_k'] if rag_rep['recall_at_k'] is not None else '-'}"
+            )
+    else:
+        st.sidebar.caption("📚 RAG 적용: reference.txt")
+        if not Path(REFERENCE_PATH).exists():
+            st.sidebar.warning("reference.txt 없음(레포에 포함 필요)")
 
-    st.caption(f"주제: {st.session_state.topic}  |  수업 유형: {st.session_state.lesson_type}")
-
-    def rag_ctx_for_step(text: str) -> str:
-        if not rag_index:
-            return ""
-        q = f"{st.session_state.topic} {text} 저작권 출처 허락 사례01 사례02 사례03 사례04 사례05 국가 인공지능 윤리기준 프라이버시 보호 연대성 데이터 관리 침해 금지 안전성"
-        return rag_retrieve(q, rag_index, top_k=RAG_TOP_K)
-
-    # =====================================================
-    # A) IMAGE PROMPT LESSON
-    # =====================================================
-    if st.session_state.lesson_type == LESSON_IMAGE_PROMPT:
-        steps = st.session_state.steps
-        idx = st.session_state.current_step
-        total = len(steps)
-
-        if idx >= total:
-            st.success("수업 종료.")
-            if st.button("처음으로(학생)", key="img_restart"):
-                st.session_state.current_step = 0
-                st.session_state.logs = []
-                clear_step_images_from_session()
-                clear_student_generated_images_from_session()
-                st.rerun()
-            st.stop()
+    queue_info = [(m, rate_queue_depth(m)) for m in [TEXT_MODEL, TEXT_MODEL_FAST, IMAGE_MODEL, EMBED_MODEL]]
+    if any(n for _, n in queue_info):
+        st.sidebar.caption("⏳ 대기열: " + " / ".join(f"{m} {n}건" for m, n in queue_info if n))
 
-        step = steps[idx]
-        st.progress((idx + 1) / total)
-        st.subheader(f"단계 {idx+1} ({step.get('type','')})")
+    mem = session_memory_report()
+    st.sidebar.caption(
+        f"💾 세션 메모리: {mem['session'] / 1024:.0f}KB / 전체 {mem['sessions']}세션 {mem['total'] / 1_048_576:.1f}MB"
+    )
 
-        show_step_illustration_medium(f"step_img_{idx}", step.get("story", st.session_state.topic), width_px=420)
-        render_story_box(step.get("story", ""))
+    if st.sidebar.button("⚠️ 전체 초기화"):
+        clear_session_logs()
+        st.session_state.clear()
+        st.rerun()
 
-        if step.get("type") == "image_revision":
-            st.divider()
-            st.subheader("🎨 프롬프트 → 이미지 → 수정")
-            st.caption("글자 없는 그림만 생성(자동 적용)")
-            st.write("목표:", "학급 로고 제작 대회에 낼 우리 반 로고(글자 없음) 만들기")
-
-            # 체크 선택 기능 제거(보기만)
-            items = step.get("checklist_items", [])
-            if isinstance(items, list) and items:
-                with st.expander("점검 포인트(보기)", expanded=False):
-                    for it in items:
-                        it = str(it).strip()
-                        if it:
-                            st.write(f"- {it}")
-
-            p1_key = f"p1_{idx}"
-            p2_key = f"p2_{idx}"
-            img1_key = f"stu_img_{idx}_1"
-            img2_key = f"stu_img_{idx}_2"
-
-            p1 = st.text_input(
-                "1차 프롬프트",
-                value=st.session_state.get(p1_key, ""),
-                key=p1_key,
-                placeholder="예: simple class logo concept, flat illustration, mascot style, no text"
-            )
+    mode = st.sidebar.radio("모드 선택", ["👨‍🏫 교사용", "🙋‍♂️ 학생용"], key="mode_radio")
+    st.session_state.mode = mode
 
-            cA, cB = st.columns([1, 1])
-            with cA:
-                if st.button("1차 이미지 생성", key=f"gen1_{idx}"):
-                    if p1.strip():
-                        with st.spinner("생성..."):
-                            st.session_state[img1_key] = generate_image_bytes_cached(p1.strip(), IMAGE_MODEL)
-                    else:
-                        st.warning("프롬프트 입력 필요.")
-            with cB:
-                if st.button("1차 이미지 지우기", key=f"clr1_{idx}"):
-                    if img1_key in st.session_state:
-                        del st.session_state[img1_key]
-                    st.rerun()
+    # =========================================================
+    # 18) Teacher UI
+    # =========================================================
+    if mode == "👨‍🏫 교사용":
+        st.header("🛠️ 교사용 수업 생성")
 
-            if st.session_state.get(img1_key):
-                show_step_illustration_small(img1_key + "_view", "preview", width_px=1)  # no-op safety
-                cL, cM, cR = st.columns([6, 2, 6])
-                with cM:
-                    st.image(st.session_state[img1_key], width=360, caption="1차 이미지")
-
-            default_p2 = st.session_state.get(p2_key, "")
-            if not default_p2 and p1:
-                default_p2 = p1
-            p2 = st.text_input(
-                "2차 프롬프트(수정)",
-                value=default_p2,
-                key=p2_key,
-                placeholder="예: make it more original, avoid famous characters, simple shapes, no logos, no text"
+        with st.expander("📘 교사용 가이드라인(사용법)", expanded=True):
+            st.markdown(
+                """
+- 주제 1개 입력 → 아래 3개 버튼 중 1개로 수업 생성  
+- 생성 시 reference.txt를 자동 참고(RAG)  
+- 학생 피드백은 교사 기준/관점을 반영  
+- 스토리 모드는 ‘브러시’ 이야기로 5막 고정 진행
+"""
             )
 
-            cC, cD = st.columns([1, 1])
-            with cC:
-                if st.button("2차 이미지 생성", key=f"gen2_{idx}"):
-                    if p2.strip():
-                        with st.spinner("생성..."):
-                            st.session_state[img2_key] = generate_image_bytes_cached(p2.strip(), IMAGE_MODEL)
-                    else:
-                        st.warning("프롬프트 입력 필요.")
-            with cD:
-                if st.button("2차 이미지 지우기", key=f"clr2_{idx}"):
-                    if img2_key in st.session_state:
-                        del st.session_state[img2_key]
-                    st.rerun()
+        topic = st.text_input(
+            "수업 주제 입력",
+            value=st.session_state.topic,
+            placeholder="예: 저작권, 개인정보, 추천 알고리즘, 편향, 딥페이크..."
+        )
+        st.session_state.topic = topic
 
-            if st.session_state.get(img2_key):
-                cL, cM, cR = st.columns([6, 2, 6])
-                with cM:
-                    st.image(st.session_state[img2_key], width=360, caption="2차 이미지(수정본)")
+        st.session_state.teacher_feedback_context = st.text_area(
+            "🧑‍🏫 교사 피드백 기준/관점(학생 피드백에 반영)",
+            value=st.session_state.teacher_feedback_context,
+            height=120,
+            placeholder="예) 1) 출처/허락/목적 구분 강조  2) 약관/학교 규칙 확인 언급  3) 대안 제시 가점",
+        )
 
-            reflection = st.text_area(
-                "🗣️ 어떤 내용의 로고를 제작했나요?",
-                key=f"ref_{idx}",
-                placeholder="예: 우리 반을 상징하는 ○○(동물/색/모양)을 넣고, 글자 없이 단순한 도형으로 만들었어요."
+        def get_rag_ctx_for_topic(tp: str) -> str:
+            if not rag_index:
+                return ""
+            q = f"{tp} 사례01 사례02 사례03 사례04 사례05 딜레마 토론 국가 인공지능 윤리기준 프라이버시 보호 연대성 데이터 관리 침해 금지 안전성"
+            return rag_retrieve(q, rag_index, top_k=RAG_TOP_K, priority=PRIORITY_TEACHER)
+
+        with st.expander("⚙️ 심화 토론 설정", expanded=False):
+            st.number_input(
+                "후속 질문 수(턴)",
+                min_value=1,
+                max_value=DEBATE_TURNS_MAX,
+                step=1,
+                key="debate_turns_setting",
+            )
+            st.select_slider(
+                "후속 질문 미리 만들기(깊이, 0=사용 안 함)",
+                options=list(range(DEBATE_TREE_MAX_DEPTH + 1)),
+                key="debate_tree_depth_setting",
+                help="수업 생성 시 A/B × 논거 유형별 후속 질문을 미리 만들어, 비슷한 답이면 바로 질문합니다.",
             )
 
-            if st.button("제출(피드백 받기)", key=f"submit_rev_{idx}"):
-                if not st.session_state.get(img1_key):
-                    st.warning("1차 이미지를 먼저 생성해야 함.")
-                elif not st.session_state.get(img2_key):
-                    st.warning("2차 이미지를 생성(수정)해야 함.")
-                elif not reflection.strip():
-                    st.warning("답변 입력 필요.")
-                else:
-                    rag_ctx = rag_ctx_for_step(step.get("story", ""))
-                    answer = f"""
-[1차 프롬프트] {p1.strip()}
-[2차 프롬프트] {p2.strip()}
-[로고 설명] {reflection.strip()}
-""".strip()
-                    with st.spinner("피드백..."):
-                        fb = feedback_with_tags(step.get("story", ""), answer, rag_ctx, extra_context="학급 로고 제작 대회: 로고 만들기/수정 활동")
-                    with st.container(border=True):
-                        if fb.get("tags"):
-                            st.write("태그:", ", ".join(fb["tags"]))
-                        if fb.get("summary"):
-                            st.write("요약:", fb["summary"])
-                        st.text(fb["feedback"])
-
-                    st.session_state.logs.append({
-                        "timestamp": now_str(),
-                        "topic": st.session_state.topic,
-                        "lesson_type": st.session_state.lesson_type,
-                        "step": idx + 1,
-                        "type": "image_revision",
-                        "p1": p1.strip(),
-                        "p2": p2.strip(),
-                        "reflection": reflection.strip(),
-                        "feedback": fb,
-                    })
-
-            if st.button("다음 단계 >", key=f"next_rev_{idx}"):
-                st.session_state.current_step += 1
-                st.rerun()
-
-        elif step.get("type") == "dilemma":
-            st.divider()
-            c1, c2 = st.columns(2)
-            with c1:
-                st.success("A: " + step.get("choice_a", ""))
-            with c2:
-                st.warning("B: " + step.get("choice_b", ""))
-
-            sel = st.radio("선택", ["A", "B"], horizontal=True, key=f"sel_{idx}")
-            reason = st.text_area("왜 그렇게 생각하나요?", key=f"reason_{idx}", placeholder="2~4문장")
-
-            if st.button("제출(피드백)", key=f"submit_dil_{idx}"):
-                if not reason.strip():
-                    st.warning("이유 입력 필요.")
+        with st.expander("🖼️ 학생 이미지 프롬프트 사전 점검", expanded=False):
+            ps = get_image_precheck_stats()
+            saved = sum(ps["rejected"].values())
+            st.write(f"- 점검 {ps['checked']}회 · 통과 {ps['passed']}회 · 글자 요청 빼고 생성 {ps['rewritten']}회")
+            st.write(f"- 생성 전 거절(유료 호출 절약): {saved}회" + (f" ({', '.join(f'{k} {v}' for k, v in ps['rejected'].items())})" if saved else ""))
+
+        with st.expander("🧹 학생 답 사전 분류", expanded=False):
+            ts = get_triage_stats()
+            local_n = sum(ts["local"].values())
+            st.write(f"- AI 피드백으로 보냄: {ts['escalated']}회")
+            st.write(f"- 바로 안내(호출 절약): {local_n}회" + (f" ({', '.join(f'{k} {v}' for k, v in ts['local'].items())})" if local_n else ""))
+
+        with st.expander("♻️ 비슷한 답 피드백 재사용", expanded=False):
+            st.slider(
+                "유사도 기준(1.0 = 재사용 안 함)",
+                min_value=0.80,
+                max_value=1.0,
+                step=0.01,
+                key="semantic_cache_threshold",
+            )
+            cache_rows = semantic_cache_stats()
+            if cache_rows:
+                st.dataframe(cache_rows, use_container_width=True, hide_index=True)
+            else:
+                st.caption("아직 기록 없음.")
+
+        with st.expander("📈 AI 응답 형식 점검", expanded=False):
+            jq = get_json_quality_stats()
+            st.write(f"- 잘린 JSON 복구: {jq['partial']}회")
+            st.write(f"- 일부 필드 재요청: {jq['reask']}회 (복구 성공 {jq['reask_fixed']}회)")
+            fallback_rows = ", ".join(f"{k} {v}회" for k, v in jq["fallback"].items())
+            st.write(f"- 기본값 대체: {fallback_rows or '0회'}")
+
+        with st.expander("💰 모델 단계/일 예산", expanded=False):
+            br = budget_report()
+            st.caption(f"{br['day']} 기준 · 전체 비용 한도 ${DAILY_COST_BUDGET_USD:.0f} · 수업 코드별 {LESSON_DAILY_TOKENS:,} 토큰")
+            st.table([
+                {
+                    "종류": c,
+                    "모델 단계": " → ".join(CALL_CLASS_TIERS[c]),
+                    "토큰": f"{u['tokens']:,} / {u['budget']:,}",
+                    "비용($)": round(u["cost"], 3),
+                    "호출": u["calls"],
+                    "강등": u["degraded"],
+                    "대체": u["blocked"],
+                    "평균 지연(s)": ", ".join(f"{m} {s}" for m, s in u["latency"].items()) or "-",
+                }
+                for c, u in br["classes"].items()
+            ])
+            if br["lessons"]:
+                st.caption("수업 코드별 토큰: " + " / ".join(f"{k or '-'} {v:,}" for k, v in br["lessons"].items()))
+            for ev in reversed(br["events"][-8:]):
+                st.caption(f"{ev['t']} · {ev['class']} {ev['action']} ({ev['reason']})")
+
+        c1, c2, c3 = st.columns(3)
+
+        with c1:
+            if st.button(f"1) {LESSON_IMAGE_PROMPT}"):
+                if not topic.strip():
+                    st.warning("주제 필요.")
                 else:
-                    rag_ctx = rag_ctx_for_step(step.get("story", ""))
-                    choice_text = step.get("choice_a") if sel == "A" else step.get("choice_b")
-                    answer = f"선택: {sel} / {choice_text}\n이유: {reason.strip()}"
-                    with st.spinner("피드백..."):
-                        fb = feedback_with_tags(step.get("story", ""), answer, rag_ctx)
-                    with st.container(border=True):
-                        if fb.get("tags"):
-                            st.write("태그:", ", ".join(fb["tags"]))
-                        if fb.get("summary"):
-                            st.write("요약:", fb["summary"])
-                        st.text(fb["feedback"])
-
-                    st.session_state.logs.append({
-                        "timestamp": now_str(),
-                        "topic": st.session_state.topic,
-                        "lesson_type": st.session_state.lesson_type,
-                        "step": idx + 1,
-                        "type": "dilemma",
-                        "choice": sel,
-                        "reason": reason.strip(),
-                        "feedback": fb,
-                    })
-
-            if st.button("다음 단계 >", key=f"next_dil_{idx}"):
-                st.session_state.current_step += 1
-                st.rerun()
-
-        elif step.get("type") == "discussion":
-            st.divider()
-            st.write("질문:", step.get("question", ""))
-            opinion = st.text_area("내 답", key=f"disc_{idx}", placeholder="3~6줄")
-
-            if st.button("제출(피드백)", key=f"submit_disc_{idx}"):
-                if not opinion.strip():
-                    st.warning("답 입력 필요.")
+                    with st.spinner("수업 생성 중..."):
+                        rag_ctx = get_rag_ctx_for_topic(topic.strip())
+                        lesson = generate_lesson_image_prompt(topic.strip(), rag_ctx)
+
+                        apply_lesson_to_session(lesson)
+                        st.session_state.lesson_id = save_lesson(lesson)
+                        st.success("생성 완료.")
+
+        with c2:
+            if st.button(f"2) {LESSON_STORY_MODE}"):
+                if not topic.strip():
+                    st.warning("주제 필요.")
                 else:
-                    rag_ctx = rag_ctx_for_step(step.get("story", ""))
-                    with st.spinner("피드백..."):
-                        fb = feedback_with_tags(step.get("story", ""), opinion.strip(), rag_ctx)
-                    with st.container(border=True):
-                        if fb.get("tags"):
-                            st.write("태그:", ", ".join(fb["tags"]))
-                        if fb.get("summary"):
-                            st.write("요약:", fb["summary"])
-                        st.text(fb["feedback"])
-
-                    st.session_state.logs.append({
-                        "timestamp": now_str(),
-                        "topic": st.session_state.topic,
-                        "lesson_type": st.session_state.lesson_type,
-                        "step": idx + 1,
-                        "type": "discussion",
-                        "answer": opinion.strip(),
-                        "feedback": fb,
-                    })
-
-            if st.button("수업 종료 >", key=f"end_{idx}"):
-                st.session_state.current_step = len(steps)
-                st.rerun()
-
-    # =====================================================
-    # B) STORY MODE LESSON (고정 5막 + 이미지 작게 + 문장 한줄씩)
-    # =====================================================
-    elif st.session_state.lesson_type == LESSON_STORY_MODE:
-        if not st.session_state.story_chapters:
-            st.warning("스토리 데이터 없음. 교사용에서 다시 생성 필요.")
-            st.stop()
+                    with st.spinner("스토리 모드 수업 생성 중..."):
+                        lesson = generate_lesson_story_mode_fixed(topic.strip())
 
-        chap_idx = int(st.session_state.story_chapter_index)
-        chap_idx = max(1, min(5, chap_idx))
-        chapters = st.session_state.story_chapters
-        chap = next((c for c in chapters if int(c.get("chapter_index", 0)) == chap_idx), None)
-        if not chap:
-            st.warning("현재 막 데이터 없음.")
-            st.stop()
+                        apply_lesson_to_session(lesson)
+                        st.session_state.lesson_id = save_lesson(lesson)
+                        st.success("생성 완료.")
 
-        st.progress(chap_idx / 5)
-        st.subheader(f"{chap_idx}막 / 5막")
-        st.write(f"🎨 제목: {st.session_state.story_title}")
-
-        # ✅ 스토리 모드 이미지: 매우 작게
-        show_step_illustration_small(f"step_img_story_{chap_idx}", chap.get("story", st.session_state.topic), width_px=280)
+        with c3:
+            if st.button(f"3) {LESSON_DEEP_DEBATE}"):
+                if not topic.strip():
+                    st.warning("주제 필요.")
+                else:
+                    with st.spinner("심화 토론 수업 생성 중..."):
+                        rag_ctx = get_rag_ctx_for_topic(topic.strip())
+                        lesson = generate_lesson_deep_debate(
+                            topic.strip(),
+                            rag_ctx,
+                            turns=st.session_state.debate_turns_setting,
+                            tree_depth=st.session_state.debate_tree_depth_setting,
+                        )
 
-        # ✅ 한 줄씩 출력
-        st.write(chap.get("chapter_title", ""))
-        render_story_box(chap.get("story", ""))
+                        apply_lesson_to_session(lesson)
+                        st.session_state.lesson_id = save_lesson(lesson)
+                        st.success("생성 완료.")
 
-        # ✅ 1막: 학생이 직접 프롬프트 작성/출력 + (선택) 이미지 생성
-        if chap_idx == 1 and chap.get("act1_prompt_activity"):
+        if st.session_state.lesson_type:
             st.divider()
-            st.subheader("🧩 1막 활동: 내가 만드는 이미지 프롬프트")
-            st.caption(chap.get("prompt_activity_desc", ""))
-
-            st.session_state["story_act1_prompt"] = st.text_area(
-                "프롬프트 작성(글자 없는 그림)",
-                value=st.session_state.get("story_act1_prompt", ""),
-                placeholder="예: colorful forest village, cozy houses, winding paths, soft sunlight, flat illustration, no text"
-            )
-
-            c1, c2 = st.columns([1, 1])
-            with c1:
-                if st.button("프롬프트 출력(저장)", key="story_prompt_save"):
-                    p = (st.session_state.get("story_act1_prompt") or "").strip()
-                    if not p:
-                        st.warning("프롬프트를 먼저 작성해 주세요.")
+            st.subheader("✅ 현재 선택된 수업")
+            st.write(f"- 주제: {st.session_state.topic}")
+            st.write(f"- 유형: {st.session_state.lesson_type}")
+            if st.session_state.lesson_id:
+                st.write(f"- 수업 코드: `{st.session_state.lesson_id}` (학생용에서 코드로 불러오기)")
+
+                with st.expander("👥 반 전체 답 요약(비슷한 답끼리 묶기)", expanded=False):
+                    lesson = load_lesson(st.session_state.lesson_id)
+                    items = [it for it in lesson_items(lesson or {}) if it["question"]]
+                    if not items:
+                        st.caption("질문이 있는 단계가 없어요.")
                     else:
-                        st.session_state["story_act1_prompt_final"] = p
-                        st.success("프롬프트를 저장했어요.")
-            with c2:
-                if st.button("프롬프트 예시 넣기", key="story_prompt_example"):
-                    st.session_state["story_act1_prompt"] = (
-                        "warm forest village, small cozy cottages, river and bridge, friendly animals, "
-                        "soft pastel colors, flat illustration, simple shapes, no text"
+                        labels = {it["id"]: f"{it['title']} · {_clip(it['question'], 40)}" for it in items}
+                        item_id = st.selectbox("단계", list(labels), format_func=labels.get, key="class_summary_item")
+                        item = next(it for it in items if it["id"] == item_id)
+                        n = len(load_class_answers(st.session_state.lesson_id, item_id))
+                        st.caption(f"모인 답 {n}개 (최소 {CLASS_SUMMARY_MIN_ANSWERS}개부터 요약)")
+                        if st.button("요약 만들기", key="class_summary_run", disabled=n < CLASS_SUMMARY_MIN_ANSWERS):
+                            with st.spinner(queue_wait_text("답 묶는 중...", call_class="summary")):
+                                st.session_state[f"_class_summary_{item_id}"] = summarize_class_answers(st.session_state.lesson_id, item)
+                        summary = st.session_state.get(f"_class_summary_{item_id}")
+                        if summary and summary.get("clusters"):
+                            st.caption(f"답 {summary['n']}개 → {len(summary['clusters'])}묶음 · AI 호출 {summary['calls']}번")
+                            for c in summary["clusters"]:
+                                with st.container(border=True):
+                                    st.write(f"**{c.get('label') or '묶음'}** — {c['size']}명 ({c['size'] / summary['n']:.0%})")
+                                    st.write(c.get("summary", ""))
+                                    if c.get("misconception") and c["misconception"] != "없음":
+                                        st.write("주의:", c["misconception"])
+                                    if c.get("teacher_move"):
+                                        st.write("발문:", c["teacher_move"])
+                                    with st.expander("대표 답", expanded=False):
+                                        render_bullets(c["examples"])
+
+                with st.expander("📦 오프라인 수업 파일 내보내기(HTML/PWA)", expanded=False):
+                    st.caption(
+                        "이야기·그림·질문을 정적 파일로 내보냅니다. 학생 화면은 서버 없이 열리고, 답 제출만 아래 주소의 피드백 API를 부릅니다. "
+                        "오프라인 캐시(PWA)는 http(s)로 올렸을 때 동작합니다. 학생 기기에서 API에 닿으려면 서버를 HEALTH_HOST=0.0.0.0 으로 실행하고, "
+                        "파일을 올릴 주소를 EXPORT_ALLOWED_ORIGINS 에 넣으세요(파일로 직접 열면 그대로 동작). 파일마다 제출 토큰이 들어가며 최근 "
+                        f"{EXPORT_TOKENS_KEEP}개 파일만 제출을 받습니다."
                     )
-                    st.rerun()
-
-            if st.session_state.get("story_act1_prompt_final"):
-                with st.container(border=True):
-                    st.write("내 프롬프트:")
-                    st.code(st.session_state["story_act1_prompt_final"], language="text")
-
-                # (선택) 실제 이미지 생성
-                if st.button("이 프롬프트로 이미지 만들기(선택)", key="story_prompt_make_img"):
-                    with st.spinner("이미지 생성..."):
-                        st.session_state["story_act1_img"] = generate_image_bytes_cached(
-                            st.session_state["story_act1_prompt_final"], IMAGE_MODEL
+                    api_base = st.text_input("피드백 API 주소(학생 기기에서 닿는 주소)", value=default_export_api_base(), key="export_api_base")
+                    api_problem = export_api_problem(api_base)
+                    if api_problem:
+                        st.warning(api_problem)
+                    with_images = st.checkbox("삽화 포함(학생 화면에서 이미 만든 것)", value=True, key="export_with_images")
+                    gen_missing = st.checkbox("없는 삽화는 새로 만들기(이미지 생성 비용 발생)", value=False, key="export_gen_missing", disabled=not with_images)
+                    if st.button("내보내기 파일 만들기", key="export_build", disabled=bool(api_problem)):
+                        lesson = load_lesson(st.session_state.lesson_id)
+                        if not lesson:
+                            st.warning("저장된 수업을 찾을 수 없어요. 수업을 다시 생성해 주세요.")
+                        else:
+                            with st.spinner(queue_wait_text("내보내기 준비...", IMAGE_MODEL)):
+                                data = export_lesson_static(lesson, st.session_state.lesson_id, api_base, with_images, gen_missing)
+                            st.session_state[f"_export_{st.session_state.lesson_id}"] = put_asset(data, ".zip")
+                    export_zip = load_asset(st.session_state.get(f"_export_{st.session_state.lesson_id}"))
+                    if export_zip:
+                        st.download_button(
+                            "수업 파일 다운로드(zip)",
+                            data=export_zip,
+                            file_name=f"lesson_{st.session_state.lesson_id}.zip",
+                            mime="application/zip",
+                            key="export_download",
                         )
-                    st.rerun()
 
-                if st.session_state.get("story_act1_img"):
-                    cL, cM, cR = st.columns([6, 2, 6])
-                    with cM:
-                        st.image(st.session_state["story_act1_img"], width=280)
+        if st.session_state.teacher_guide:
+            with st.expander("📌 교사용 안내(자동 생성)", expanded=True):
+                st.text(st.session_state.teacher_guide)
 
-        st.divider()
-        st.write(chap.get("question", ""))
+        if st.session_state.analysis:
+            st.divider()
+            render_analysis_box(st.session_state.analysis)
 
-        answer_key = f"story_answer_{chap_idx}"
-        ans = st.text_area("내 생각", key=answer_key, placeholder="2~6줄")
+        # teacher preview for story
+        if st.session_state.lesson_type == LESSON_STORY_MODE and st.session_state.story_chapters:
+            st.divider()
+            st.subheader("📖 스토리 모드 미리보기(고정)")
+            st.write(f"🎨 제목: {st.session_state.story_title}")
+            with st.container(border=True):
+                st.markdown("### 5막 개요")
+                for i, o in enumerate(st.session_state.story_outline[:5], start=1):
+                    st.write(f"- {i}막: {o.get('chapter_title','')} / {o.get('learning_focus','')}")
+            with st.container(border=True):
+                st.markdown("### 1막")
+                ch1 = st.session_state.story_chapters[0]
+                st.write(ch1.get("chapter_title", ""))
+                render_story_box(ch1.get("story", ""), ch1.get("story_lines"))
+                st.write(ch1.get("question", ""))
+
+    # =========================================================
+    # 19) Student UI
+    # =========================================================
+    else:
+        st.header("🙋‍♂️ 학생용 학습")
+
+        if not st.session_state.lesson_type:
+            st.warning("교사용에서 주제 입력 후 수업 유형 버튼을 눌러 생성 필요.")
+            code = st.text_input("또는 수업 코드 입력", key="lesson_code_input", placeholder="예: 3F9A1C2B")
+            if st.button("수업 불러오기", key="lesson_code_load"):
+                loaded = load_lesson(code)
+                if loaded:
+                    st.session_state.topic = loaded.get("topic", "")
+                    apply_lesson_to_session(loaded)
+                    st.session_state.lesson_id = code.strip().upper()
+                    st.rerun()
+                else:
+                    st.warning("해당 코드의 수업이 없어요.")
+            resume = st.text_input("이어하기 코드(하던 곳부터 계속)", key="resume_code_input", placeholder="예: 7K2Q-9DMX-4HPA")
+            if st.button("이어하기", key="resume_load"):
+                restored = restore_progress(resume)
+                if restored == "ok":
+                    st.rerun()
+                elif restored == "limited":
+                    st.warning(f"잘못된 코드를 여러 번 넣었어요. {RESUME_FAIL_WINDOW_S // 60}분 뒤에 다시 해 보세요.")
+                else:
+                    st.warning("해당 이어하기 코드가 없어요.")
+            st.stop()
 
-        if st.button("제출(피드백)", key=f"story_submit_{chap_idx}"):
-            if not ans.strip():
-                st.warning("답을 입력해 주세요.")
-            else:
-                rag_ctx = rag_ctx_for_step(chap.get("story", ""))
-                extra = "스토리 모드(고정 5막)"
-                if chap_idx == 1 and st.session_state.get("story_act1_prompt_final"):
-                    extra += f" / 1막 프롬프트: {st.session_state.get('story_act1_prompt_final')}"
-                with st.spinner("피드백..."):
-                    fb = feedback_with_tags(
-                        chap.get("story", ""),
-                        f"[질문] {chap.get('question','')}\n[답] {ans.strip()}",
-                        rag_ctx=rag_ctx,
-                        extra_context=extra
-                    )
-                with st.container(border=True):
-                    if fb.get("tags"):
-                        st.write("태그:", ", ".join(fb["tags"]))
-                    if fb.get("summary"):
-                        st.write("요약:", fb["summary"])
-                    st.text(fb["feedback"])
+        checkpoint_progress()
+        st.caption(
+            f"주제: {st.session_state.topic}  |  수업 유형: {st.session_state.lesson_type}  |  "
+            f"이어하기 코드: **{format_resume_code(resume_code())}** (연결이 끊기면 이 코드로 계속)"
+        )
 
-                st.session_state.logs.append({
-                    "timestamp": now_str(),
-                    "topic": st.session_state.topic,
-                    "lesson_type": st.session_state.lesson_type,
-                    "chapter": chap_idx,
-                    "question": chap.get("question", ""),
-                    "answer": ans.strip(),
-                    "act1_prompt": st.session_state.get("story_act1_prompt_final", "") if chap_idx == 1 else "",
-                    "feedback": fb,
-                })
+        # =====================================================
+        # A) IMAGE PROMPT LESSON
+        # =====================================================
+        if st.session_state.lesson_type == LESSON_IMAGE_PROMPT:
+            steps = st.session_state.steps
+            idx = st.session_state.current_step
+            total = len(steps)
+
+            if idx >= total:
+                st.success("수업 종료.")
+                if st.button("처음으로(학생)", key="img_restart"):
+                    st.session_state.current_step = 0
+                    clear_session_logs()
+                    clear_step_images_from_session()
+                    clear_student_generated_images_from_session()
+                    st.rerun()
+                st.stop()
+
+            step = steps[idx]
+            st.progress((idx + 1) / total)
+            st.subheader(f"단계 {idx+1} ({step.get('type','')})")
+
+            show_step_illustration_medium(f"step_img_{idx}", step.get("story", st.session_state.topic), width_px=420)
+            render_story_box(step.get("story", ""), step.get("story_lines"))
+
+            # 현재 단계 RAG + 다음 단계 삽화/RAG 미리 가져오기
+            prefetch_step_assets(rag_query=rag_query_for_step(st.session_state.topic, step.get("story", "")), index=rag_index)
+            if idx + 1 < total:
+                nxt = steps[idx + 1]
+                prefetch_step_assets(
+                    nxt.get("story", st.session_state.topic),
+                    rag_query_for_step(st.session_state.topic, nxt.get("story", "")),
+                    rag_index,
+                )
+
+            if step.get("type") == "image_revision":
+                render_image_revision_panel(step, idx)
+
+                if st.button("다음 단계 >", key=f"next_rev_{idx}"):
+                    st.session_state.current_step += 1
+                    st.rerun()
 
-        # 다음 단계 이동
-        if chap.get("ending"):
-            st.divider()
-            st.success("스토리 종료.")
-            if chap.get("debrief"):
-                st.write("정리")
-                render_story_box(chap.get("debrief", ""))
-            if st.button("처음으로(학생)", key="story_restart"):
-                st.session_state.story_chapter_index = 1
-                st.session_state.logs = []
-                clear_step_images_from_session()
-                clear_story_prompt_assets()
-                st.rerun()
-        else:
-            if st.button("다음 단계로", key=f"story_next_{chap_idx}"):
-                st.session_state.story_chapter_index = chap_idx + 1
-                st.rerun()
-
-    # =====================================================
-    # C) DEEP DEBATE LESSON
-    # =====================================================
-    elif st.session_state.lesson_type == LESSON_DEEP_DEBATE:
-        debate = st.session_state.debate
-        closing = st.session_state.closing
-        if not debate:
-            st.warning("토론 데이터 없음. 교사용에서 다시 생성 필요.")
-            st.stop()
+            elif step.get("type") == "dilemma":
+                st.divider()
+                c1, c2 = st.columns(2)
+                with c1:
+                    st.success("A: " + step.get("choice_a", ""))
+                with c2:
+                    st.warning("B: " + step.get("choice_b", ""))
 
-        st.subheader("딜레마 토론 상황")
-        show_step_illustration_small("step_img_debate", debate.get("story", st.session_state.topic), width_px=300)
+                sel = st.radio("선택", ["A", "B"], horizontal=True, key=f"sel_{idx}")
+                reason = st.text_area("왜 그렇게 생각하나요?", key=f"reason_{idx}", placeholder="2~4문장")
 
-        if debate.get("case_title"):
-            st.write("사례:", debate.get("case_title", ""))
-        if debate.get("case_summary"):
-            st.write("요약:", debate.get("case_summary", ""))
+                if st.button("제출(피드백)", key=f"submit_dil_{idx}"):
+                    if not reason.strip():
+                        st.warning("이유 입력 필요.")
+                    else:
+                        rag_ctx = rag_ctx_for_step(step.get("story", ""))
+                        choice_text = step.get("choice_a") if sel == "A" else step.get("choice_b")
+                        answer = f"선택: {sel} / {choice_text}\n이유: {reason.strip()}"
+                        with st.spinner(queue_wait_text("피드백...")):
+                            fb = feedback_with_tags(step.get("story", ""), answer, rag_ctx)
+                        with st.container(border=True):
+                            if fb.get("tags"):
+                                st.write("태그:", ", ".join(fb["tags"]))
+                            if fb.get("summary"):
+                                st.write("요약:", fb["summary"])
+                            st.text(fb["feedback"])
+
+                        append_log({
+                            "timestamp": now_str(),
+                            "topic": st.session_state.topic,
+                            "lesson_type": st.session_state.lesson_type,
+                            "step": idx + 1,
+                            "type": "dilemma",
+                            "choice": sel,
+                            "reason": reason.strip(),
+                            "feedback": fb,
+                        })
+
+                if st.button("다음 단계 >", key=f"next_dil_{idx}"):
+                    st.session_state.current_step += 1
+                    st.rerun()
 
-        render_story_box(debate.get("story", ""))
+            elif step.get("type") == "discussion":
+                st.divider()
+                st.write("질문:", step.get("question", ""))
+                opinion = st.text_area("내 답", key=f"disc_{idx}", placeholder="3~6줄")
 
-        cons = debate.get("constraints", [])
-        if isinstance(cons, list) and cons:
-            with st.expander("토론 규칙", expanded=True):
-                for it in cons:
-                    st.write(f"- {it}")
+                if st.button("제출(피드백)", key=f"submit_disc_{idx}"):
+                    if not opinion.strip():
+                        st.warning("답 입력 필요.")
+                    else:
+                        rag_ctx = rag_ctx_for_step(step.get("story", ""))
+                        with st.spinner(queue_wait_text("피드백...")):
+                            fb = feedback_with_tags(step.get("story", ""), opinion.strip(), rag_ctx)
+                        with st.container(border=True):
+                            if fb.get("tags"):
+                                st.write("태그:", ", ".join(fb["tags"]))
+                            if fb.get("summary"):
+                                st.write("요약:", fb["summary"])
+                            st.text(fb["feedback"])
+
+                        append_log({
+                            "timestamp": now_str(),
+                            "topic": st.session_state.topic,
+                            "lesson_type": st.session_state.lesson_type,
+                            "step": idx + 1,
+                            "type": "discussion",
+                            "answer": opinion.strip(),
+                            "feedback": fb,
+                        })
+
+                if st.button("수업 종료 >", key=f"end_{idx}"):
+                    st.session_state.current_step = len(steps)
+                    st.rerun()
 
-        rag_ctx = rag_ctx_for_step(debate.get("story", ""))
+        # =====================================================
+        # B) STORY MODE LESSON (고정 5막 + 이미지 작게 + 문장 한줄씩)
+        # =====================================================
+        elif st.session_state.lesson_type == LESSON_STORY_MODE:
+            if not st.session_state.story_chapters:
+                st.warning("스토리 데이터 없음. 교사용에서 다시 생성 필요.")
+                st.stop()
+
+            chap_idx = int(st.session_state.story_chapter_index)
+            chap_idx = max(1, min(5, chap_idx))
+            chapters = st.session_state.story_chapters
+            chap = next((c for c in chapters if int(c.get("chapter_index", 0)) == chap_idx), None)
+            if not chap:
+                st.warning("현재 막 데이터 없음.")
+                st.stop()
+
+            st.progress(chap_idx / 5)
+            st.subheader(f"{chap_idx}막 / 5막")
+            st.write(f"🎨 제목: {st.session_state.story_title}")
+
+            # ✅ 스토리 모드 이미지: 매우 작게
+            show_step_illustration_small(f"step_img_story_{chap_idx}", chap.get("story", st.session_state.topic), width_px=280)
+
+            # ✅ 한 줄씩 출력
+            st.write(chap.get("chapter_title", ""))
+            render_story_box(chap.get("story", ""), chap.get("story_lines"))
+
+            prefetch_step_assets(rag_query=rag_query_for_step(st.session_state.topic, chap.get("story", "")), index=rag_index)
+            nxt = next((c for c in chapters if int(c.get("chapter_index", 0)) == chap_idx + 1), None)
+            if nxt:
+                prefetch_step_assets(
+                    nxt.get("story", st.session_state.topic),
+                    rag_query_for_step(st.session_state.topic, nxt.get("story", "")),
+                    rag_index,
+                )
+
+            # ✅ 1막: 학생이 직접 프롬프트 작성/출력 + (선택) 이미지 생성
+            if chap_idx == 1 and chap.get("act1_prompt_activity"):
+                st.divider()
+                st.subheader("🧩 1막 활동: 내가 만드는 이미지 프롬프트")
+                st.caption(chap.get("prompt_activity_desc", ""))
+
+                st.session_state["story_act1_prompt"] = st.text_area(
+                    "프롬프트 작성(글자 없는 그림)",
+                    value=st.session_state.get("story_act1_prompt", ""),
+                    placeholder="예: colorful forest village, cozy houses, winding paths, soft sunlight, flat illustration, no text"
+                )
+
+                c1, c2 = st.columns([1, 1])
+                with c1:
+                    if st.button("프롬프트 출력(저장)", key="story_prompt_save"):
+                        p = (st.session_state.get("story_act1_prompt") or "").strip()
+                        if not p:
+                            st.warning("프롬프트를 먼저 작성해 주세요.")
+                        else:
+                            st.session_state["story_act1_prompt_final"] = p
+                            st.success("프롬프트를 저장했어요.")
+                with c2:
+                    if st.button("프롬프트 예시 넣기", key="story_prompt_example"):
+                        st.session_state["story_act1_prompt"] = (
+                            "warm forest village, small cozy cottages, river and bridge, friendly animals, "
+                            "soft pastel colors, flat illustration, simple shapes, no text"
+                        )
+                        st.rerun()
 
-        turns = int(debate.get("turns", 3))
-        if turns != 3:
-            turns = 3
+                if st.session_state.get("story_act1_prompt_final"):
+                    with st.container(border=True):
+                        st.write("내 프롬프트:")
+                        st.code(st.session_state["story_act1_prompt_final"], language="text")
+
+                    # (선택) 실제 이미지 생성
+                    if st.button("이 프롬프트로 이미지 만들기(선택)", key="story_prompt_make_img"):
+                        ref = generate_student_image(st.session_state["story_act1_prompt_final"], "이미지 생성...")
+                        if ref:
+                            st.session_state["story_act1_img"] = ref
+                            st.rerun()
+
+                    if st.session_state.get("story_act1_img"):
+                        cL, cM, cR = st.columns([6, 2, 6])
+                        with cM:
+                            st.image(load_asset(st.session_state["story_act1_img"]), width=280)
+
+            render_story_answer_panel(chap, chap_idx)
+
+            # 다음 단계 이동
+            if chap.get("ending"):
+                st.divider()
+                st.success("스토리 종료.")
+                if chap.get("debrief"):
+                    st.write("정리")
+                    render_story_box(chap.get("debrief", ""), chap.get("debrief_lines"))
+                if st.button("처음으로(학생)", key="story_restart"):
+                    st.session_state.story_chapter_index = 1
+                    clear_session_logs()
+                    clear_step_images_from_session()
+                    clear_story_prompt_assets()
+                    st.rerun()
+            else:
+                if st.button("다음 단계로", key=f"story_next_{chap_idx}"):
+                    st.session_state.story_chapter_index = chap_idx + 1
+                    st.rerun()
 
-        if st.session_state.debate_msgs:
-            st.divider()
-            for m in st.session_state.debate_msgs:
-                role = m.get("role", "student")
-                content = m.get("content", "")
-                st.chat_message("assistant" if role == "assistant" else "user").write(content)
+        # =====================================================
+        # C) DEEP DEBATE LESSON
+        # =====================================================
+        elif st.session_state.lesson_type == LESSON_DEEP_DEBATE:
+            debate = st.session_state.debate
+            closing = st.session_state.closing
+            if not debate:
+                st.warning("토론 데이터 없음. 교사용에서 다시 생성 필요.")
+                st.stop()
 
-        st.divider()
+            st.subheader("딜레마 토론 상황")
+            show_step_illustration_small("step_img_debate", debate.get("story", st.session_state.topic), width_px=300)
 
-        if st.session_state.debate_turn == 0:
-            st.subheader("선택")
-            c1, c2 = st.columns(2)
-            with c1:
-                st.success("A: " + debate.get("choice_a", ""))
-            with c2:
-                st.warning("B: " + debate.get("choice_b", ""))
+            if debate.get("case_title"):
+                st.write("사례:", debate.get("case_title", ""))
+            if debate.get("case_summary"):
+                st.write("요약:", debate.get("case_summary", ""))
 
-            pick = st.radio("A/B 선택", ["A", "B"], horizontal=True, key="deb_pick")
-            opening_reason = st.text_area("왜 그렇게 생각하나요?", key="deb_opening_reason", placeholder="2~6줄")
+            render_story_box(debate.get("story", ""), debate.get("story_lines"))
 
-            if st.button("제출(후속 질문 시작)", key="deb_start"):
-                if not opening_reason.strip():
-                    st.warning("이유 입력 필요.")
-                else:
-                    choice_text = debate.get("choice_a") if pick == "A" else debate.get("choice_b")
-                    msg = f"선택: {pick} / {choice_text}\n이유: {opening_reason.strip()}"
-                    st.session_state.debate_msgs.append({"role": "student", "content": msg})
+            cons = debate.get("constraints", [])
+            if isinstance(cons, list) and cons:
+                with st.expander("토론 규칙", expanded=True):
+                    for it in cons:
+                        st.write(f"- {it}")
 
-                    q1 = debate_next_question(
-                        st.session_state.topic,
-                        debate.get("story", ""),
-                        st.session_state.debate_msgs,
-                        1,
-                        rag_ctx
-                    )
-                    st.session_state.debate_msgs.append({"role": "assistant", "content": q1})
-                    st.session_state.debate_turn = 1
-                    st.rerun()
+            rag_ctx = rag_ctx_for_step(debate.get("story", ""))
 
-        elif 1 <= st.session_state.debate_turn <= turns:
-            t = st.session_state.debate_turn
-            st.subheader(f"후속 질문 {t}/{turns}")
-            ans = st.text_area("답변", key=f"deb_ans_{t}", placeholder="2~6줄")
+            turns = clamp_debate_turns(debate.get("turns", DEBATE_TURNS_DEFAULT))
 
-            if st.button("제출", key=f"deb_submit_{t}"):
-                if not ans.strip():
-                    st.warning("입력 필요.")
-                else:
-                    st.session_state.debate_msgs.append({"role": "student", "content": ans.strip()})
-                    if t < turns:
-                        qn = debate_next_question(
-                            st.session_state.topic,
-                            debate.get("story", ""),
-                            st.session_state.debate_msgs,
-                            t + 1,
-                            rag_ctx
-                        )
-                        st.session_state.debate_msgs.append({"role": "assistant", "content": qn})
-                        st.session_state.debate_turn = t + 1
-                    else:
-                        st.session_state.debate_turn = 4
-                    st.rerun()
+            render_debate_chat(debate, closing, rag_ctx, turns)
 
-        else:
-            st.subheader("정리")
-            st.write(closing.get("story", ""))
-            st.write("질문:", closing.get("question", ""))
-
-            closing_ans = st.text_area("최종 정리 답", key="deb_close_ans", placeholder="2~6줄(규칙/원칙 형태)")
-            if st.button("제출(최종 피드백)", key="deb_finish"):
-                if not closing_ans.strip():
-                    st.warning("입력 필요.")
-                else:
-                    transcript = "\n\n".join(
-                        [("학생: " if m["role"] == "student" else "선생님: ") + m["content"] for m in st.session_state.debate_msgs]
-                    )
-                    answer = f"[토론 기록]\n{transcript}\n\n[최종 정리]\n{closing_ans.strip()}"
+        # =====================================================
+        # Logs download (패널이 이미 그렸으면 생략)
+        # =====================================================
+        if not st.session_state.get("_log_download_shown"):
+            render_log_download()
 
-                    with st.spinner("최종 피드백..."):
-                        fb = feedback_with_tags(
-                            debate.get("story", ""),
-                            answer,
-                            rag_ctx,
-                            extra_context="딜레마 토론(3턴) 최종 정리"
-                        )
-                    with st.container(border=True):
-                        if fb.get("tags"):
-                            st.write("태그:", ", ".join(fb["tags"]))
-                        if fb.get("summary"):
-                            st.write("요약:", fb["summary"])
-                        st.text(fb["feedback"])
-
-                    st.session_state.logs.append({
-                        "timestamp": now_str(),
-                        "topic": st.session_state.topic,
-                        "lesson_type": st.session_state.lesson_type,
-                        "debate_msgs": st.session_state.debate_msgs,
-                        "closing": closing_ans.strip(),
-                        "feedback": fb,
-                    })
-
-            if st.button("처음으로(학생)", key="deb_restart"):
-                st.session_state.debate_turn = 0
-                st.session_state.debate_msgs = []
-                clear_step_images_from_session()
-                st.rerun()
-
-    # =====================================================
-    # Logs download
-    # =====================================================
-    if st.session_state.logs:
-        st.divider()
-        st.download_button(
-            "학습 로그 다운로드(JSON)",
-            data=json.dumps(st.session_state.logs, ensure_ascii=False, indent=2),
-            file_name="ethics_learning_log.json",
-            mime="application/json",
-        )
+        checkpoint_progress()
+
+if _in_streamlit_runtime():
+    main()
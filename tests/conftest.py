@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+# import 전에: 공유 캐시는 테스트 전용 임시 sqlite, API 키는 가짜(실제 호출 없음)
+_CACHE_DIR = tempfile.mkdtemp(prefix="app-tests-")
+os.environ["SHARED_CACHE_URL"] = f"sqlite:///{_CACHE_DIR}/cache.db"
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+
+@pytest.fixture(scope="session")
+def app():
+    # `streamlit run` 밖에서 import 하면 화면 코드(main) 없이 함수/상수만 정의됨
+    import app as module
+
+    return module
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # 세션/수업 파일은 상대 경로(.session_store 등)에 쓰므로 테스트마다 빈 폴더에서 실행
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def debate_lesson(app):
+    # generate_lesson_deep_debate 가 만드는 모양 그대로(질문 트리는 비움)
+    return {
+        "topic": "학교에서 휴대폰 사용",
+        "lesson_type": app.LESSON_DEEP_DEBATE,
+        "analysis": {"ethics_standards": ["책임성"], "curriculum_alignment": ["도덕 6학년"], "lesson_content": ["규칙 만들기"]},
+        "teacher_guide": "A/B 선택 후 후속 질문 3번.",
+        "debate_step": {
+            "case_title": "쉬는 시간 휴대폰",
+            "case_summary": "반에서 쉬는 시간 휴대폰 사용을 두고 의견이 나뉘었다.",
+            "story": "쉬는 시간에 휴대폰을 써도 될지 반 회의가 열렸어요. 연락이 필요하다는 친구도, 게임만 할 거라는 친구도 있어요.",
+            "choice_a": "쉬는 시간에는 써도 된다",
+            "choice_b": "수업이 끝날 때까지 걷어 둔다",
+            "opening_question": "좋아, 네 생각이 궁금해.\nA/B 중 무엇을 선택하고, 왜 그렇게 생각하나요?",
+            "constraints": ["근거 1개 이상", "반대 의견 1개"],
+            "turns": 3,
+            "question_tree": {},
+        },
+        "closing_step": {
+            "story": "정리: 토론을 바탕으로 실행 가능한 규칙을 만든다.",
+            "question": "우리 반 휴대폰 규칙 3줄",
+        },
+    }
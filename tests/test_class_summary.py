@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+ITEM = {"id": "s1", "story": "친구가 AI 그림을 허락 없이 쓰려고 한다.", "question": "어떻게 해야 할까요?"}
+
+
+@pytest.mark.parametrize("row, item_id", [
+    ({"chapter": 3, "answer": "..."}, "c3"),
+    ({"step": 1, "type": "dilemma", "choice": "A", "reason": "..."}, "s0"),
+    ({"step": "4", "answer": "..."}, "s3"),
+    ({"closing": "규칙을 정해요."}, "d1"),
+    ({"type": "debate"}, ""),
+])
+def test_class_item_id_matches_lesson_items(app, row, item_id):
+    assert app._class_item_id(row) == item_id
+
+
+def test_class_answer_text_keeps_dilemma_choice(app):
+    assert app._class_answer_text({"type": "dilemma", "choice": "B", "reason": "약속이니까"}) == "B: 약속이니까"
+
+
+def _blobs(n_per: int, dims: int = 16, seed: int = 1):
+    rng = np.random.default_rng(seed)
+    centers = np.eye(dims, dtype=np.float32)[:3]
+    X = np.concatenate([c + 0.05 * rng.standard_normal((n_per, dims)).astype(np.float32) for c in centers])
+    return X / np.linalg.norm(X, axis=1, keepdims=True), np.repeat(np.arange(3), n_per)
+
+
+@pytest.mark.parametrize("n_per", [10, 200])  # 200×3 > batch → 미니배치 갱신 경로
+def test_kmeans_recovers_separated_groups(app, n_per):
+    X, truth = _blobs(n_per)
+    labels, C = app.kmeans_numpy(X, 3)
+    assert C.shape == (3, X.shape[1])
+    assert np.allclose(np.linalg.norm(C, axis=1), 1, atol=1e-3)
+    for g in range(3):
+        assert len(set(labels[truth == g].tolist())) == 1
+    assert len(set(labels.tolist())) == 3
+
+
+def test_kmeans_clips_k_to_rows(app):
+    X, _ = _blobs(1)
+    labels, C = app.kmeans_numpy(X, 10)
+    assert len(C) == len(X) and sorted(labels.tolist()) == [0, 1, 2]
+
+
+def test_answers_with_personal_info_are_not_stored(app, workdir):
+    app.record_class_answer("L1", "s1", "제 이름은 김민수이고 허락을 받아야 해요.")
+    app.record_class_answer("L1", "s1", "010-1234-5678로 연락해 주세요.")
+    app.record_class_answer("L1", "s1", "허락을 먼저 받아야 해요.")
+    assert app.load_class_answers("L1", "s1") == ["허락을 먼저 받아야 해요."]
+
+
+def test_empty_cluster_summaries_are_not_cached(app, workdir, monkeypatch):
+    for a in ("허락을 받아요.", "출처를 밝혀요.", "선생님께 여쭤봐요.", "몰래 쓰면 안 돼요."):
+        app.record_class_answer("L2", ITEM["id"], a)
+    calls = []
+
+    def fake_summary(item, examples, size, total):
+        calls.append(size)
+        return {"label": "", "summary": "" if len(calls) == 1 else "허락이 먼저", "misconception": "", "teacher_move": ""}
+
+    monkeypatch.setattr(app, "_embed_class_answers", lambda answers: (_ for _ in ()).throw(RuntimeError("offline")))
+    monkeypatch.setattr(app, "_summarize_cluster", fake_summary)
+    first = app.summarize_class_answers("L2", ITEM)
+    assert first["clusters"][0]["summary"] == ""
+    second = app.summarize_class_answers("L2", ITEM)
+    assert second["clusters"][0]["summary"] == "허락이 먼저" and len(calls) == 2
+    app.summarize_class_answers("L2", ITEM)
+    assert len(calls) == 2
+
+
+def test_same_answers_count_per_student_and_embed_once(app, workdir, monkeypatch):
+    answers = ["허락을 받아요."] * 4 + ["출처를 밝혀요."] * 2
+    for a in answers:
+        app.record_class_answer("L3", ITEM["id"], a)
+    assert app.load_class_answers("L3", ITEM["id"]) == answers
+    embedded = []
+
+    def fake_embed(texts, priority=None):
+        embedded.extend(texts)
+        return [[1.0, 0.0] if "허락" in t else [0.0, 1.0] for t in texts]
+
+    monkeypatch.setattr(app, "embed_texts", fake_embed)
+    monkeypatch.setattr(app, "_summarize_cluster", lambda item, examples, size, total: {"summary": "요약"})
+    summary = app.summarize_class_answers("L3", ITEM)
+    assert sorted(embedded) == sorted(set(answers))
+    assert summary["n"] == 6
+    assert [(c["size"], c["examples"]) for c in summary["clusters"]] == [(4, ["허락을 받아요."]), (2, ["출처를 밝혀요."])]
@@ -0,0 +1,165 @@
+import io
+import json
+import re
+import socket
+import urllib.error
+import urllib.request
+import zipfile
+
+import pytest
+
+
+@pytest.fixture
+def exported(app, workdir, monkeypatch, debate_lesson):
+    # 삽화 없이 내보내기 → (수업 코드, zip 안의 토큰). 피드백 LLM 호출은 가짜로
+    app.get_rate_windows()["hits"].clear()
+    lesson_id = app.save_lesson(debate_lesson)
+    data = app.export_lesson_static(debate_lesson, lesson_id, "https://ethics.example.kr:8599", include_images=False)
+    page = zipfile.ZipFile(io.BytesIO(data)).read("index.html").decode("utf-8")
+    token = json.loads(re.search(r"TOKEN = (\"[^\"]+\")", page).group(1))
+    monkeypatch.setattr(app, "get_rag_index", lambda: None)
+    monkeypatch.setattr(app, "feedback_with_tags", lambda *a, **k: {"tags": [], "summary": "요약", "feedback": "좋아요"})
+    yield lesson_id, token
+    app.get_rate_windows()["hits"].clear()
+
+
+@pytest.mark.parametrize("base", [
+    "http://127.0.0.1:8599", "http://localhost:8599", "http://0.0.0.0:8599", "http://[::1]:8599", "ftp://10.0.0.5", "8599",
+])
+def test_unreachable_api_bases_are_flagged(app, base):
+    assert app.export_api_problem(base)
+
+
+@pytest.mark.parametrize("base", ["http://192.168.0.20:8599", "https://ethics.example.kr"])
+def test_reachable_api_bases_pass(app, base):
+    assert app.export_api_problem(base) == ""
+
+
+def test_only_listed_origins_are_allowed(app):
+    assert app.export_origin_allowed("null")
+    assert not app.export_origin_allowed("https://evil.example.com")
+
+
+def test_submission_needs_the_exported_token(app, exported):
+    lesson_id, token = exported
+    body = {"lesson_id": lesson_id, "item": "d1", "answer": "서로 약속을 정하면 좋겠어요."}
+    assert app.handle_exported_feedback(body, client="1.2.3.4")[0] == 403
+    assert app.handle_exported_feedback({**body, "token": "x" + token}, client="1.2.3.4")[0] == 403
+    code, out = app.handle_exported_feedback({**body, "token": token}, client="1.2.3.4")
+    assert code == 200 and out["feedback"] == "좋아요"
+
+
+def test_reexport_keeps_recent_tokens(app, exported):
+    lesson_id, token = exported
+    lesson = app.load_lesson(lesson_id)
+    for _ in range(app.EXPORT_TOKENS_KEEP - 1):
+        app.export_lesson_static(lesson, lesson_id, "https://ethics.example.kr", include_images=False)
+    assert token in app.shared_get_json("export", lesson_id)["tokens"]
+    app.export_lesson_static(lesson, lesson_id, "https://ethics.example.kr", include_images=False)
+    assert token not in app.shared_get_json("export", lesson_id)["tokens"]
+
+
+def test_submissions_are_rate_limited_per_client(app, exported, monkeypatch):
+    lesson_id, token = exported
+    monkeypatch.setattr(app, "EXPORT_RATE_PER_CLIENT", 2)
+    body = {"lesson_id": lesson_id, "token": token, "item": "d1", "answer": "정리했어요."}
+    assert [app.handle_exported_feedback(body, client="1.2.3.4")[0] for _ in range(3)] == [200, 200, 429]
+    assert app.handle_exported_feedback(body, client="5.6.7.8")[0] == 200
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def server_url(app):
+    port = _free_port()
+    mp = pytest.MonkeyPatch()
+    mp.setattr(app, "HEALTH_PORT", port)
+    state = {}
+    app._start_health_server(state)
+    mp.undo()
+    assert state["health"].startswith("http://")
+    return f"http://127.0.0.1:{port}/api/feedback"
+
+
+def _post(url, data: bytes, origin=None):
+    headers = {"Content-Type": "text/plain"}
+    if origin:
+        headers["Origin"] = origin
+    req = urllib.request.Request(url, data=data, headers=headers, method="POST")
+    try:
+        with urllib.request.urlopen(req, timeout=5) as r:
+            return r.status, dict(r.headers)
+    except urllib.error.HTTPError as e:
+        return e.code, dict(e.headers)
+
+
+def test_empty_body_is_bad_request(server_url):
+    assert _post(server_url, b"")[0] == 400
+
+
+def test_oversized_body_is_rejected(app, server_url):
+    assert _post(server_url, b"x" * (app.EXPORT_BODY_MAX_BYTES + 1))[0] == 413
+
+
+def test_foreign_origin_is_refused_without_cors(server_url):
+    code, headers = _post(server_url, b"{}", origin="https://evil.example.com")
+    assert code == 403 and "Access-Control-Allow-Origin" not in headers
+
+
+def test_file_origin_gets_cors_header(server_url):
+    code, headers = _post(server_url, b"{}", origin="null")
+    assert code == 403 and headers.get("Access-Control-Allow-Origin") == "null"
+
+
+def _png() -> bytes:
+    from PIL import Image
+
+    buf = io.BytesIO()
+    Image.new("RGB", (32, 32), (200, 80, 40)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _assets(data: bytes) -> list:
+    return [n for n in zipfile.ZipFile(io.BytesIO(data)).namelist() if n.startswith("assets/")]
+
+
+def test_export_uses_stored_images_without_generating(app, workdir, monkeypatch, debate_lesson):
+    calls = []
+    monkeypatch.setattr(app, "_fetch_image_bytes", lambda prompt, *a: calls.append(prompt) or _png())
+    lesson = debate_lesson
+    lesson["debate_step"]["story"] += " (저장된 삽화)"
+    lesson_id = app.save_lesson(lesson)
+    assert _assets(app.export_lesson_static(lesson, lesson_id, "https://ethics.example.kr")) == []
+    app.save_original_image(app.image_key(lesson["debate_step"]["story"], app.IMAGE_MODEL), _png())
+    assert len(_assets(app.export_lesson_static(lesson, lesson_id, "https://ethics.example.kr"))) == 1
+    assert calls == []
+
+
+def test_export_generates_only_illustrated_items(app, workdir, monkeypatch, debate_lesson):
+    calls = []
+    monkeypatch.setattr(app, "_fetch_image_bytes", lambda prompt, *a: calls.append(prompt) or _png())
+    lesson = debate_lesson
+    lesson["debate_step"]["story"] += " (새 삽화)"
+    lesson_id = app.save_lesson(lesson)
+    app.export_lesson_static(lesson, lesson_id, "https://ethics.example.kr", generate_missing=True)
+    assert calls == [lesson["debate_step"]["story"]]
+
+
+@pytest.mark.parametrize("choice", ["", "C", "찬성", None])
+def test_invalid_choice_is_rejected(app, exported, choice):
+    lesson_id, token = exported
+    body = {"lesson_id": lesson_id, "token": token, "item": "d0", "choice": choice, "answer": "연락이 필요해요."}
+    assert app.handle_exported_feedback(body, client="1.2.3.4")[0] == 400
+
+
+def test_choice_is_ignored_for_items_without_choices(app, exported, monkeypatch):
+    lesson_id, token = exported
+    recorded = []
+    monkeypatch.setattr(app, "record_class_answer", lambda *a, **k: recorded.append(a))
+    body = {"lesson_id": lesson_id, "token": token, "item": "d1", "choice": "<script>", "answer": "규칙을 정해요."}
+    assert app.handle_exported_feedback(body, client="1.2.3.4")[0] == 200
+    assert recorded == [(lesson_id, "d1", "규칙을 정해요.")]
@@ -0,0 +1,99 @@
+import pytest
+
+# 앱이 학생에게 보여 주는 예시 프롬프트(그대로 통과해야 함)
+APP_EXAMPLE_PROMPTS = [
+    "simple class logo concept, flat illustration, mascot style, no text",
+    "make it more original, avoid famous characters, simple shapes, no logos, no text",
+    "colorful forest village, cozy houses, winding paths, soft sunlight, flat illustration, no text",
+    "warm forest village, small cozy cottages, river and bridge, friendly animals, "
+    "soft pastel colors, flat illustration, simple shapes, no text",
+]
+
+
+@pytest.mark.parametrize("prompt", APP_EXAMPLE_PROMPTS)
+def test_app_example_prompts_pass_unchanged(app, prompt):
+    check = app.precheck_image_prompt(prompt)
+    assert check["action"] == "ok"
+    assert check["prompt"] == prompt
+
+
+@pytest.mark.parametrize("prompt", [
+    "글자 없는 숲속 마을",
+    "글자 없이 숲속 마을을 그려줘",
+    "숲속 마을, 글씨는 넣지 말고",
+    "a cozy village without any text",
+    "text-free badge with a sun",
+])
+def test_negated_text_is_not_a_text_request(app, prompt):
+    assert app.precheck_image_prompt(prompt)["action"] == "ok"
+
+
+def test_text_request_is_dropped_from_its_clause_only(app):
+    check = app.precheck_image_prompt("웃는 고양이 마스코트, 우리 반 이름을 써 줘")
+    assert check["action"] == "rewrite"
+    assert check["prompt"] == "웃는 고양이 마스코트"
+
+
+def test_rewrite_keeps_and_phrases(app):
+    check = app.precheck_image_prompt("river and bridge, a banner that says hello")
+    assert check["action"] == "rewrite"
+    assert check["prompt"] == "river and bridge"
+
+
+def test_text_only_prompt_is_rejected(app):
+    check = app.precheck_image_prompt("우리 반 이름 글자")
+    assert (check["action"], check["reason"]) == ("reject", "text")
+
+
+@pytest.mark.parametrize("prompt, reason", [
+    ("피카츄랑 같이 노는 아이들", "brand"),
+    ("방탄 멤버들이 춤추는 장면", "person"),
+    ("좀비가 나오는 학교", "unsafe"),
+    ("a boy holding a gun", "unsafe"),
+])
+def test_block_rules(app, prompt, reason):
+    check = app.precheck_image_prompt(prompt)
+    assert (check["action"], check["reason"]) == ("reject", reason)
+
+
+@pytest.mark.parametrize("prompt", [
+    "방탄조끼를 입은 경찰 강아지",  # "방탄" 은 단어 전체일 때만
+    "따뜻한 호박죽이 든 그릇",
+    "죽이 담긴 그릇과 숟가락",  # "죽이"(죽 + 조사) 는 "죽이다" 가 아님
+    "마리오네트 인형 극장",
+    "사과 총 다섯 개가 든 바구니",
+])
+def test_block_rules_match_whole_words_only(app, prompt):
+    assert app.precheck_image_prompt(prompt)["action"] == "ok"
+
+
+def test_short_prompt_is_rejected(app):
+    assert app.precheck_image_prompt("산")["reason"] == "short"
+
+
+@pytest.mark.parametrize("prompt", ["무지개", "공룡", "우주", "로봇", "사과", "큰 나무", "sun"])
+def test_short_but_valid_prompts_pass(app, prompt):
+    assert app.precheck_image_prompt(prompt)["action"] == "ok"
+
+
+@pytest.mark.parametrize("prompt", [
+    "a number of birds flying",
+    "숫자 모양 구름",
+    "a girl writing in her diary",
+])
+def test_text_words_without_a_write_cue_pass(app, prompt):
+    assert app.precheck_image_prompt(prompt)["action"] == "ok"
+
+
+@pytest.mark.parametrize("prompt", [
+    "숫자 3을 크게 써 줘",
+    "a poster with the words be kind",
+    "write our class name on a flag",
+])
+def test_explicit_text_requests_are_caught(app, prompt):
+    assert app.precheck_image_prompt(prompt)["reason"] == "text"
+
+
+@pytest.mark.parametrize("prompt", ["a water gun fight in summer", "물총 놀이하는 여름 바다", "장난감 총으로 노는 아이"])
+def test_harmless_gun_compounds_pass(app, prompt):
+    assert app.precheck_image_prompt(prompt)["action"] == "ok"
@@ -0,0 +1,53 @@
+import io
+import uuid
+
+import streamlit as st
+from PIL import Image
+
+
+def _png() -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 64), (30, 120, 200)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def test_failed_image_fetch_is_not_cached(app, workdir, monkeypatch):
+    prompt = f"파란 하늘 아래 작은 집 {uuid.uuid4().hex}"
+    results = [None, _png()]
+    calls = []
+
+    def fake_fetch(user_prompt, model, priority):
+        calls.append(user_prompt)
+        return results[len(calls) - 1]
+
+    monkeypatch.setattr(app, "_fetch_image_bytes", fake_fetch)
+    assert app.image_ref_or_none(prompt, app.IMAGE_MODEL) is None
+    ref = app.image_ref_or_none(prompt, app.IMAGE_MODEL)
+    assert len(calls) == 2 and app.load_asset(ref)
+    assert app.image_ref_or_none(prompt, app.IMAGE_MODEL) == ref and len(calls) == 2
+
+
+def test_failed_illustration_leaves_no_session_ref(app, workdir, monkeypatch):
+    monkeypatch.setattr(app, "_fetch_image_bytes", lambda *a: None)
+    key = f"step_img_{uuid.uuid4().hex}"
+    app.show_step_illustration_small(key, f"숲속 마을 {uuid.uuid4().hex}")
+    assert key not in st.session_state
+
+
+def _image_row(app, key):
+    cache = app.get_shared_cache()
+    with cache.lock:
+        return cache.conn.execute("SELECT expires_at, rowid FROM cache WHERE ns = 'image' AND key = ?", (key,)).fetchone()
+
+
+def test_original_is_shared_once_with_a_ttl(app, workdir, monkeypatch, tmp_path):
+    key = uuid.uuid4().hex
+    app.save_original_image(key, _png())
+    expires_at, rowid = _image_row(app, key)
+    assert expires_at is not None
+    # 다른 레플리카(빈 디스크)에서 읽으면 디스크에만 받아 두고 공유 캐시는 다시 쓰지 않음
+    (tmp_path / "replica").mkdir()
+    monkeypatch.chdir(tmp_path / "replica")
+    assert app.load_original_image(key)
+    assert (app.IMAGE_STORE_DIR / f"{key}.png").exists()
+    assert _image_row(app, key) == (expires_at, rowid)
@@ -0,0 +1,70 @@
+import streamlit as st
+
+
+def _reset_session():
+    for k in list(st.session_state.keys()):
+        del st.session_state[k]
+
+
+def test_resume_code_is_long_and_unambiguous(app):
+    _reset_session()
+    code = app.resume_code()
+    assert len(code) == app.RESUME_CODE_LEN >= 10
+    assert set(code) <= set(app.RESUME_ALPHABET)
+    assert not set("01OIL") & set(app.RESUME_ALPHABET)
+    assert app.normalize_resume_code(app.format_resume_code(code).lower()) == code
+
+
+def _start_debate(app, lesson):
+    app.apply_lesson_to_session(lesson)
+    st.session_state.topic = lesson["topic"]
+    st.session_state.debate_turn = 2
+    st.session_state.debate_choice = "A"
+    st.session_state.debate_msgs = [
+        {"role": "student", "content": f"선택: A / {lesson['debate_step']['choice_a']}\n이유: 연락이 필요해요"},
+        {"role": "assistant", "content": "게임만 하는 친구가 있으면 어떻게 할까요?", "source": "tree"},
+    ]
+    return app.resume_code()
+
+
+def _assert_debate_restored(app, lesson, code):
+    ss = st.session_state
+    assert ss.lesson_type == app.LESSON_DEEP_DEBATE
+    assert (ss.debate_turn, ss.debate_choice) == (2, "A")
+    assert ss.debate_msgs[0]["content"].startswith("선택: A / 쉬는 시간에는")
+    for k in ("story", "choice_a", "choice_b", "turns", "opening_question"):
+        assert ss.debate[k] == lesson["debate_step"][k]
+    assert ss.debate["story_lines"] == app.split_to_lines(lesson["debate_step"]["story"], max_lines=app.STORY_MAX_LINES)
+    assert ss.closing["question"] == lesson["closing_step"]["question"]
+    assert ss.resume_code == code
+
+
+def test_checkpoint_and_restore_round_trip(app, workdir, debate_lesson):
+    _reset_session()
+    code = _start_debate(app, debate_lesson)
+    st.session_state.lesson_id = app.save_lesson(debate_lesson)
+    app.checkpoint_progress()
+
+    _reset_session()
+    assert app.restore_progress(app.format_resume_code(code)) == "ok"
+    _assert_debate_restored(app, debate_lesson, code)
+
+
+def test_restore_without_a_stored_lesson_uses_the_snapshot(app, workdir, debate_lesson):
+    # 수업 코드가 없으면(공유 캐시 저장 실패 등) 수업 내용을 스냅샷에 같이 저장
+    _reset_session()
+    code = _start_debate(app, debate_lesson)
+    app.checkpoint_progress()
+
+    _reset_session()
+    assert app.restore_progress(code) == "ok"
+    _assert_debate_restored(app, debate_lesson, code)
+
+
+def test_wrong_codes_are_rate_limited(app, workdir):
+    _reset_session()
+    app.get_rate_windows()["hits"].clear()
+    for _ in range(app.RESUME_MAX_FAILS):
+        assert app.restore_progress("ZZZZ-ZZZZ-ZZZZ") == "missing"
+    assert app.restore_progress("ZZZZ-ZZZZ-ZZZZ") == "limited"
+    app.get_rate_windows()["hits"].clear()
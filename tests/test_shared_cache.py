@@ -0,0 +1,39 @@
+import time
+
+
+def _backend(app, tmp_path):
+    return app.SQLiteCacheBackend(str(tmp_path / "cache.db"))
+
+
+def test_capped_namespace_drops_oldest_entries(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "SHARED_CACHE_NS_MAX_BYTES", {"image": 250})
+    cache = _backend(app, tmp_path)
+    for i in range(4):
+        cache.set("image", f"k{i}", bytes(100), ttl_s=3600 + i)
+    assert [cache.get("image", f"k{i}") is not None for i in range(4)] == [False, False, True, True]
+
+
+def test_uncapped_namespace_is_left_alone(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "SHARED_CACHE_NS_MAX_BYTES", {"image": 50})
+    cache = _backend(app, tmp_path)
+    for i in range(3):
+        cache.set("lesson", f"k{i}", bytes(100))
+    assert all(cache.get("lesson", f"k{i}") for i in range(3))
+
+
+def test_prune_removes_expired_rows(app, tmp_path):
+    cache = _backend(app, tmp_path)
+    cache.set("asset", "old", b"x" * 10, ttl_s=0.01)
+    time.sleep(0.02)
+    cache.prune("asset", 10**9)
+    assert cache.conn.execute("SELECT COUNT(*) FROM cache WHERE ns = 'asset'").fetchone()[0] == 0
+
+
+def test_assets_are_shared_with_a_ttl(app, workdir):
+    ref = app.put_asset(b"RIFF-asset-bytes-for-test")
+    cache = app.get_shared_cache()
+    with cache.lock:
+        expires_at = cache.conn.execute(
+            "SELECT expires_at FROM cache WHERE ns = 'asset' AND key = ?", (ref.rsplit("/", 1)[-1],)
+        ).fetchone()[0]
+    assert expires_at is not None and expires_at > time.time()
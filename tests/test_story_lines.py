@@ -0,0 +1,15 @@
+import pytest
+
+
+def test_sentences_split_after_closing_quotes(app):
+    text = "민지가 말했어요. “허락을 먼저 받자.” 모두 고개를 끄덕였어요."
+    assert app.split_to_lines(text) == ["민지가 말했어요.", "“허락을 먼저 받자.”", "모두 고개를 끄덕였어요."]
+
+
+@pytest.mark.parametrize("text", [
+    "친구가 “그건 내 그림이야.” 라고 말했어요.",
+    "선생님은 “출처를 꼭 적자!” 하고 웃었어요.",
+    "“괜찮을까?” 는 민지의 첫 질문이었어요.",
+])
+def test_quoted_speech_followed_by_a_particle_stays_on_one_line(app, text):
+    assert app.split_to_lines(text) == [text]
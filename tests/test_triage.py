@@ -0,0 +1,56 @@
+import pytest
+
+STORY = "친구가 AI로 만든 그림을 허락 없이 자기 발표에 쓰려고 한다. 어떻게 해야 할까?"
+
+
+@pytest.mark.parametrize("answer", [
+    "정직한 친구라면 먼저 허락을 받아야 한다고 생각해요.",
+    "고마운 선생님께 출처를 여쭤보고 쓰면 좋겠어요.",
+    "안전한 친구 사이라도 그림을 쓰기 전에 물어봐야 해요.",
+    "이상한 친구처럼 몰래 쓰면 안 되고 허락을 받아야 해요.",
+])
+def test_ordinary_phrases_are_not_names(app, answer):
+    assert app.triage_answer(STORY, answer) is None
+
+
+@pytest.mark.parametrize("answer", [
+    "돈을 내고 쓰면 괜찮다고 봐요",
+    "그 화가가 힘들게 만든 거잖아요",
+    "나도 같은 입장이면 기분 나쁠 것 같아요",
+    "게임만 할 것 같아서 반대",
+])
+def test_answers_without_story_words_go_to_the_model(app, answer):
+    assert app.triage_answer(STORY, answer) is None
+
+
+@pytest.mark.parametrize("answer, kind", [
+    ("제 이름은 김민수이고 허락을 받아야 한다고 생각해요.", "이름"),
+    ("짝꿍 이름은 박지훈인데 그림을 허락 없이 쓰면 안 돼요.", "이름"),
+    ("궁금하면 010-1234-5678로 연락해 주세요. 허락이 먼저예요.", "전화번호"),
+    ("제 메일 kid@example.com 으로 보내 주세요. 출처를 밝혀야 해요.", "이메일"),
+])
+def test_explicit_personal_info_is_withheld(app, answer, kind):
+    reason, info = app.triage_answer(STORY, answer)
+    assert reason == "pii"
+    assert kind in info["kinds"]
+
+
+def test_student_part_prefers_closing_over_summary_reason(app):
+    summary = app.format_debate_summary(
+        app.update_debate_summary([], "선택: A / 허락받기\n이유: 약속이니까", "왜 그렇게 생각하나요?")
+    )
+    answer = f"[토론 요약]\n{summary}\n\n[최종 정리]\n그림을 쓰기 전에 꼭 허락을 받아요."
+    assert app._student_part(answer) == "그림을 쓰기 전에 꼭 허락을 받아요."
+
+
+def test_short_and_copied_answers_stay_local(app):
+    assert app.triage_answer(STORY, "몰라요")[0] == "short"
+    assert app.triage_answer(STORY, "[답] " + STORY)[0] == "copy"
+
+
+def test_pii_feedback_has_no_summary(app):
+    answer = "제 이름은 김민수이고 허락을 받아야 해요."
+    reason, info = app.triage_answer(STORY, answer)
+    fb = app._triage_feedback(reason, info, answer)
+    assert fb["triage"] == "pii"
+    assert fb["summary"] == ""